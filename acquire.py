@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import string
+import config
+from lecroy import LeCroyScope
+from stats import Stats
+from autotune import tune_scope
+from cruncher import Cruncher, parse_extractor
+from monitor import Monitor, MonitorServer
+from suppress import ZeroSuppressor
+from writers import BlockCompressor
+from engine import AcquisitionEngine, CrunchFiles, hdf5_writer, raw_writer
+
+def acquire(nevents, nsequence, depth=4, stats=None, hdf5=None, raw=None, crunch=None, cruncher=None, monitor=None, first=0, points=0, sparsing=1,
+            block_events=1024, compression='gzip', level=None, shuffle=False, compressor=None, suppressor=None, max_events=0, max_bytes=0, max_seconds=0):
+    '''
+    Fetch waveform traces from the oscilloscope once and send them to any
+    combination of sinks in the same run: an HDF5 file `hdf5` as written by
+    fetch.py, a set of raw files `raw` as written by fetch_fast.py with the
+    writers.BlockCompressor `compressor`, crunch files `crunch` of the
+    cruncher.Cruncher `cruncher` as written by fetch_and_crunch.py, and a
+    monitor.Monitor `monitor`. A suppress.ZeroSuppressor as `suppressor`
+    applies to both file writers, which rotate by `max_events`,
+    `max_bytes` or `max_seconds` if given.
+    '''
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
+    engine = AcquisitionEngine(scope, nsequence, depth, stats, first, points, sparsing)
+    writers = []
+    if hdf5 is not None:
+        writers.append(('hdf5', hdf5_writer(engine, hdf5, nevents, block_events, compression, level, shuffle, max_events, max_bytes, max_seconds)))
+    if raw is not None:
+        writers.append(('raw', raw_writer(engine, raw, compressor, max_events, max_bytes, max_seconds)))
+    engine.add_writers(writers, suppressor)
+    if compressor is not None:
+        engine.at_close(compressor.close, compressor.summary)
+    if crunch is not None:
+        files = CrunchFiles(crunch, engine.channels, cruncher)
+        writer = engine.add_sink('crunch_writer', files.write, close=files.close)
+        engine.add_sink('crunch', files.crunch, outputs=[writer])
+    if monitor is not None:
+        engine.add_sink('monitor', monitor.process, close=monitor.publish)
+    return engine.run(nevents)
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog [--hdf5 <filename>] [--raw <prefix>] [--crunch <prefix>] [--monitor <filename>] [-n] [-s]"
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("--hdf5", type="string", dest="hdf5",
+                      help="save the traces to this HDF5 file as fetch.py", default=None)
+    parser.add_option("--raw", type="string", dest="raw",
+                      help="save the traces to raw files with this prefix as fetch_fast.py", default=None)
+    parser.add_option("--crunch", type="string", dest="crunch",
+                      help="crunch the traces to files with this prefix as fetch_and_crunch.py", default=None)
+    parser.add_option("--monitor", type="string", dest="monitor",
+                      help="file to publish live histograms and the average waveform to as JSON", default=None)
+    parser.add_option("--monitor-port", type="int", dest="monitor_port",
+                      help="port to serve the live monitor snapshots on (0 for none)", default=0)
+    parser.add_option("--monitor-interval", type="float", dest="monitor_interval",
+                      help="seconds between live monitor snapshots", default=5.0)
+    parser.add_option("-n", type="int", dest="nevents",
+                      help="number of events to capture in total", default=1000)
+    parser.add_option("-s", type="int", dest="nsequence",
+                      help="number of sequential events to capture at a time", default=1)
+    parser.add_option("--tune", action="store_true", dest="tune",
+                      help="measure the scope and choose the sequence count instead of -s", default=False)
+    parser.add_option("--memory", type="float", dest="memory",
+                      help="memory budget of the acquisition buffers in MB when tuning", default=512)
+    parser.add_option("--depth", type="int", dest="depth",
+                      help="number of acquisitions buffered for each sink", default=4)
+    parser.add_option("--ps", type="int", dest="ps",
+                      help="pedestal start index", default=0)
+    parser.add_option("--pe", type="int", dest="pe",
+                      help="pedestal end index", default=2500)
+    parser.add_option("--ws", type="int", dest="ws",
+                      help="window start index", default=2500)
+    parser.add_option("--we", type="int", dest="we",
+                      help="window end index", default=10000)
+    parser.add_option("--load", type="float", dest="load",
+                      help="load", default=50)
+    parser.add_option("--feature", action="append", dest="features",
+                      help="extra feature to crunch as name,start,end[,args], e.g. charge,2500,3000 peak,2500,10000 cfd,2500,10000,0.2", default=[])
+    parser.add_option("--full-record", action="store_true", dest="full_record",
+                      help="transfer whole segments when only crunching or monitoring", default=False)
+    parser.add_option("--block", type="int", dest="block_events",
+                      help="number of events written to the HDF5 file at a time", default=1024)
+    parser.add_option("--compression", type="choice", dest="compression", choices=['gzip', 'lzf', 'none'],
+                      help="compression filter for the HDF5 samples (gzip, lzf or none)", default='gzip')
+    parser.add_option("--shuffle", action="store_true", dest="shuffle",
+                      help="apply the shuffle filter before HDF5 compression", default=False)
+    parser.add_option("--raw-compression", type="choice", dest="raw_compression", choices=['zlib', 'bz2', 'none'],
+                      help="compression of each raw block (zlib, bz2 or none)", default='none')
+    parser.add_option("--level", type="int", dest="level",
+                      help="compression level of the HDF5 or raw samples", default=None)
+    parser.add_option("--workers", type="int", dest="workers",
+                      help="number of raw compression threads", default=2)
+    parser.add_option("--suppress", type="choice", dest="suppress", choices=['drop', 'shrink', 'none'],
+                      help="zero suppression of written segments below --threshold: drop them, zero their samples (shrink) or none", default='none')
+    parser.add_option("--threshold", type="float", dest="threshold",
+                      help="zero suppression threshold in volts from the pedestal", default=0.01)
+    parser.add_option("--rotate-events", type="int", dest="rotate_events",
+                      help="start new files after this many events (0 for no limit)", default=0)
+    parser.add_option("--rotate-mb", type="float", dest="rotate_mb",
+                      help="start new files after this many MB of samples (0 for no limit)", default=0)
+    parser.add_option("--rotate-seconds", type="float", dest="rotate_seconds",
+                      help="start new files after this many seconds (0 for no limit)", default=0)
+    parser.add_option("--stats", type="float", dest="stats",
+                      help="seconds between timing summaries (0 for none)", default=0)
+    parser.add_option("--stats-file", type="string", dest="stats_file",
+                      help="file to write the timing stats to", default=None)
+    parser.add_option("--stats-format", type="choice", dest="stats_format", choices=['jsonl', 'prom'],
+                      help="format of the stats file: JSON lines (jsonl) or Prometheus text (prom)", default='jsonl')
+    parser.add_option("--time", action="store_true", dest="time",
+                      help="append time string to the filenames", default=False)
+    (options, args) = parser.parse_args()
+
+    if options.hdf5 is None and options.raw is None and options.crunch is None and options.monitor is None and not options.monitor_port:
+        sys.exit(parser.format_help())
+
+    if options.nevents < 1 or options.nsequence < 1:
+        sys.exit("Arguments to -s or -n must be positive")
+
+    try:
+        extractors = [parse_extractor(spec) for spec in options.features]
+    except Exception as e:
+        sys.exit(str(e))
+
+    suffix = '_' + string.replace(time.asctime(time.localtime()), ' ', '-') if options.time else ''
+    hdf5 = options.hdf5 + suffix + '.h5' if options.hdf5 is not None else None
+    raw = options.raw + suffix if options.raw is not None else None
+    crunch = options.crunch + suffix if options.crunch is not None else None
+    for filename in (hdf5, raw, crunch):
+        if filename is not None:
+            print 'Saving to file %s' % filename
+
+    if options.tune:
+        options.nsequence = tune_scope(options.memory*1e6, options.depth)
+
+    stats = None
+    if options.stats > 0 or options.stats_file is not None:
+        stats = Stats(options.stats if options.stats > 0 else 10.0, options.stats_file, options.stats_format)
+
+    cruncher = Cruncher(options.ps, options.pe, options.ws, options.we, options.load)
+    for extractor in extractors:
+        cruncher.register(extractor)
+
+    # whole segments are needed by the file writers
+    first, points = 0, 0
+    if hdf5 is None and raw is None and not options.full_record:
+        first, end = cruncher.record_range()
+        points = end - first
+
+    compressor = None
+    if raw is not None and options.raw_compression != 'none':
+        compressor = BlockCompressor(options.raw_compression, options.level, options.workers, stats)
+
+    suppressor = None
+    if options.suppress != 'none':
+        suppressor = ZeroSuppressor(options.ps, options.pe, options.ws, options.we, options.threshold, mode=options.suppress)
+
+    monitor = None
+    server = None
+    if options.monitor is not None or options.monitor_port:
+        monitor = Monitor(options.ps, options.pe, options.ws, options.we, options.load, interval=options.monitor_interval, filename=options.monitor)
+        if options.monitor_port:
+            server = MonitorServer(monitor, port=options.monitor_port).start()
+            print 'Serving live monitor snapshots on port %i' % server.port
+
+    start = time.time()
+    count = acquire(options.nevents, options.nsequence, options.depth, stats, hdf5, raw, crunch, cruncher, monitor, first, points,
+                    block_events=options.block_events, compression=options.compression, level=options.level, shuffle=options.shuffle,
+                    compressor=compressor, suppressor=suppressor, max_events=options.rotate_events, max_bytes=options.rotate_mb*1e6,
+                    max_seconds=options.rotate_seconds)
+    elapsed = time.time() - start
+    if server is not None:
+        server.stop()
+    if count > 0:
+        print 'Completed %i events in %.3f seconds.' % (count, elapsed)
+        print 'Averaged %.5f seconds per acquisition.' % (elapsed/count)
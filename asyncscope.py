@@ -0,0 +1,546 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An event driven LeCroy client for running many instruments from one
+# thread. Coroutines are generators that yield what they wait for: another
+# coroutine (whose value is returned by the yield), a Task, a Wait on a
+# socket, sleep(seconds) or with_timeout(coroutine, seconds). A coroutine
+# returns a value by raising Return(value). For example
+#
+#     loop = EventLoop()
+#     scope = AsyncLeCroyScope(ip)
+#     def run():
+#         yield scope.connect()
+#         yield scope.trigger()
+#         wave_desc, wave_array = yield with_timeout(scope.get_waveform(1), 10.0)
+#         raise Return(wave_array.mean())
+#     print loop.run_until_complete(run())
+
+import os
+import time
+import errno
+import types
+import select
+import socket
+import struct
+import collections
+from lecroy import headerformat, errors, setting_commands, ordered_settings, batch_size, recv_buffer_size, decode_wavedesc, decode_waveform, Waveform
+
+# errors of non-blocking socket calls that only mean "not yet"
+would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS)
+
+class Return(Exception):
+    '''
+    Raised by a coroutine to return `value` to whatever yielded it.
+    '''
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+class Cancelled(Exception):
+    '''
+    Thrown into the coroutines of a cancelled Task.
+    '''
+    pass
+
+class Timeout(socket.timeout):
+    '''
+    Thrown into a coroutine whose time is up.
+    '''
+    pass
+
+class Wait(object):
+    '''
+    Yielded by a coroutine to wait until `sock` is readable ('read') or
+    writable ('write'), for at most `timeout` seconds, after which Timeout
+    is raised, or the yield returns False if `quiet` is set. Without a
+    socket it just waits for the timeout, or for a task to wake it.
+    '''
+    def __init__(self, sock, mode, timeout=None, quiet=False):
+        self.sock = sock
+        self.mode = mode
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.quiet = quiet or sock is None
+
+class WithTimeout(object):
+    def __init__(self, coroutine, timeout):
+        self.coroutine = coroutine
+        self.timeout = timeout
+
+def sleep(seconds):
+    '''
+    Yield the result to wait `seconds`.
+    '''
+    return Wait(None, 'sleep', seconds)
+
+def with_timeout(coroutine, timeout):
+    '''
+    Yield the result to run `coroutine`, throwing Timeout into it if it
+    takes longer than `timeout` seconds (None for no limit). `coroutine` may
+    also be a Task, to wait for, or another with_timeout, in which case the
+    earlier deadline applies.
+    '''
+    return WithTimeout(coroutine, timeout)
+
+def wait_for(task):
+    '''
+    A coroutine returning the result of `task`.
+    '''
+    result = yield task
+    raise Return(result)
+
+class Task(object):
+    '''
+    Runs a coroutine, and the coroutines it yields, on an EventLoop. The
+    outcome is in `result` or `error` once `done`.
+    '''
+    def __init__(self, loop, coroutine):
+        self.loop = loop
+        self.stack = [coroutine]
+        # [stack depth, absolute time] of the with_timeout calls in progress
+        self.deadlines = []
+        self.waiting = None
+        self.pending = None
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def cancel(self):
+        '''
+        Throws Cancelled into the coroutine the task is waiting in.
+        '''
+        self.interrupt(Cancelled())
+
+    def interrupt(self, error):
+        if self.done:
+            return
+        if self.waiting is not None:
+            self.wake(self.waiting, None, error)
+        else:
+            self.pending = error # thrown at the next step
+
+    def wake(self, request, value=None, error=None):
+        '''
+        Resumes the task if it is still waiting for `request`.
+        '''
+        if self.waiting is request:
+            self.waiting = None
+            self.loop.schedule(self, value, error)
+
+    def expire(self, depth):
+        '''
+        Throws Timeout into the coroutine started by the with_timeout at
+        stack `depth`, closing the coroutines it is waiting in.
+        '''
+        if self.done:
+            return
+        while len(self.stack) > depth:
+            self.stack.pop().close()
+        while self.deadlines and self.deadlines[-1][0] >= depth:
+            self.deadlines.pop()
+        self.waiting = None
+        self.loop.schedule(self, None, Timeout('timed out'))
+
+    def pop(self):
+        self.stack.pop()
+        while self.deadlines and self.deadlines[-1][0] > len(self.stack):
+            self.deadlines.pop()
+
+    def step(self, value=None, error=None):
+        '''
+        Runs the coroutines until one of them waits.
+        '''
+        if self.pending is not None:
+            value, error, self.pending = None, self.pending, None
+        while self.stack:
+            coroutine = self.stack[-1]
+            try:
+                if error is not None:
+                    request = coroutine.throw(error)
+                else:
+                    request = coroutine.send(value)
+            except Return as r:
+                value, error = r.value, None
+                self.pop()
+                continue
+            except StopIteration:
+                value, error = None, None
+                self.pop()
+                continue
+            except Exception as e:
+                value, error = None, e
+                self.pop()
+                continue
+            value, error = None, None
+            if isinstance(request, types.GeneratorType):
+                self.stack.append(request)
+            elif isinstance(request, WithTimeout):
+                coroutine, deadline = request, None
+                while isinstance(coroutine, WithTimeout):
+                    if coroutine.timeout is not None:
+                        when = time.time() + coroutine.timeout
+                        deadline = when if deadline is None else min(deadline, when)
+                    coroutine = coroutine.coroutine
+                if isinstance(coroutine, Task):
+                    coroutine = wait_for(coroutine)
+                if isinstance(coroutine, types.GeneratorType):
+                    self.stack.append(coroutine)
+                    if deadline is not None:
+                        self.deadlines.append([len(self.stack), deadline])
+                else:
+                    error = TypeError('with_timeout of %r' % (coroutine,))
+            elif isinstance(request, Wait):
+                self.waiting = request
+                self.loop.waiting[self] = request
+                return
+            elif isinstance(request, Task):
+                wait = Wait(None, 'task')
+                self.waiting = wait
+                self.loop.waiting[self] = wait
+                request.add_done_callback(lambda task: self.wake(wait, task.result, task.error))
+                return
+            else:
+                error = TypeError('coroutine yielded %r' % (request,))
+        self.done = True
+        self.result = value
+        self.error = error
+        for callback in self.callbacks:
+            callback(self)
+
+class EventLoop(object):
+    '''
+    Runs Tasks in the calling thread, waiting on all their sockets at once
+    with select.
+    '''
+    def __init__(self):
+        self.ready = collections.deque()
+        self.waiting = {}
+
+    def spawn(self, coroutine):
+        '''
+        Starts a Task running `coroutine` and returns it.
+        '''
+        task = Task(self, coroutine)
+        self.schedule(task)
+        return task
+
+    def schedule(self, task, value=None, error=None):
+        self.ready.append((task, value, error))
+
+    def run_once(self):
+        '''
+        Runs the ready tasks, then waits for the first socket, timeout or
+        deadline of a waiting task. Returns False if there is nothing left to
+        wait for.
+        '''
+        while self.ready:
+            task, value, error = self.ready.popleft()
+            task.step(value, error)
+        now = time.time()
+        readers = []
+        writers = []
+        timeout = None
+        for task, request in self.waiting.items():
+            if task.waiting is not request:
+                del self.waiting[task]
+                continue
+            if task.deadlines:
+                # an outer deadline may be earlier than the inner ones
+                depth, when = min(task.deadlines, key=lambda deadline: deadline[1])
+                if when <= now:
+                    del self.waiting[task]
+                    task.expire(depth)
+                    continue
+            if request.deadline is not None and request.deadline <= now:
+                task.wake(request, False, None if request.quiet else Timeout('timed out'))
+                continue
+            for deadline in [request.deadline] + [when for depth, when in task.deadlines]:
+                if deadline is not None and (timeout is None or deadline - now < timeout):
+                    timeout = max(deadline - now, 0.0)
+            if request.mode == 'read':
+                readers.append(request.sock)
+            elif request.mode == 'write':
+                writers.append(request.sock)
+        if self.ready:
+            return True
+        if not readers and not writers:
+            if timeout is None:
+                return False
+            time.sleep(timeout)
+            return True
+        readable, writable, exceptional = select.select(readers, writers, [], timeout)
+        ready = set(readable) | set(writable)
+        for task, request in self.waiting.items():
+            if request.sock in ready and task.waiting is request:
+                task.wake(request, True)
+        return True
+
+    def run_until_complete(self, coroutine):
+        '''
+        Runs the loop until `coroutine` (or a Task) is done and returns its
+        value, or raises its error.
+        '''
+        task = coroutine if isinstance(coroutine, Task) else self.spawn(coroutine)
+        while not task.done:
+            if not self.run_once() and not task.done:
+                raise RuntimeError('no task can make progress.')
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+class AsyncLeCroyScope(object):
+    '''
+    The coroutine counterpart of lecroy.LeCroyScope, speaking the same VICP
+    framing on a non-blocking socket. Every method is a coroutine to be
+    yielded from a Task. `timeout` bounds each wait on the socket; use
+    with_timeout to bound a whole call. A call that is cancelled or times
+    out in the middle of a reply leaves the rest of the reply queued, so
+    `clear` should be yielded before the next query.
+    '''
+    def __init__(self, host, port=1861, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.header = bytearray(8)
+        self.buffer = bytearray(recv_buffer_size)
+        self.wavedesc_cache = {}
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        err = sock.connect_ex((self.host, self.port))
+        if err and err not in would_block:
+            raise socket.error(err, os.strerror(err))
+        yield Wait(sock, 'write', self.timeout)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+        self.sock = sock
+        yield self.clear()
+        yield self.send('comm_header short')
+        yield self.check_last_command()
+        yield self.send('comm_format DEF9,BYTE,BIN')
+        yield self.check_last_command()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def clear(self, timeout=0.5):
+        '''
+        Clear any bytes in the oscilloscope's output queue by receiving
+        packets until the connection is idle for more than `timeout` seconds.
+        '''
+        while True:
+            readable = yield Wait(self.sock, 'read', timeout, quiet=True)
+            if not readable:
+                return
+            if not self.sock.recv(4096):
+                raise socket.error('connection closed by scope')
+
+    def send(self, msg):
+        '''
+        Format and send the string `msg`.
+        '''
+        if not msg.endswith('\n'):
+            msg += '\n'
+        data = memoryview(struct.pack(headerformat, 129, 1, 1, 0, len(msg)) + msg)
+        pos = 0
+        while pos < len(data):
+            try:
+                pos += self.sock.send(data[pos:])
+            except socket.error as e:
+                if e.errno not in would_block:
+                    raise
+                yield Wait(self.sock, 'write', self.timeout)
+
+    def recv_exactly(self, view):
+        '''
+        Fills the memoryview `view` from the socket.
+        '''
+        pos = 0
+        while pos < len(view):
+            try:
+                nbytes = self.sock.recv_into(view[pos:], len(view) - pos)
+            except socket.error as e:
+                if e.errno not in would_block:
+                    raise
+                yield Wait(self.sock, 'read', self.timeout)
+                continue
+            if nbytes == 0:
+                raise socket.error('connection closed by scope')
+            pos += nbytes
+
+    def recv_into_buffer(self):
+        '''
+        Receive a message from the scope into the reusable receive buffer and
+        return a memoryview of it, valid until the next message is received.
+        '''
+        length = 0
+        while True:
+            yield self.recv_exactly(memoryview(self.header))
+            operation, headerver, seqnum, spare, totalbytes = \
+                struct.unpack_from(headerformat, self.header)
+            if length + totalbytes > len(self.buffer):
+                grown = bytearray(max(2*len(self.buffer), length + totalbytes))
+                grown[:length] = self.buffer[:length]
+                self.buffer = grown
+            yield self.recv_exactly(memoryview(self.buffer)[length:length+totalbytes])
+            length += totalbytes
+            if operation % 2:
+                break
+        raise Return(memoryview(self.buffer)[:length])
+
+    def recv(self):
+        '''
+        Return a message from the scope.
+        '''
+        msg = yield self.recv_into_buffer()
+        raise Return(msg.tobytes())
+
+    def check_last_command(self):
+        '''
+        Check that the last command sent was received okay; if not, raise
+        an exception with details about the error.
+        '''
+        yield self.send('cmr?')
+        reply = yield self.recv()
+        err = int(reply.split(' ')[-1].rstrip('\n'))
+        if err in errors:
+            raise Exception(errors[err])
+
+    def last_command_failed(self, reply):
+        '''
+        Returns True if `reply` to a `cmr?` query reports an error.
+        '''
+        try:
+            return int(reply.split(' ')[-1].rstrip('\n')) in errors
+        except ValueError:
+            return True
+
+    def query_batch(self, commands):
+        '''
+        Sends the queries for `commands` as one message followed by one
+        `cmr?` and returns the list of replies, like LeCroyScope.query_batch.
+        '''
+        yield self.send(';'.join(command + '?' for command in commands) + ';cmr?')
+        reply = yield self.recv()
+        replies = [part.strip() for part in reply.strip().split(';')]
+        if len(replies) == len(commands) + 1 and not self.last_command_failed(replies[-1]):
+            raise Return(replies[:-1])
+        replies = []
+        for command in commands:
+            yield self.send(command + '?')
+            reply = yield self.recv()
+            replies.append(reply.strip())
+            yield self.check_last_command()
+        raise Return(replies)
+
+    def send_batch(self, commands):
+        '''
+        Sends `commands` as one message followed by one `cmr?`, like
+        LeCroyScope.send_batch.
+        '''
+        yield self.send(';'.join(commands) + ';cmr?')
+        reply = yield self.recv()
+        if not self.last_command_failed(reply.strip()):
+            return
+        for command in commands:
+            yield self.send(command)
+            yield self.check_last_command()
+
+    def get_settings(self):
+        '''
+        Captures the current settings of the scope as a dict of Command->Setting.
+        '''
+        settings = {}
+        for i in range(0, len(setting_commands), batch_size):
+            commands = setting_commands[i:i+batch_size]
+            replies = yield self.query_batch(commands)
+            settings.update(zip(commands, replies))
+        raise Return(settings)
+
+    def set_settings(self, settings):
+        '''
+        Sends a `settings` dict of Command->Setting to the scope, in the
+        order of lecroy.ordered_settings.
+        '''
+        settings = ordered_settings(settings)
+        for i in range(0, len(settings), batch_size):
+            yield self.send_batch(settings[i:i+batch_size])
+
+    def get_channels(self):
+        '''
+        Returns a list of the active channels on the scope.
+        '''
+        replies = yield self.query_batch(['c%i:trace' % i for i in range(1, 5)])
+        raise Return([i for i, reply in zip(range(1, 5), replies) if 'ON' in reply])
+
+    def trigger(self):
+        '''
+        Arms the oscilloscope and instructs it to wait before processing
+        further commands. The next query completes once it has triggered.
+        '''
+        yield self.send('arm;wait')
+
+    def set_sequence_mode(self, nsequence):
+        '''
+        Sets the scope to use sequence mode for aquisition.
+        '''
+        if nsequence == 1:
+            yield self.send('seq off')
+        else:
+            yield self.send('seq on,%i' % nsequence)
+
+    def get_wavedesc(self, channel):
+        '''
+        Requests the wave descriptor for `channel` from the scope. Returns it
+        in dictionary format.
+        '''
+        if channel not in range(1, 5):
+            raise Exception('channel must be in %s.' % str(range(1, 5)))
+        yield self.send('c%i:wf? desc' % channel)
+        msg = yield self.recv()
+        if not int(msg[1]) == channel:
+            raise RuntimeError('waveforms out of sync or comm_header is off.')
+        raise Return(decode_wavedesc(self.wavedesc_cache, channel, msg, msg.index('WAVEDESC')))
+
+    def get_waveform(self, channel, copy=False, trigtime=False):
+        '''
+        Returns a Waveform of the wave descriptor and samples of `channel`
+        from a single `wf? all` transfer, like LeCroyScope.get_waveform.
+        '''
+        if channel not in range(1, 5):
+            raise Exception('channel must be in %s.' % str(range(1, 5)))
+        yield self.send('c%i:wf? all' % channel)
+        msg = yield self.recv_into_buffer()
+        wavedesc, wave_array = decode_waveform(self.wavedesc_cache, channel, self.buffer, len(msg), trigtime)
+        raise Return(Waveform(wavedesc, wave_array.copy() if copy else wave_array))
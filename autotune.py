@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import numpy
+import config
+from lecroy import LeCroyScope
+from stats import Stats
+
+def block_memory(sequence_count, segment_bytes, depth):
+    '''
+    Bytes held by an AcquisitionPipeline of `depth` for acquisitions of
+    `sequence_count` segments of `segment_bytes` (all channels): the queued
+    blocks, the one being read and the one being processed.
+    '''
+    return (depth + 2)*sequence_count*segment_bytes
+
+def trial(scope, channels, sequence_count, repeats):
+    '''
+    Times `repeats` acquisitions of `sequence_count` segments. Returns the
+    sequence count the scope actually used, the median seconds per
+    acquisition, the bytes per segment of all channels and the seconds
+    spent in transfers per byte.
+    '''
+    scope.set_sequence_mode(sequence_count)
+    setting = scope.get_settings()['SEQUENCE']
+    used = int(setting.split(',')[1]) if 'ON' in setting else 1
+    stats = Stats(interval=float('inf'))
+    scope.stats = stats
+    elapsed = []
+    nbytes = 0
+    try:
+        for n in range(repeats):
+            start = time.time()
+            scope.trigger()
+            nbytes = 0
+            for channel in channels:
+                wave_desc, wave_array = scope.get_waveform(channel)
+                nbytes += wave_array.nbytes
+            elapsed.append(time.time() - start)
+    finally:
+        scope.stats = None
+    transfer = stats.summary()['stages']['transfer']
+    return used, float(numpy.median(elapsed)), nbytes//used, transfer['seconds']/max(transfer['bytes'], 1)
+
+def tune(scope, channels, memory=512e6, depth=4, max_sequence=10000, repeats=3, time_limit=5.0):
+    '''
+    Chooses the sequence count of the highest event rate whose pipeline
+    buffers fit in `memory` bytes. Acquisitions of 1, 2, 4, ... segments are
+    timed until the memory or `max_sequence` is reached, the scope refuses
+    the sequence count, or a trial takes more than `time_limit` seconds.
+    The time per acquisition is modelled as
+
+        T(S) = overhead + S*(trigger + segment_bytes*per_byte)
+
+    with per_byte measured from the transfers and the per acquisition
+    overhead and per segment trigger time fitted to the trials. Returns the
+    chosen sequence count and the model as a dict.
+    '''
+    trials = []
+    sequence_count = 1
+    while sequence_count <= max_sequence:
+        start = time.time()
+        used, seconds, segment_bytes, per_byte = trial(scope, channels, sequence_count, repeats)
+        trials.append((used, seconds, segment_bytes, per_byte))
+        print 'sequence count %6i: %9.3f ms per acquisition, %10.1f events/s' % (used, seconds*1e3, used/seconds)
+        if used != sequence_count or time.time() - start > time_limit:
+            break
+        if block_memory(2*sequence_count, segment_bytes, depth) > memory:
+            break
+        sequence_count *= 2
+    counts = numpy.array([t[0] for t in trials], dtype=numpy.float64)
+    seconds = numpy.array([t[1] for t in trials])
+    segment_bytes = trials[-1][2]
+    per_byte = numpy.median([t[3] for t in trials])
+    # the transfers are measured, the rest is fitted as overhead + S*trigger
+    rest = seconds - counts*segment_bytes*per_byte
+    if len(trials) > 1:
+        trigger, overhead = numpy.polyfit(counts, rest, 1)
+    else:
+        trigger, overhead = 0.0, rest[0]
+    overhead = max(overhead, 0.0)
+    trigger = max(trigger, 0.0)
+    model = { 'overhead' : overhead,
+              'trigger' : trigger,
+              'per_byte' : per_byte,
+              'segment_bytes' : segment_bytes,
+              'trials' : [(int(t[0]), t[1]) for t in trials] }
+    # largest sequence count the scope accepted and the memory allows
+    limit = int(counts.max())
+    while limit > 1 and block_memory(limit, segment_bytes, depth) > memory:
+        limit //= 2
+    candidates = numpy.arange(1, limit + 1)
+    rate = candidates/(overhead + candidates*(trigger + segment_bytes*per_byte))
+    best = int(candidates[rate.argmax()])
+    # prefer a measured count if the model overestimates the larger ones
+    measured = dict((int(c), c/s) for c, s in zip(counts, seconds) if c <= limit)
+    if measured:
+        count = max(measured, key=measured.get)
+        if measured[count] > rate[best-1]:
+            best = count
+    model['rate'] = float(best/(overhead + best*(trigger + segment_bytes*per_byte)))
+    model['sequence_count'] = best
+    return best, model
+
+def format_model(model):
+    lines = ['overhead %.3f ms per acquisition, trigger %.3f ms per segment, transfer %.1f MB/s for %i bytes per segment' %
+             (model['overhead']*1e3, model['trigger']*1e3, 1e-6/model['per_byte'] if model['per_byte'] > 0 else float('inf'), model['segment_bytes']),
+             'chose sequence count %i for a predicted %.1f events/s' % (model['sequence_count'], model['rate'])]
+    return '\n'.join(lines)
+
+def tune_scope(memory=512e6, depth=4, max_sequence=10000):
+    '''
+    Connects to the scope of `config`, tunes the sequence count for its
+    active channels and prints the model. Returns the sequence count.
+    '''
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
+    try:
+        channels = scope.get_channels()
+        best, model = tune(scope, channels, memory, depth, max_sequence)
+        print format_model(model)
+        return best
+    finally:
+        scope.resync()
+        scope.sock.close()
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog [--memory] [--depth] [--max]"
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("--memory", type="float", dest="memory",
+                      help="memory budget of the acquisition buffers in MB", default=512)
+    parser.add_option("--depth", type="int", dest="depth",
+                      help="number of acquisitions buffered by the fetch pipeline", default=4)
+    parser.add_option("--max", type="int", dest="max_sequence",
+                      help="largest sequence count to try", default=10000)
+    (options, args) = parser.parse_args()
+
+    tune_scope(options.memory*1e6, options.depth, options.max_sequence)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import platform
+import tempfile
+import numpy
+import config
+import lecroy
+from lecroy import LeCroyScope
+from simulator import SimulatedScope, SimulatorServer, build_wavedesc
+from writers import HDF5Writer, RawWriter, BlockCompressor
+from cruncher import Cruncher
+
+class Quiet(object):
+    '''
+    Silences stdout, i.e. the progress output of the fetch loops.
+    '''
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def best_of(func, repeat=3):
+    '''
+    Returns the shortest of `repeat` timings of `func()` in seconds.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return max(best, 1e-9)
+
+def bench_recv(port, channels, sequence_count, record_length, transfers=10):
+    '''
+    Throughput of LeCroyScope.recv for waveform transfers.
+    '''
+    scope = LeCroyScope('127.0.0.1', port, timeout=60.0)
+    scope.set_sequence_mode(sequence_count)
+    scope.trigger()
+    def run():
+        for n in range(transfers):
+            for channel in channels:
+                scope.send('c%i:wf? dat1' % channel)
+                scope.recv_into_buffer()
+    elapsed = best_of(run)
+    nbytes = transfers*len(channels)*sequence_count*record_length
+    scope.sock.close()
+    return [('recv', nbytes/elapsed/1e6, 'MB/s')]
+
+def bench_wavedesc(port, sequence_count, record_length, count=20000):
+    '''
+    Rate of full and cached wave descriptor decoding.
+    '''
+    raw = build_wavedesc({ 'descriptor_name' : 'WAVEDESC', 'comm_order' : 1, 'wave_descriptor' : lecroy.wavedesclength, 'wave_array_count' : sequence_count*record_length, 'subarray_count' : sequence_count })
+    parser = lecroy.wavedesc_parsers['<']
+    full = best_of(lambda: [parser.parse(raw) for n in xrange(count)])
+    scope = LeCroyScope('127.0.0.1', port, timeout=60.0)
+    cached = best_of(lambda: [scope.decode_wavedesc(1, raw) for n in xrange(count)])
+    scope.sock.close()
+    return [('wavedesc_parse', count/full, 'desc/s'), ('wavedesc_cached', count/cached, 'desc/s')]
+
+def make_block(channels, sequence_count, record_length):
+    traces = numpy.random.normal(0, 2, size=(sequence_count, record_length)).astype(numpy.int8)
+    wave_desc = { 'wave_array_count' : traces.size, 'dtype' : numpy.int8(), 'vertical_offset' : 0.0, 'vertical_gain' : 0.002, 'horiz_offset' : -2.5e-7, 'horiz_interval' : 1e-9 }
+    return wave_desc, dict((channel, (wave_desc, traces)) for channel in channels)
+
+def bench_writers(tmpdir, channels, sequence_count, record_length, nevents=20000):
+    '''
+    Throughput of the HDF5 and raw writers with and without compression.
+    '''
+    wave_desc, block = make_block(channels, sequence_count, record_length)
+    nblocks = max(1, nevents//sequence_count)
+    nevents = nblocks*sequence_count
+    nbytes = nevents*record_length*len(channels)
+    results = []
+    for compression in ('gzip', 'none'):
+        def run():
+            writer = HDF5Writer(os.path.join(tmpdir, 'bench.h5'), nevents, sequence_count, {}, dict((channel, wave_desc) for channel in channels), compression=compression)
+            for n in xrange(nblocks):
+                writer.write(n*sequence_count, block)
+            writer.close()
+        results.append(('hdf5_%s' % compression, nbytes/best_of(run, 1)/1e6, 'MB/s'))
+    def run():
+        writers = [RawWriter(os.path.join(tmpdir, 'bench.ch%i.traces' % channel), {}, wave_desc) for channel in channels]
+        for n in xrange(nblocks):
+            for writer, channel in zip(writers, channels):
+                writer.write(n*sequence_count, wave_desc, block[channel][1])
+        for writer in writers:
+            writer.close()
+    results.append(('raw', nbytes/best_of(run, 1)/1e6, 'MB/s'))
+    def run():
+        compressor = BlockCompressor('zlib', 1)
+        writers = [RawWriter(os.path.join(tmpdir, 'bench.ch%i.traces' % channel), {}, wave_desc, compressor) for channel in channels]
+        for n in xrange(nblocks):
+            for writer, channel in zip(writers, channels):
+                writer.write(n*sequence_count, wave_desc, block[channel][1])
+        for writer in writers:
+            writer.close()
+        compressor.close()
+    results.append(('raw_zlib', nbytes/best_of(run, 1)/1e6, 'MB/s'))
+    return results
+
+def bench_crunch(channels, sequence_count, record_length, nevents=20000):
+    '''
+    Rate of crunching with the default pedestal and window statistics.
+    '''
+    wave_desc, block = make_block(channels, sequence_count, record_length)
+    cruncher = Cruncher(0, record_length//4, record_length//4, record_length, 50.0)
+    nblocks = max(1, nevents//sequence_count)
+    def run():
+        for n in xrange(nblocks):
+            for channel in channels:
+                cruncher.crunch(block[channel][1], wave_desc)
+    return [('crunch', nblocks*sequence_count/best_of(run), 'events/s')]
+
+def bench_fetch(tmpdir, port, sequence_count, record_length, nevents=2000):
+    '''
+    End to end event rate of fetch, fetch_fast and fetch_and_crunch against
+    the simulator, including connecting to it.
+    '''
+    import fetch
+    import fetch_fast
+    import fetch_and_crunch
+    nevents = max(1, nevents//sequence_count)*sequence_count
+    ip, port0, timeout = config.ip, config.port, config.timeout
+    config.ip, config.port, config.timeout = '127.0.0.1', port, 60.0
+    results = []
+    try:
+        prefix = os.path.join(tmpdir, 'bench')
+        for name, run in (('fetch', lambda: fetch.fetch(prefix + '.h5', nevents, sequence_count)),
+                          ('fetch_fast', lambda: fetch_fast.fetch(prefix, nevents, sequence_count)),
+                          ('fetch_and_crunch', lambda: fetch_and_crunch.crunch(prefix, nevents, sequence_count, 0, record_length//4, record_length//4, record_length, 50.0))):
+            with Quiet():
+                elapsed = best_of(run, 1)
+            results.append((name, nevents/elapsed, 'events/s'))
+    finally:
+        config.ip, config.port, config.timeout = ip, port0, timeout
+    return results
+
+def run(lengths, sequences, channel_counts, suites):
+    '''
+    Runs the `suites` over the sweep and returns the results as a list of
+    dicts with the benchmark name, its parameters, value and unit.
+    '''
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='lecrunch-bench')
+    try:
+        for record_length in lengths:
+            for nchannels in channel_counts:
+                channels = range(1, nchannels+1)
+                scope = SimulatedScope(record_length, channels, trigger_rate=1e6, trigger_latency=0.0, seed=0)
+                server = SimulatorServer(scope, port=0).start()
+                try:
+                    for sequence_count in sequences:
+                        params = { 'record_length' : record_length, 'sequence_count' : sequence_count, 'channels' : nchannels }
+                        found = []
+                        if 'recv' in suites:
+                            found += bench_recv(server.port, channels, sequence_count, record_length)
+                        if 'wavedesc' in suites and nchannels == channel_counts[0]:
+                            found += bench_wavedesc(server.port, sequence_count, record_length)
+                        if 'writers' in suites:
+                            found += bench_writers(tmpdir, channels, sequence_count, record_length)
+                        if 'crunch' in suites:
+                            found += bench_crunch(channels, sequence_count, record_length)
+                        if 'fetch' in suites:
+                            found += bench_fetch(tmpdir, server.port, sequence_count, record_length)
+                        for name, value, unit in found:
+                            print '%-18s L=%-6i S=%-5i C=%i  %12.1f %s' % (name, record_length, sequence_count, nchannels, value, unit)
+                            results.append({ 'name' : name, 'params' : params, 'value' : value, 'unit' : unit })
+                finally:
+                    server.stop()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+def key(result):
+    return (result['name'], tuple(sorted(result['params'].items())))
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints the ratio of each result to the matching baseline result and
+    returns the number of results slower than the baseline by more than
+    `tolerance` (a fraction).
+    '''
+    reference = dict((key(result), result) for result in baseline['results'])
+    regressions = 0
+    for result in results:
+        base = reference.get(key(result))
+        if base is None or base['value'] <= 0:
+            continue
+        ratio = result['value']/base['value']
+        flag = ''
+        if ratio < 1.0 - tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        params = result['params']
+        print '%-18s L=%-6i S=%-5i C=%i  %6.2fx baseline%s' % (result['name'], params['record_length'], params['sequence_count'], params['channels'], ratio, flag)
+    return regressions
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog [-o results.json] [--baseline baseline.json] [-l] [-s] [-c] [--suite]"
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("-o", type="string", dest="output",
+                      help="file to save the results to as JSON", default=None)
+    parser.add_option("--baseline", type="string", dest="baseline",
+                      help="JSON results to compare against", default=None)
+    parser.add_option("--tolerance", type="float", dest="tolerance",
+                      help="fractional slowdown reported as a regression", default=0.1)
+    parser.add_option("-l", type="string", dest="lengths",
+                      help="comma separated record lengths to sweep", default='1000,10000')
+    parser.add_option("-s", type="string", dest="sequences",
+                      help="comma separated sequence counts to sweep", default='1,100')
+    parser.add_option("-c", type="string", dest="channels",
+                      help="comma separated channel counts to sweep", default='1,2')
+    parser.add_option("--suite", type="string", dest="suites",
+                      help="comma separated benchmarks to run", default='recv,wavedesc,writers,crunch,fetch')
+    (options, args) = parser.parse_args()
+
+    lengths = [int(value) for value in options.lengths.split(',')]
+    sequences = [int(value) for value in options.sequences.split(',')]
+    channel_counts = [int(value) for value in options.channels.split(',')]
+    suites = options.suites.split(',')
+
+    results = run(lengths, sequences, channel_counts, suites)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({ 'time' : time.asctime(), 'host' : socket.gethostname(), 'python' : platform.python_version(), 'numpy' : numpy.__version__, 'results' : results }, f, indent=1)
+    if options.baseline:
+        with open(options.baseline) as f:
+            if compare(results, json.load(f), options.tolerance):
+                sys.exit(1)
@@ -1,2 +1,6 @@
 ip = '131.243.31.120'
+port = 1861
 timeout = 1000.0
+
+# oscilloscopes sharing a trigger for fetch_multi.py, as (ip, port)
+scopes = [(ip, port)]
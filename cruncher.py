@@ -0,0 +1,215 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+from lecroy import sample_timing, to_volts
+
+def sample_range(start, end, wave_desc):
+    '''
+    Returns the (start, end) indices into transferred samples of the record
+    points `start` to `end`, given the `first_point` and `sparsing_factor`
+    of the waveform setup in `wave_desc`.
+    '''
+    first = wave_desc.get('first_point', 0)
+    sparsing = max(wave_desc.get('sparsing_factor', 1), 1)
+    return (max(start - first + sparsing - 1, 0)//sparsing,
+            max(end - first + sparsing - 1, 0)//sparsing)
+
+class Extractor(object):
+    '''
+    A feature computed by a Cruncher for every segment of a sequence block.
+    Subclasses define `extract(traces, wave_desc, baseline, load)`, which
+    returns an array of shape (sequence_count, columns). The window `start`
+    to `end` is given in points of the full record, so it stays the same
+    when only part of the record is transferred.
+    '''
+    columns = 1
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.scratch = None
+
+    def volts(self, traces, wave_desc):
+        '''
+        Converts the window of `traces` to volts in a reusable scratch array.
+        '''
+        start, end = sample_range(self.start, self.end, wave_desc)
+        raw = traces[:,start:end]
+        if self.scratch is None or self.scratch.shape != raw.shape:
+            self.scratch = numpy.empty(raw.shape, dtype=numpy.float64)
+        return to_volts(raw, wave_desc['vertical_gain'], wave_desc['vertical_offset'], out=self.scratch)
+
+class WindowStats(Extractor):
+    '''
+    Length, charge, minimum, maximum and standard deviation of a window, as
+    computed by fetch_and_crunch.py for the pedestal and signal windows. The
+    mean voltage of each segment is kept in `mean` after `extract`.
+    '''
+    columns = 5
+
+    def extract(self, traces, wave_desc, baseline, load):
+        volts = self.volts(traces, wave_desc)
+        tinc = wave_desc['horiz_interval']
+        first, interval = sample_timing(wave_desc)
+        n = volts.shape[1]
+        values = numpy.empty((volts.shape[0], 5), dtype=numpy.float64)
+        values[:,0] = (self.end - self.start + 1.0)*tinc
+        total = volts.sum(axis=1)
+        values[:,1] = total*interval/load
+        volts.min(axis=1, out=values[:,2])
+        volts.max(axis=1, out=values[:,3])
+        self.mean = total/n
+        values[:,4] = numpy.sqrt(numpy.maximum(numpy.einsum('ij,ij->i', volts, volts)/n - self.mean*self.mean, 0.0))
+        return values
+
+class Charge(Extractor):
+    '''
+    Baseline subtracted charge in a window.
+    '''
+    columns = 1
+
+    def extract(self, traces, wave_desc, baseline, load):
+        volts = self.volts(traces, wave_desc)
+        first, interval = sample_timing(wave_desc)
+        return ((volts.sum(axis=1) - baseline*volts.shape[1])*interval/load)[:,numpy.newaxis]
+
+class Peak(Extractor):
+    '''
+    Baseline subtracted amplitude and time of the largest excursion with the
+    given `polarity` in a window.
+    '''
+    columns = 2
+
+    def __init__(self, start, end, polarity=-1):
+        Extractor.__init__(self, start, end)
+        self.polarity = polarity
+
+    def extract(self, traces, wave_desc, baseline, load):
+        volts = self.volts(traces, wave_desc)
+        volts -= baseline[:,numpy.newaxis]
+        if self.polarity < 0:
+            volts *= -1
+        index = volts.argmax(axis=1)
+        values = numpy.empty((volts.shape[0], 2), dtype=numpy.float64)
+        values[:,0] = self.polarity*volts[numpy.arange(len(index)),index]
+        first, interval = sample_timing(wave_desc)
+        start, end = sample_range(self.start, self.end, wave_desc)
+        values[:,1] = first + (start + index)*interval
+        return values
+
+class CFD(Extractor):
+    '''
+    Constant fraction time: the linearly interpolated time where the
+    baseline subtracted pulse with the given `polarity` first crosses
+    `fraction` of its peak amplitude in a window. NaN if there is no pulse.
+    '''
+    columns = 1
+
+    def __init__(self, start, end, fraction=0.2, polarity=-1):
+        Extractor.__init__(self, start, end)
+        self.fraction = fraction
+        self.polarity = polarity
+
+    def extract(self, traces, wave_desc, baseline, load):
+        volts = self.volts(traces, wave_desc)
+        volts -= baseline[:,numpy.newaxis]
+        if self.polarity < 0:
+            volts *= -1
+        rows = numpy.arange(volts.shape[0])
+        threshold = self.fraction*volts.max(axis=1)
+        index = numpy.maximum((volts >= threshold[:,numpy.newaxis]).argmax(axis=1), 1)
+        before = volts[rows,index-1]
+        after = volts[rows,index]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            frac = numpy.where(after > before, (threshold - before)/(after - before), 0.0)
+        first, interval = sample_timing(wave_desc)
+        start, end = sample_range(self.start, self.end, wave_desc)
+        times = first + (start + index - 1 + frac)*interval
+        times[threshold <= 0] = numpy.nan
+        return times[:,numpy.newaxis]
+
+# extractors selectable by name from the command line
+extractors = { 'stats'  : WindowStats,
+               'charge' : Charge,
+               'peak'   : Peak,
+               'cfd'    : CFD }
+
+def parse_extractor(spec):
+    '''
+    Builds an extractor from a `spec` of 'name,start,end[,args...]', for
+    example 'charge,2500,3000' or 'cfd,2500,10000,0.2'.
+    '''
+    fields = spec.split(',')
+    if fields[0] not in extractors or len(fields) < 3:
+        raise Exception('bad feature %s, expected one of %s followed by start,end.' % (spec, ','.join(sorted(extractors))))
+    args = [int(fields[1]), int(fields[2])] + [float(arg) for arg in fields[3:]]
+    return extractors[fields[0]](*args)
+
+class Cruncher(object):
+    '''
+    Computes the pedestal and window statistics of fetch_and_crunch.py, and
+    any registered extra features, for a whole (sequence_count, num_samples)
+    block at once with axis-wise numpy reductions. Each segment gives one
+    row of 10 values, followed by the columns of the extra extractors.
+    '''
+    def __init__(self, ped_start, ped_end, win_start, win_end, load):
+        self.load = load
+        self.pedestal = WindowStats(ped_start, ped_end)
+        self.extractors = [self.pedestal, WindowStats(win_start, win_end)]
+
+    def register(self, extractor):
+        '''
+        Adds an `extractor` whose columns are appended to each row.
+        '''
+        self.extractors.append(extractor)
+
+    def record_range(self):
+        '''
+        Returns the (first, end) points of the record used by any extractor,
+        i.e. the part of the record that has to be transferred.
+        '''
+        return (min(extractor.start for extractor in self.extractors),
+                max(extractor.end for extractor in self.extractors))
+
+    @property
+    def columns(self):
+        return sum(extractor.columns for extractor in self.extractors)
+
+    def crunch(self, traces, wave_desc):
+        '''
+        Returns the crunched values of all segments of `traces` as an array of
+        shape (sequence_count, columns). The `wave_desc` values may also be
+        per segment arrays, with the vertical gain and offset of shape
+        (sequence_count, 1) so they broadcast against the samples. The per
+        segment 'horiz_offsets' of the trigger time array are used if present.
+        '''
+        if 'horiz_offsets' in wave_desc:
+            wave_desc = dict(wave_desc, horiz_offset=wave_desc['horiz_offsets'])
+        values = numpy.empty((traces.shape[0], self.columns), dtype=numpy.float64)
+        ped = self.pedestal.extract(traces, wave_desc, None, self.load)
+        values[:,:5] = ped
+        baseline = self.pedestal.mean
+        column = 5
+        for extractor in self.extractors[1:]:
+            values[:,column:column+extractor.columns] = extractor.extract(traces, wave_desc, baseline, self.load)
+            column += extractor.columns
+        return values
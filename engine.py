@@ -0,0 +1,175 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from pipeline import AcquisitionPipeline
+from rotation import RotatingWriter, rotated_name
+from writers import HDF5Writer, RawFileSet
+
+class AcquisitionEngine(object):
+    '''
+    The acquisition loop shared by the fetch scripts. Configures sequence
+    mode and, if any of `first`, `points` or `sparsing` is given, the part
+    of each segment to transfer on `scope`, then sends every transferred
+    block to all registered sinks in the same run. Each sink is a pipeline
+    Stage of its own that gets the block by reference, so no sink copies
+    what another one needs and the time of each sink is accounted
+    separately in the summary and in `stats`.
+    '''
+    def __init__(self, scope, nsequence, depth=4, stats=None, first=0, points=0, sparsing=1):
+        self.scope = scope
+        scope.set_sequence_mode(nsequence)
+        self.channels = scope.get_channels()
+        self.settings = scope.get_settings()
+
+        if 'ON' in self.settings['SEQUENCE']:
+            self.sequence_count = int(self.settings['SEQUENCE'].split(',')[1])
+        else:
+            self.sequence_count = 1
+
+        if nsequence != self.sequence_count:
+            print 'Could not configure sequence mode properly'
+        if self.sequence_count != 1:
+            print 'Using sequence mode with %i traces per aquisition' % self.sequence_count
+
+        self.setup = None
+        if (first, points, sparsing) != (0, 0, 1):
+            self.setup = scope.get_waveform_setup()
+            scope.set_waveform_setup(first, points, sparsing)
+            print 'Transferring %s points from point %i with sparsing %i' % (points if points else 'all', first, sparsing)
+
+        self.wave_descs = dict((channel, scope.get_wavedesc(channel)) for channel in self.channels)
+        self.pipeline = AcquisitionPipeline(scope, self.channels, self.sequence_count, depth, stats)
+        self.closers = []
+
+    def add_sink(self, name, process, outputs=(), close=None, summary=None):
+        '''
+        Adds a stage calling `process(i, block)` for every block, or for
+        what the stages of `outputs` pass on. `close` is called once the
+        run is over and `summary` for a line to print after it.
+        '''
+        stage = self.pipeline.add_stage(name, process, outputs)
+        self.at_close(close, summary)
+        return stage
+
+    def at_close(self, close=None, summary=None):
+        '''
+        Registers `close` to be called once the run is over, after those
+        registered before it, and `summary` for a line to print.
+        '''
+        self.closers.append((close, summary))
+
+    def add_writers(self, writers, suppressor=None):
+        '''
+        Adds a sink for each (name, writer) of `writers`, all fed by a single
+        suppress.ZeroSuppressor stage if `suppressor` is given, whose
+        settings and counters are stored in every file.
+        '''
+        stages = []
+        for name, writer in writers:
+            if suppressor is not None:
+                writer.update_info(suppressor.info())
+            def close(writer=writer):
+                if suppressor is not None:
+                    writer.update_info(suppressor.info())
+                writer.close()
+            stages.append(self.add_sink(name, writer.write, close=close))
+        if suppressor is not None:
+            self.add_sink('suppress', suppressor.process, outputs=stages, summary=suppressor.summary)
+        return stages
+
+    def run(self, nevents):
+        '''
+        Acquires `nevents` events, then closes the sinks and restores the
+        waveform setup. Returns the number of events acquired.
+        '''
+        try:
+            self.pipeline.run(nevents)
+        except KeyboardInterrupt:
+            print '\rUser interrupted fetch early'
+        except Exception as e:
+            print "\rUnexpected error:", e
+        finally:
+            self.close()
+        return self.pipeline.count
+
+    def close(self):
+        print '\r',
+        for close, summary in self.closers:
+            if close is not None:
+                close()
+        self.scope.resync()
+        if self.setup is not None:
+            self.scope.set_waveform_setup(self.setup['first'], self.setup['number'], self.setup['sparsing'], self.setup['segment'])
+        print self.pipeline.summary()
+        for close, summary in self.closers:
+            if summary is not None:
+                print summary()
+
+def hdf5_writer(engine, filename, nevents, block_events=1024, compression='gzip', level=None, shuffle=False, max_events=0, max_bytes=0, max_seconds=0):
+    '''
+    Returns an HDF5Writer for the run of `engine`, or with any of
+    `max_events`, `max_bytes` or `max_seconds` a RotatingWriter of numbered
+    HDF5 files listed in `filename`.catalog, e.g. run.h5.catalog.
+    '''
+    if max_events or max_bytes or max_seconds:
+        base, ext = os.path.splitext(filename)
+        open_file = lambda index, first: HDF5Writer(rotated_name(base, index, ext), nevents - first, engine.sequence_count, engine.settings, engine.wave_descs, block_events, compression, level, shuffle)
+        return RotatingWriter(open_file, filename + '.catalog', engine.settings, max_events, max_bytes, max_seconds)
+    return HDF5Writer(filename, nevents, engine.sequence_count, engine.settings, engine.wave_descs, block_events, compression, level, shuffle)
+
+def raw_writer(engine, prefix, compressor=None, max_events=0, max_bytes=0, max_seconds=0):
+    '''
+    Returns a RawFileSet for the run of `engine`, or with any of
+    `max_events`, `max_bytes` or `max_seconds` a RotatingWriter of numbered
+    sets listed in `prefix`.traces.catalog.
+    '''
+    if max_events or max_bytes or max_seconds:
+        open_file = lambda index, first: RawFileSet(rotated_name(prefix, index), engine.settings, engine.wave_descs, compressor)
+        return RotatingWriter(open_file, prefix + '.traces.catalog', engine.settings, max_events, max_bytes, max_seconds)
+    return RawFileSet(prefix, engine.settings, engine.wave_descs, compressor)
+
+class CrunchFiles(object):
+    '''
+    The <prefix>.chN.crunch files of fetch_and_crunch.py, holding the rows
+    of float64 values of `cruncher` for every segment. `crunch` computes the
+    values of a block and `write` appends them, so that they can run as two
+    stages.
+    '''
+    def __init__(self, prefix, channels, cruncher):
+        self.channels = channels
+        self.cruncher = cruncher
+        self.f = dict((channel, open('%s.ch%s.crunch' % (prefix, channel), 'wb')) for channel in channels)
+
+    def crunch(self, i, block):
+        values = {}
+        for channel in self.channels:
+            wave_desc, traces = block[channel]
+            values[channel] = self.cruncher.crunch(traces, wave_desc)
+        return (i, values)
+
+    def write(self, i, values):
+        for channel in self.channels:
+            values[channel].tofile(self.f[channel])
+
+    def close(self):
+        for f in self.f.values():
+            f.close()
@@ -30,83 +30,24 @@ import h5py
 import numpy
 import config
 from lecroy import LeCroyScope
+from stats import Stats
+from autotune import tune_scope
+from suppress import ZeroSuppressor
+from engine import AcquisitionEngine, hdf5_writer
 
-def fetch(filename, nevents, nsequence):
+def fetch(filename, nevents, nsequence, depth=4, block_events=1024, compression='gzip', level=None, shuffle=False, first=0, points=0, sparsing=1, stats=None, suppressor=None, max_events=0, max_bytes=0, max_seconds=0):
     '''
-    Fetch and save waveform traces from the oscilloscope.
+    Fetch and save waveform traces from the oscilloscope. With a
+    suppress.ZeroSuppressor as `suppressor`, only the segments it keeps are
+    written and its counters are stored in the file attributes. With any of
+    `max_events`, `max_bytes` or `max_seconds`, the run is split into
+    numbered files listed in <filename>.catalog, see rotation.RotatingWriter.
     '''
-    scope = LeCroyScope(config.ip, timeout=config.timeout)
-    scope.clear()
-    scope.set_sequence_mode(nsequence)
-    channels = scope.get_channels()
-    settings = scope.get_settings()
-
-    if 'ON' in settings['SEQUENCE']:
-        sequence_count = int(settings['SEQUENCE'].split(',')[1])
-    else:
-        sequence_count = 1
-        
-    if nsequence != sequence_count:
-        print 'Could not configure sequence mode properly'
-    if sequence_count != 1:
-        print 'Using sequence mode with %i traces per aquisition' % sequence_count 
-    
-    f = h5py.File(filename, 'w')
-    for command, setting in settings.items():
-        f.attrs[command] = setting
-    current_dim = {}
-    for channel in channels:
-        wave_desc = scope.get_wavedesc(channel)
-        current_dim[channel] = wave_desc['wave_array_count']//sequence_count
-        f.create_dataset("c%i_samples"%channel, (nevents,current_dim[channel]), dtype=wave_desc['dtype'], compression='gzip', maxshape=(nevents,None))
-        for key, value in wave_desc.items():
-            try:
-                f["c%i_samples"%channel].attrs[key] = value
-            except ValueError:
-                pass
-        f.create_dataset("c%i_vert_offset"%channel, (nevents,), dtype='f8')
-        f.create_dataset("c%i_vert_scale"%channel, (nevents,), dtype='f8')
-        f.create_dataset("c%i_horiz_offset"%channel, (nevents,), dtype='f8')
-        f.create_dataset("c%i_horiz_scale"%channel, (nevents,), dtype='f8')
-        f.create_dataset("c%i_num_samples"%channel, (nevents,), dtype='f8')
-        
-    try:
-        i = 0
-        while i < nevents:
-            print '\rfetching event: %i' % i,
-            sys.stdout.flush()
-            try:
-                scope.trigger()
-                for channel in channels:
-                    wave_desc,wave_array = scope.get_waveform(channel)
-                    num_samples = wave_desc['wave_array_count']//sequence_count
-                    if current_dim[channel] < num_samples:
-                        current_dim[channel] = num_samples
-                        f['c%i_samples'%channel].resize(current_dim[channel],1)
-                    traces = wave_array.reshape(sequence_count, wave_array.size//sequence_count)
-                    #necessary because h5py does not like indexing and this is the fastest (and man is it slow) way
-                    scratch = numpy.zeros((current_dim[channel],),dtype=wave_array.dtype)
-                    for n in xrange(0,sequence_count):
-                        scratch[0:num_samples] = traces[n] #'fast' copy to right size
-                        f['c%i_samples'%channel][i+n] = scratch #'fast' add to dataset
-                        f['c%i_num_samples'%channel][i+n] = num_samples
-                        f['c%i_vert_offset'%channel][i+n] = wave_desc['vertical_offset']
-                        f['c%i_vert_scale'%channel][i+n] = wave_desc['vertical_gain']
-                        f['c%i_horiz_offset'%channel][i+n] = -wave_desc['horiz_offset']
-                        f['c%i_horiz_scale'%channel][i+n] = wave_desc['horiz_interval']
-                    
-            except (socket.error, struct.error) as e:
-                print '\n' + str(e)
-                scope.clear()
-                continue
-            i += sequence_count
-    except KeyboardInterrupt:
-        print '\rUser interrupted fetch early'
-    finally:
-        print '\r', 
-        f.close()
-        scope.clear()
-        return i
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
+    engine = AcquisitionEngine(scope, nsequence, depth, stats, first, points, sparsing)
+    writer = hdf5_writer(engine, filename, nevents, block_events, compression, level, shuffle, max_events, max_bytes, max_seconds)
+    engine.add_writers([('writer', writer)], suppressor)
+    return engine.run(nevents)
 
 if __name__ == '__main__':
     import optparse
@@ -117,6 +58,50 @@ if __name__ == '__main__':
                       help="number of events to capture in total", default=1000)
     parser.add_option("-s", type="int", dest="nsequence",
                       help="number of sequential events to capture at a time", default=1)
+    parser.add_option("--tune", action="store_true", dest="tune",
+                      help="measure the scope and choose the sequence count instead of -s", default=False)
+    parser.add_option("--memory", type="float", dest="memory",
+                      help="memory budget of the acquisition buffers in MB when tuning", default=512)
+    parser.add_option("--depth", type="int", dest="depth",
+                      help="number of acquisitions buffered for writing", default=4)
+    parser.add_option("--block", type="int", dest="block_events",
+                      help="number of events written to the file at a time", default=1024)
+    parser.add_option("--compression", type="choice", dest="compression", choices=['gzip', 'lzf', 'none'],
+                      help="compression filter for the samples (gzip, lzf or none)", default='gzip')
+    parser.add_option("--level", type="int", dest="level",
+                      help="gzip compression level", default=None)
+    parser.add_option("--shuffle", action="store_true", dest="shuffle",
+                      help="apply the shuffle filter before compression", default=False)
+    parser.add_option("--first", type="int", dest="first",
+                      help="first point of each segment to transfer", default=0)
+    parser.add_option("--points", type="int", dest="points",
+                      help="number of points of each segment to transfer (0 for all)", default=0)
+    parser.add_option("--sparsing", type="int", dest="sparsing",
+                      help="transfer only every Nth point", default=1)
+    parser.add_option("--suppress", type="choice", dest="suppress", choices=['drop', 'shrink', 'none'],
+                      help="zero suppression of segments below --threshold: drop them, zero their samples (shrink) or none", default='none')
+    parser.add_option("--threshold", type="float", dest="threshold",
+                      help="zero suppression threshold in volts from the pedestal", default=0.01)
+    parser.add_option("--ps", type="int", dest="ps",
+                      help="zero suppression pedestal start index", default=0)
+    parser.add_option("--pe", type="int", dest="pe",
+                      help="zero suppression pedestal end index", default=2500)
+    parser.add_option("--ws", type="int", dest="ws",
+                      help="zero suppression window start index", default=2500)
+    parser.add_option("--we", type="int", dest="we",
+                      help="zero suppression window end index", default=10000)
+    parser.add_option("--rotate-events", type="int", dest="rotate_events",
+                      help="start a new file after this many events (0 for no limit)", default=0)
+    parser.add_option("--rotate-mb", type="float", dest="rotate_mb",
+                      help="start a new file after this many MB of samples (0 for no limit)", default=0)
+    parser.add_option("--rotate-seconds", type="float", dest="rotate_seconds",
+                      help="start a new file after this many seconds (0 for no limit)", default=0)
+    parser.add_option("--stats", type="float", dest="stats",
+                      help="seconds between timing summaries (0 for none)", default=0)
+    parser.add_option("--stats-file", type="string", dest="stats_file",
+                      help="file to write the timing stats to", default=None)
+    parser.add_option("--stats-format", type="choice", dest="stats_format", choices=['jsonl', 'prom'],
+                      help="format of the stats file: JSON lines (jsonl) or Prometheus text (prom)", default='jsonl')
     parser.add_option("--time", action="store_true", dest="time",
                       help="append time string to filename", default=False)
     (options, args) = parser.parse_args()
@@ -126,12 +111,26 @@ if __name__ == '__main__':
     
     if options.nevents < 1 or options.nsequence < 1:
         sys.exit("Arguments to -s or -n must be positive")
+
+    if options.first < 0 or options.points < 0 or options.sparsing < 1:
+        sys.exit("Arguments to --first or --points must not be negative and to --sparsing must be positive")
     
     filename = args[0] + '_' + string.replace(time.asctime(time.localtime()), ' ', '-') + '.h5' if options.time else args[0] + '.h5'
     print 'Saving to file %s' % filename
 
+    if options.tune:
+        options.nsequence = tune_scope(options.memory*1e6, options.depth)
+
+    stats = None
+    if options.stats > 0 or options.stats_file is not None:
+        stats = Stats(options.stats if options.stats > 0 else 10.0, options.stats_file, options.stats_format)
+
+    suppressor = None
+    if options.suppress != 'none':
+        suppressor = ZeroSuppressor(options.ps, options.pe, options.ws, options.we, options.threshold, mode=options.suppress)
+
     start = time.time()
-    count = fetch(filename, options.nevents, options.nsequence)
+    count = fetch(filename, options.nevents, options.nsequence, options.depth, options.block_events, options.compression, options.level, options.shuffle, options.first, options.points, options.sparsing, stats=stats, suppressor=suppressor, max_events=options.rotate_events, max_bytes=options.rotate_mb*1e6, max_seconds=options.rotate_seconds)
     elapsed = time.time() - start
     if count > 0:
         print 'Completed %i events in %.3f seconds.' % (count, elapsed)
@@ -30,69 +30,35 @@ import h5py
 import numpy
 import config
 from lecroy import LeCroyScope
+from stats import Stats
+from autotune import tune_scope
+from cruncher import Cruncher, parse_extractor
+from monitor import Monitor, MonitorServer
+from engine import AcquisitionEngine, CrunchFiles
 
-def crunch(filename, nevents, nsequence, ped_start, ped_end, win_start, win_end, load):
+def crunch(filename, nevents, nsequence, ped_start, ped_end, win_start, win_end, load, depth=4, extractors=(), full_record=False, stats=None, monitor=None):
     '''
-    Fetch and crunch waveform traces from the oscilloscope.
+    Fetch and crunch waveform traces from the oscilloscope. A monitor.Monitor
+    given as `monitor` is fed every block from a stage of its own.
     '''
-    scope = LeCroyScope(config.ip, timeout=config.timeout)
-    scope.clear()
-    scope.set_sequence_mode(nsequence)
-    channels = scope.get_channels()
-    settings = scope.get_settings()
+    cruncher = Cruncher(ped_start, ped_end, win_start, win_end, load)
+    for extractor in extractors:
+        cruncher.register(extractor)
 
-    if 'ON' in settings['SEQUENCE']:
-        sequence_count = int(settings['SEQUENCE'].split(',')[1])
-    else:
-        sequence_count = 1
-        
-    if nsequence != sequence_count:
-        print 'Could not configure sequence mode properly'
-    if sequence_count != 1:
-        print 'Using sequence mode with %i traces per aquisition' % sequence_count 
-    
-    f = {}
-    for channel in channels:
-        f[channel] = open('%s.ch%s.crunch'%(filename,channel),'wb')
-    try:
-        i = 0
-        while i < nevents:
-            print '\rfetching event: %i' % i,
-            sys.stdout.flush()
-            try:
-                scope.trigger()
-                for channel in channels:
-                    wave_desc,wave_array = scope.get_waveform(channel)
-                    num_samples = wave_desc['wave_array_count']//sequence_count
-                    traces = wave_array.reshape(sequence_count, wave_array.size//sequence_count)
-                    offset = wave_desc['vertical_offset']
-                    gain = wave_desc['vertical_gain']
-                    tinc = wave_desc['horiz_interval']
-                    out = f[channel]
-                    for n in xrange(0,sequence_count):
-                        ped = traces[n,ped_start:ped_end]*gain-offset
-                        win = traces[n,win_start:win_end]*gain-offset
-                        values = numpy.asarray([
-                            (ped_end-ped_start+1.0)*tinc, numpy.sum(ped)*tinc/load, numpy.amin(ped), numpy.amax(ped), numpy.std(ped), 
-                            (win_end-win_start+1.0)*tinc, numpy.sum(win)*tinc/load, numpy.amin(win), numpy.amax(win), numpy.std(win)
-                            ],dtype=numpy.float64)
-                        values.tofile(out)
-                    
-            except (socket.error) as e:
-                print '\n' + str(e)
-                scope.clear()
-                continue
-            i += sequence_count
-    except KeyboardInterrupt:
-        print '\rUser interrupted fetch early'
-    except Exception as e:
-        print "\rUnexpected error:", e
-    finally:
-        print '\r', 
-        for channel in channels:
-            f[channel].close()
-        scope.clear()
-        return i
+    # only the points the cruncher looks at are transferred
+    first, points = 0, 0
+    if not full_record:
+        first, end = cruncher.record_range()
+        points = end - first
+
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
+    engine = AcquisitionEngine(scope, nsequence, depth, stats, first, points)
+    files = CrunchFiles(filename, engine.channels, cruncher)
+    writer = engine.add_sink('writer', files.write, close=files.close)
+    engine.add_sink('crunch', files.crunch, outputs=[writer])
+    if monitor is not None:
+        engine.add_sink('monitor', monitor.process, close=monitor.publish)
+    return engine.run(nevents)
 
 if __name__ == '__main__':
     import optparse
@@ -109,10 +75,32 @@ if __name__ == '__main__':
                       help="window end index", default=10000)
     parser.add_option("--load", type="float", dest="load",
                       help="load", default=50)
+    parser.add_option("--feature", action="append", dest="features",
+                      help="extra feature to crunch as name,start,end[,args], e.g. charge,2500,3000 peak,2500,10000 cfd,2500,10000,0.2", default=[])
     parser.add_option("-n", type="int", dest="nevents",
                       help="number of events to capture in total", default=1000)
     parser.add_option("-s", type="int", dest="nsequence",
                       help="number of sequential events to capture at a time", default=1)
+    parser.add_option("--tune", action="store_true", dest="tune",
+                      help="measure the scope and choose the sequence count instead of -s", default=False)
+    parser.add_option("--memory", type="float", dest="memory",
+                      help="memory budget of the acquisition buffers in MB when tuning", default=512)
+    parser.add_option("--depth", type="int", dest="depth",
+                      help="number of acquisitions buffered for crunching and writing", default=4)
+    parser.add_option("--full-record", action="store_true", dest="full_record",
+                      help="transfer whole segments instead of only the crunched points", default=False)
+    parser.add_option("--monitor", type="string", dest="monitor",
+                      help="file to publish live histograms and the average waveform to as JSON", default=None)
+    parser.add_option("--monitor-port", type="int", dest="monitor_port",
+                      help="port to serve the live monitor snapshots on (0 for none)", default=0)
+    parser.add_option("--monitor-interval", type="float", dest="monitor_interval",
+                      help="seconds between live monitor snapshots", default=5.0)
+    parser.add_option("--stats", type="float", dest="stats",
+                      help="seconds between timing summaries (0 for none)", default=0)
+    parser.add_option("--stats-file", type="string", dest="stats_file",
+                      help="file to write the timing stats to", default=None)
+    parser.add_option("--stats-format", type="choice", dest="stats_format", choices=['jsonl', 'prom'],
+                      help="format of the stats file: JSON lines (jsonl) or Prometheus text (prom)", default='jsonl')
     parser.add_option("--time", action="store_true", dest="time",
                       help="append time string to filename", default=False)
     (options, args) = parser.parse_args()
@@ -122,13 +110,35 @@ if __name__ == '__main__':
     
     if options.nevents < 1 or options.nsequence < 1:
         sys.exit("Arguments to -s or -n must be positive")
+
+    try:
+        extractors = [parse_extractor(spec) for spec in options.features]
+    except Exception as e:
+        sys.exit(str(e))
     
     filename = args[0] + '_' + string.replace(time.asctime(time.localtime()), ' ', '-') if options.time else args[0]
     print 'Saving to file %s' % filename
 
+    if options.tune:
+        options.nsequence = tune_scope(options.memory*1e6, options.depth)
+
+    stats = None
+    if options.stats > 0 or options.stats_file is not None:
+        stats = Stats(options.stats if options.stats > 0 else 10.0, options.stats_file, options.stats_format)
+
+    monitor = None
+    server = None
+    if options.monitor is not None or options.monitor_port:
+        monitor = Monitor(options.ps, options.pe, options.ws, options.we, options.load, interval=options.monitor_interval, filename=options.monitor)
+        if options.monitor_port:
+            server = MonitorServer(monitor, port=options.monitor_port).start()
+            print 'Serving live monitor snapshots on port %i' % server.port
+
     start = time.time()
-    count = crunch(filename, options.nevents, options.nsequence, options.ps, options.pe, options.ws, options.we, options.load)
+    count = crunch(filename, options.nevents, options.nsequence, options.ps, options.pe, options.ws, options.we, options.load, options.depth, extractors, options.full_record, stats=stats, monitor=monitor)
     elapsed = time.time() - start
+    if server is not None:
+        server.stop()
     if count > 0:
         print 'Completed %i events in %.3f seconds.' % (count, elapsed)
         print 'Averaged %.5f seconds per acquisition.' % (elapsed/count)
@@ -30,62 +30,32 @@ import h5py
 import numpy
 import config
 from lecroy import LeCroyScope
+from stats import Stats
+from autotune import tune_scope
+from suppress import ZeroSuppressor
+from writers import BlockCompressor
+from engine import AcquisitionEngine, raw_writer
 
-def fetch(filename, nevents, nsequence):
+def fetch(filename, nevents, nsequence, depth=4, first=0, points=0, sparsing=1, stats=None, compression='none', level=None, workers=2, suppressor=None, max_events=0, max_bytes=0, max_seconds=0):
     '''
-    Fetch and save waveform traces from the oscilloscope.
+    Fetch and save waveform traces from the oscilloscope. With a
+    `compression` of zlib or bz2, the blocks are compressed by `workers`
+    threads. With a suppress.ZeroSuppressor as `suppressor`, only the
+    segments it keeps are written and its counters are stored in the file
+    headers. With any of `max_events`, `max_bytes` or `max_seconds`, the
+    run is split into numbered files listed in <filename>.traces.catalog,
+    see rotation.RotatingWriter.
     '''
-    scope = LeCroyScope(config.ip, timeout=config.timeout)
-    scope.clear()
-    scope.set_sequence_mode(nsequence)
-    channels = scope.get_channels()
-    settings = scope.get_settings()
-
-    if 'ON' in settings['SEQUENCE']:
-        sequence_count = int(settings['SEQUENCE'].split(',')[1])
-    else:
-        sequence_count = 1
-        
-    if nsequence != sequence_count:
-        print 'Could not configure sequence mode properly'
-    if sequence_count != 1:
-        print 'Using sequence mode with %i traces per aquisition' % sequence_count 
-    
-    f = {}
-    for channel in channels:
-        f[channel] = open('%s.ch%s.traces'%(filename,channel),'wb')
-    params_pattern = '=IBdddd' # (num_samples, sample_bytes, v_off, v_scale, h_off, h_scale, [samples]) ...
-    try:
-        i = 0
-        while i < nevents:
-            print '\rfetching event: %i' % i,
-            sys.stdout.flush()
-            try:
-                scope.trigger()
-                for channel in channels:
-                    wave_desc,wave_array = scope.get_waveform(channel)
-                    num_samples = wave_desc['wave_array_count']//sequence_count
-                    traces = wave_array.reshape(sequence_count, wave_array.size//sequence_count)
-                    out = f[channel]
-                    for n in xrange(0,sequence_count):
-                        out.write(struct.pack(params_pattern,num_samples,wave_desc['dtype'].itemsize,wave_desc['vertical_offset'], wave_desc['vertical_gain'], -wave_desc['horiz_offset'], wave_desc['horiz_interval']))
-                        traces[n].tofile(out)
-                    
-            except (socket.error) as e:
-                print '\n' + str(e)
-                scope.clear()
-                continue
-            i += sequence_count
-    except KeyboardInterrupt:
-        print '\rUser interrupted fetch early'
-    except Exception as e:
-        print "\rUnexpected error:", e
-    finally:
-        print '\r', 
-        for channel in channels:
-            f[channel].close()
-        scope.clear()
-        return i
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
+    engine = AcquisitionEngine(scope, nsequence, depth, stats, first, points, sparsing)
+    compressor = None
+    if compression != 'none':
+        compressor = BlockCompressor(compression, level, workers, stats)
+    writer = raw_writer(engine, filename, compressor, max_events, max_bytes, max_seconds)
+    engine.add_writers([('writer', writer)], suppressor)
+    if compressor is not None:
+        engine.at_close(compressor.close, compressor.summary)
+    return engine.run(nevents)
 
 if __name__ == '__main__':
     import optparse
@@ -96,6 +66,48 @@ if __name__ == '__main__':
                       help="number of events to capture in total", default=1000)
     parser.add_option("-s", type="int", dest="nsequence",
                       help="number of sequential events to capture at a time", default=1)
+    parser.add_option("--tune", action="store_true", dest="tune",
+                      help="measure the scope and choose the sequence count instead of -s", default=False)
+    parser.add_option("--memory", type="float", dest="memory",
+                      help="memory budget of the acquisition buffers in MB when tuning", default=512)
+    parser.add_option("--depth", type="int", dest="depth",
+                      help="number of acquisitions buffered for writing", default=4)
+    parser.add_option("--first", type="int", dest="first",
+                      help="first point of each segment to transfer", default=0)
+    parser.add_option("--points", type="int", dest="points",
+                      help="number of points of each segment to transfer (0 for all)", default=0)
+    parser.add_option("--sparsing", type="int", dest="sparsing",
+                      help="transfer only every Nth point", default=1)
+    parser.add_option("--compression", type="choice", dest="compression", choices=['zlib', 'bz2', 'none'],
+                      help="compression of each block (zlib, bz2 or none)", default='none')
+    parser.add_option("--level", type="int", dest="level",
+                      help="compression level (default 6 for zlib, 9 for bz2)", default=None)
+    parser.add_option("--workers", type="int", dest="workers",
+                      help="number of compression threads", default=2)
+    parser.add_option("--suppress", type="choice", dest="suppress", choices=['drop', 'shrink', 'none'],
+                      help="zero suppression of segments below --threshold: drop them, zero their samples (shrink) or none", default='none')
+    parser.add_option("--threshold", type="float", dest="threshold",
+                      help="zero suppression threshold in volts from the pedestal", default=0.01)
+    parser.add_option("--ps", type="int", dest="ps",
+                      help="zero suppression pedestal start index", default=0)
+    parser.add_option("--pe", type="int", dest="pe",
+                      help="zero suppression pedestal end index", default=2500)
+    parser.add_option("--ws", type="int", dest="ws",
+                      help="zero suppression window start index", default=2500)
+    parser.add_option("--we", type="int", dest="we",
+                      help="zero suppression window end index", default=10000)
+    parser.add_option("--rotate-events", type="int", dest="rotate_events",
+                      help="start a new file after this many events (0 for no limit)", default=0)
+    parser.add_option("--rotate-mb", type="float", dest="rotate_mb",
+                      help="start a new file after this many MB of samples (0 for no limit)", default=0)
+    parser.add_option("--rotate-seconds", type="float", dest="rotate_seconds",
+                      help="start a new file after this many seconds (0 for no limit)", default=0)
+    parser.add_option("--stats", type="float", dest="stats",
+                      help="seconds between timing summaries (0 for none)", default=0)
+    parser.add_option("--stats-file", type="string", dest="stats_file",
+                      help="file to write the timing stats to", default=None)
+    parser.add_option("--stats-format", type="choice", dest="stats_format", choices=['jsonl', 'prom'],
+                      help="format of the stats file: JSON lines (jsonl) or Prometheus text (prom)", default='jsonl')
     parser.add_option("--time", action="store_true", dest="time",
                       help="append time string to filename", default=False)
     (options, args) = parser.parse_args()
@@ -105,12 +117,26 @@ if __name__ == '__main__':
     
     if options.nevents < 1 or options.nsequence < 1:
         sys.exit("Arguments to -s or -n must be positive")
+
+    if options.first < 0 or options.points < 0 or options.sparsing < 1:
+        sys.exit("Arguments to --first or --points must not be negative and to --sparsing must be positive")
     
     filename = args[0] + '_' + string.replace(time.asctime(time.localtime()), ' ', '-') if options.time else args[0]
     print 'Saving to file %s' % filename
 
+    if options.tune:
+        options.nsequence = tune_scope(options.memory*1e6, options.depth)
+
+    stats = None
+    if options.stats > 0 or options.stats_file is not None:
+        stats = Stats(options.stats if options.stats > 0 else 10.0, options.stats_file, options.stats_format)
+
+    suppressor = None
+    if options.suppress != 'none':
+        suppressor = ZeroSuppressor(options.ps, options.pe, options.ws, options.we, options.threshold, mode=options.suppress)
+
     start = time.time()
-    count = fetch(filename, options.nevents, options.nsequence)
+    count = fetch(filename, options.nevents, options.nsequence, options.depth, options.first, options.points, options.sparsing, stats=stats, compression=options.compression, level=options.level, workers=options.workers, suppressor=suppressor, max_events=options.rotate_events, max_bytes=options.rotate_mb*1e6, max_seconds=options.rotate_seconds)
     elapsed = time.time() - start
     if count > 0:
         print 'Completed %i events in %.3f seconds.' % (count, elapsed)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import string
+import config
+from lecroy import LeCroyScope
+from multiscope import ScopeGroup, MultiScopePipeline
+from stats import Stats
+from writers import HDF5Writer
+
+def fetch(filename, nevents, nsequence, scopes, depth=4, tolerance=1e-6, block_events=1024, compression='gzip', level=None, shuffle=False, stats=None):
+    '''
+    Fetch waveform traces from several oscilloscopes sharing a trigger and
+    save the events seen by all of them to one HDF5 file, with the samples of
+    channel N of scope K in `sK_cN_samples`.
+    '''
+    group = ScopeGroup([LeCroyScope(ip, port, timeout=config.timeout) for ip, port in scopes])
+    group.map(lambda index, scope: scope.set_sequence_mode(nsequence))
+    channels = group.map(lambda index, scope: scope.get_channels())
+    settings = group.map(lambda index, scope: scope.get_settings())
+
+    sequence_counts = []
+    for setting in settings:
+        if 'ON' in setting['SEQUENCE']:
+            sequence_counts.append(int(setting['SEQUENCE'].split(',')[1]))
+        else:
+            sequence_counts.append(1)
+    sequence_count = sequence_counts[0]
+
+    if len(set(sequence_counts)) != 1:
+        group.close()
+        raise Exception('scopes use different sequence counts %s.' % sequence_counts)
+    if nsequence != sequence_count:
+        print 'Could not configure sequence mode properly'
+    if sequence_count != 1:
+        print 'Using sequence mode with %i traces per aquisition' % sequence_count
+
+    try:
+        pipeline = MultiScopePipeline(group, channels, sequence_count, depth, stats, tolerance)
+    except Exception:
+        group.close()
+        raise
+
+    merged = {}
+    wave_descs = {}
+    for k, (ip, port) in enumerate(scopes):
+        merged['S%i:ADDRESS' % k] = '%s:%i' % (ip, port)
+        for command, setting in settings[k].items():
+            merged['S%i:%s' % (k, command)] = setting
+        for channel in channels[k]:
+            wave_descs[(k, channel)] = group.scopes[k].get_wavedesc(channel)
+    writer = HDF5Writer(filename, nevents, sequence_count, merged, wave_descs, block_events, compression, level, shuffle, names='s%i_c%i')
+
+    pipeline.add_stage('writer', writer.write)
+    try:
+        pipeline.run(nevents)
+    except KeyboardInterrupt:
+        print '\rUser interrupted fetch early'
+    finally:
+        print '\r',
+        writer.close()
+        group.resync()
+        group.close()
+        print pipeline.summary()
+        return pipeline.count
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog <filename/prefix> [-n] [-s] [--scope ip[:port]] ..."
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("-n", type="int", dest="nevents",
+                      help="number of events to capture in total", default=1000)
+    parser.add_option("-s", type="int", dest="nsequence",
+                      help="number of sequential events to capture at a time", default=1)
+    parser.add_option("--scope", action="append", dest="scopes",
+                      help="address of a scope as ip[:port], once per scope (default: config.scopes)", default=[])
+    parser.add_option("--tolerance", type="float", dest="tolerance",
+                      help="largest difference in seconds of the trigger times of one event", default=1e-6)
+    parser.add_option("--depth", type="int", dest="depth",
+                      help="number of acquisitions buffered for writing", default=4)
+    parser.add_option("--block", type="int", dest="block_events",
+                      help="number of events written to the file at a time", default=1024)
+    parser.add_option("--compression", type="choice", dest="compression", choices=['gzip', 'lzf', 'none'],
+                      help="compression filter for the samples (gzip, lzf or none)", default='gzip')
+    parser.add_option("--level", type="int", dest="level",
+                      help="gzip compression level", default=None)
+    parser.add_option("--shuffle", action="store_true", dest="shuffle",
+                      help="apply the shuffle filter before compression", default=False)
+    parser.add_option("--stats", type="float", dest="stats",
+                      help="seconds between timing summaries (0 for none)", default=0)
+    parser.add_option("--stats-file", type="string", dest="stats_file",
+                      help="file to write the timing stats to", default=None)
+    parser.add_option("--stats-format", type="choice", dest="stats_format", choices=['jsonl', 'prom'],
+                      help="format of the stats file: JSON lines (jsonl) or Prometheus text (prom)", default='jsonl')
+    parser.add_option("--time", action="store_true", dest="time",
+                      help="append time string to filename", default=False)
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        sys.exit(parser.format_help())
+
+    if options.nevents < 1 or options.nsequence < 1:
+        sys.exit("Arguments to -s or -n must be positive")
+
+    scopes = []
+    for address in options.scopes:
+        ip, _, port = address.partition(':')
+        scopes.append((ip, int(port) if port else config.port))
+    if not scopes:
+        scopes = config.scopes
+
+    filename = args[0] + '_' + string.replace(time.asctime(time.localtime()), ' ', '-') + '.h5' if options.time else args[0] + '.h5'
+    print 'Saving to file %s' % filename
+
+    stats = None
+    if options.stats > 0 or options.stats_file is not None:
+        stats = Stats(options.stats if options.stats > 0 else 10.0, options.stats_file, options.stats_format)
+
+    start = time.time()
+    count = fetch(filename, options.nevents, options.nsequence, scopes, options.depth, options.tolerance, options.block_events, options.compression, options.level, options.shuffle, stats=stats)
+    elapsed = time.time() - start
+    if count > 0:
+        print 'Completed %i events in %.3f seconds.' % (count, elapsed)
+        print 'Averaged %.5f seconds per acquisition.' % (elapsed/count)
@@ -20,12 +20,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import re
 import array
-import StringIO
 import struct
 import numpy as np
 import socket
+import time
+import calendar
 import os
 
 # data types in lecroy binary blocks, where:
@@ -78,6 +78,16 @@ setting_commands = ['TIME_DIV', 'COMM_FORMAT', 'COMM_HEADER', 'COMM_ORDER'] + \
     ['C%i:TRIG_SLOPE' % i for i in range(1,5)] + \
     ['C%i:TRACE' % i for i in range(1,5)]
 
+def ordered_settings(settings):
+    '''
+    Returns the settings of a `settings` dict of Command->Setting in the
+    order to send them: those of `setting_commands` in that order, since
+    some depend on others, then any others.
+    '''
+    commands = [command for command in setting_commands if command in settings]
+    commands += [command for command in settings if command not in setting_commands]
+    return [settings[command] for command in commands]
+
 # byte length of wavedesc block
 wavedesclength = 346
 
@@ -139,9 +149,241 @@ wavedesc_template = ( ('descriptor_name'    , 0   , String),
                       ('vertical_vernier'   , 336 , Float),
                       ('acq_vert_offset'    , 340 , Float),
                       ('wave_source'        , 344 , Enum) )
+
+# wavedesc fields that change from one acquisition to the next without any
+# change of the scope settings
+volatile_fields = ('horiz_offset', 'pixel_offset', 'trigger_time', 'acq_duration')
+
+def packfmt(datatype):
+    '''
+    Returns the struct format string for a lecroy binary block `datatype`.
+    '''
+    if datatype in (String, UnitDefinition):
+        return '%is' % datatype.length
+    return datatype.packfmt
+
+class WaveDescParser(object):
+    '''
+    Decodes wavedesc blocks of one byte order with a single precompiled
+    struct instead of unpacking the template field by field.
+    '''
+    def __init__(self, endian):
+        self.endian = endian
+        self.little_endian = endian == '<'
+        self.struct = struct.Struct(endian + ''.join(packfmt(datatype) for name, pos, datatype in wavedesc_template))
+        if self.struct.size != wavedesclength:
+            raise Exception('wavedesc_template does not match wavedesclength.')
+        # (name, first value index, last value index, is string) for each field
+        self.fields = []
+        index = 0
+        for name, pos, datatype in wavedesc_template:
+            count = len(struct.unpack(endian + packfmt(datatype), '\x00'*datatype.length))
+            self.fields.append((name, index, index + count, datatype in (String, UnitDefinition)))
+            index += count
+        self.volatile = []
+        for name, pos, datatype in wavedesc_template:
+            if name in volatile_fields:
+                self.volatile.append((name, pos, struct.Struct(endian + packfmt(datatype))))
+        # byte ranges of the wavedesc that do not contain volatile fields
+        self.static_ranges = []
+        start = 0
+        for name, pos, fmt in self.volatile:
+            if pos > start:
+                self.static_ranges.append((start, pos))
+            start = pos + fmt.size
+        self.static_ranges.append((start, wavedesclength))
+
+    def static_key(self, raw, offset=0):
+        '''
+        Returns the bytes of the wavedesc at `offset` in `raw` that only change
+        when the scope settings change.
+        '''
+        return ''.join(raw[offset+start:offset+end] for start, end in self.static_ranges)
+
+    def parse(self, raw, offset=0):
+        '''
+        Decodes the wavedesc at `offset` in `raw` into dictionary format.
+        '''
+        values = self.struct.unpack_from(raw, offset)
+        wavedesc = {}
+        for name, first, last, is_string in self.fields:
+            if is_string:
+                wavedesc[name] = values[first].rstrip('\x00')
+            elif last - first > 1:
+                wavedesc[name] = values[first:last]
+            else:
+                wavedesc[name] = values[first]
+        wavedesc['little_endian'] = self.little_endian
+        # determine data type
+        if wavedesc['comm_type'] == 0:
+            wavedesc['dtype'] = np.int8()
+        elif wavedesc['comm_type'] == 1:
+            wavedesc['dtype'] = np.int16()
+        else:
+            raise Exception('unknown comm_type.')
+        return wavedesc
+
+    def update(self, wavedesc, raw, offset=0):
+        '''
+        Returns a copy of `wavedesc` with the volatile fields decoded from the
+        wavedesc at `offset` in `raw`.
+        '''
+        wavedesc = dict(wavedesc)
+        for name, pos, fmt in self.volatile:
+            value = fmt.unpack_from(raw, offset + pos)
+            wavedesc[name] = value if len(value) > 1 else value[0]
+        return wavedesc
+
+wavedesc_parsers = { '<' : WaveDescParser('<'),
+                     '>' : WaveDescParser('>') }
+
+def data_offset(wavedesc):
+    '''
+    Returns the byte offset of the first data array from the start of the
+    wavedesc in a `wf? all` block.
+    '''
+    return wavedesc['wave_descriptor'] + wavedesc['user_text'] + \
+        wavedesc['res_desc1'] + wavedesc['trigtime_array'] + \
+        wavedesc['ris_time_array'] + wavedesc['res_array1']
+
+def timestamp(wavedesc):
+    '''
+    Returns the `trigger_time` of a wavedesc, i.e. the trigger of the first
+    segment by the scope's clock, as seconds since the epoch.
+    '''
+    seconds, minutes, hours, days, months, year, unused = wavedesc['trigger_time']
+    return calendar.timegm((year, months, days, hours, minutes, 0, 0, 0, 0)) + seconds
+
+def sample_timing(wavedesc):
+    '''
+    Returns (time of the first transferred sample relative to the trigger,
+    time between transferred samples) for a wavedesc, honouring the
+    `first_point` and `sparsing_factor` of the waveform setup, if present.
+    '''
+    sparsing = max(wavedesc.get('sparsing_factor', 1), 1)
+    return (wavedesc['horiz_offset'] + wavedesc.get('first_point', 0)*wavedesc['horiz_interval'],
+            sparsing*wavedesc['horiz_interval'])
+
+def time_axis(wavedesc, num_samples):
+    '''
+    Returns the times relative to the trigger of the `num_samples` samples
+    of a segment described by `wavedesc`.
+    '''
+    first, interval = sample_timing(wavedesc)
+    return first + interval*np.arange(num_samples)
+
+def to_volts(samples, gain, offset, out=None, dtype=np.float32):
+    '''
+    Converts raw `samples` to volts as `samples*gain - offset` in a single
+    pass without temporaries. `gain` and `offset` may be scalars or have one
+    value per row of 2D `samples`. The result is written to `out` if given,
+    which sets the output precision, or to a new array of `dtype`.
+    '''
+    if out is None:
+        out = np.empty(samples.shape, dtype=dtype)
+    # the descriptor floats would otherwise make the product double precision
+    np.multiply(samples, np.asarray(gain, dtype=out.dtype), out=out)
+    np.subtract(out, np.asarray(offset, dtype=out.dtype), out=out)
+    return out
+
+class Waveform(tuple):
+    '''
+    The wave descriptor and raw samples of a transfer or of events read from
+    a file, kept as the digitized integers. Unpacks as a (wave_desc,
+    samples) tuple, and converts to volts and gives the time axis only when
+    asked. The descriptor fields may hold one value per row
+    of 2D samples, as for events read from files.
+    '''
+    def __new__(cls, wave_desc, samples):
+        return tuple.__new__(cls, (wave_desc, samples))
+
+    @property
+    def wave_desc(self):
+        return self[0]
+
+    @property
+    def samples(self):
+        return self[1]
+
+    def volts(self, out=None, dtype=np.float32):
+        '''
+        Returns the samples in volts, see to_volts. Pass `out` to reuse an
+        array, e.g. one of the same shape for every block of a file.
+        '''
+        return to_volts(self.samples, self.wave_desc['vertical_gain'], self.wave_desc['vertical_offset'], out, dtype)
+
+    def times(self):
+        '''
+        Returns the time relative to the trigger of every sample along the
+        last axis, with one row per segment if the horizontal offset differs
+        per segment.
+        '''
+        first, interval = sample_timing(self.wave_desc)
+        if 'horiz_offsets' in self.wave_desc and self.samples.ndim == 2:
+            first = first - self.wave_desc['horiz_offset'] + self.wave_desc['horiz_offsets'][:len(self.samples)]
+        index = np.arange(self.samples.shape[-1])
+        if np.ndim(first) or np.ndim(interval):
+            return np.reshape(first, (-1, 1)) + np.reshape(interval, (-1, 1))*index
+        return first + interval*index
+
+def decode_wavedesc(cache, channel, raw, offset=0):
+    '''
+    Decodes the wavedesc at `offset` in `raw` for `channel`. The full decode
+    is kept in the dict `cache` per channel and only redone when a field
+    other than the `volatile_fields` changes, i.e. when the settings change.
+    '''
+    # comm_order reads as zero in either byte order for big endian data
+    if raw[offset+34:offset+36] == '\x00\x00':
+        parser = wavedesc_parsers['>']
+    else:
+        parser = wavedesc_parsers['<']
+    key = parser.static_key(raw, offset)
+    cached = cache.get(channel)
+    if cached is not None and cached[0] == key:
+        return parser.update(cached[1], raw, offset)
+    wavedesc = parser.parse(raw, offset)
+    cache[channel] = (key, wavedesc)
+    return dict(wavedesc)
+
+def decode_waveform(cache, channel, buffer, length, trigtime=False):
+    '''
+    Decodes the `cN:wf? all` reply for `channel` held in the first `length`
+    bytes of `buffer`. Returns the wavedesc and a numpy array of the samples
+    sharing memory with `buffer`. With `trigtime` set, the trigger time
+    array is decoded into the wavedesc as the arrays 'trigger_times'
+    (seconds since the trigger of the first segment) and 'horiz_offsets'
+    (the horiz_offset of each segment).
+    '''
+    raw = str(buffer[:min(length, wavedesclength+64)])
+    if not int(raw[1:2]) == channel:
+        raise RuntimeError('waveforms out of sync or comm_header is off.')
+    startpos = raw.index('WAVEDESC')
+    wavedesc = decode_wavedesc(cache, channel, raw, startpos)
+    dtype = np.dtype(wavedesc['dtype'])
+    if not wavedesc['little_endian']:
+        dtype = dtype.newbyteorder('>')
+    offset = startpos + data_offset(wavedesc)
+    wave_array = np.frombuffer(buffer, dtype, wavedesc['wave_array_count'], offset)
+    if trigtime:
+        count = wavedesc['trigtime_array']//16
+        if count:
+            offset = startpos + wavedesc['wave_descriptor'] + wavedesc['user_text'] + wavedesc['res_desc1']
+            times = np.frombuffer(buffer, '<f8' if wavedesc['little_endian'] else '>f8', 2*count, offset).reshape(count, 2)
+            wavedesc['trigger_times'] = times[:,0].astype(np.float64)
+            wavedesc['horiz_offsets'] = times[:,1].astype(np.float64)
+        else:
+            wavedesc['trigger_times'] = np.zeros(1)
+            wavedesc['horiz_offsets'] = np.array([wavedesc['horiz_offset']])
+    return wavedesc, wave_array
                       
 headerformat = '>BBBBL'
 
+# initial size of the reusable receive buffer, grown on demand
+recv_buffer_size = 1 << 20
+
+# number of commands joined into one message when querying or sending settings
+batch_size = 16
+
 errors = { 1  : 'unrecognized command/query header',
            2  : 'illegal header path',
            3  : 'illegal number',
@@ -157,12 +399,33 @@ errors = { 1  : 'unrecognized command/query header',
 class LeCroyScope(object):
     '''
     A class for triggering and fetching waveforms from a LeCroy oscilloscope.
+    If `stats` is set to a stats.Stats, the time waiting for triggers and
+    replies, transferring, decoding descriptors and copying is recorded.
     '''
     def __init__(self,  host, port=1861, timeout=5.0):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # commands like 'arm;wait' get no reply, so without this the next
+        # query waits for a delayed ack
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.connect((host, port))
         self.sock.settimeout(timeout)
-        self.clear()
+        self.header = bytearray(8)
+        self.buffer = bytearray(recv_buffer_size)
+        self.wavedesc_cache = {}
+        self.stats = None
+        self.armed = False
+        # sequence number of the last message sent, echoed by the scope in
+        # the headers of its reply. Old firmware always replies with 1, so
+        # the numbers used by sync start at 2.
+        self.seqnum = 1
+        self.sequencing = False
+        # progress through the header being received and bytes of an
+        # interrupted frame that are still to be discarded
+        self.header_pos = 0
+        self.skip = 0
+        self.desynced = False
+        self.stale = 0
+        self.sync()
         self.send('comm_header short')
         self.check_last_command()
         self.send('comm_format DEF9,BYTE,BIN')
@@ -184,34 +447,141 @@ class LeCroyScope(object):
         except socket.timeout:
             pass
         self.sock.settimeout(t)
+        self.header_pos = 0
+        self.skip = 0
+        self.desynced = False
+
+    def sync(self):
+        '''
+        Finds out whether the scope echoes the sequence numbers of the
+        messages it replies to by sending a `cmr?` query. If the first reply
+        does not carry the query's sequence number, it may have been left over
+        from an earlier connection, so the output queue is cleared and the
+        query repeated before giving up on sequence numbers.
+        '''
+        for attempt in range(2):
+            self.send('cmr?')
+            try:
+                seqnum, length = self.recv_message()
+            except socket.error:
+                self.desynced = True
+                seqnum = None
+            if seqnum == self.seqnum:
+                self.sequencing = True
+                return
+            if attempt == 0 or self.desynced:
+                self.clear()
+        self.sequencing = False
+
+    def resync(self):
+        '''
+        Recovers from an interrupted exchange, e.g. after a timeout. If the
+        scope echoes sequence numbers, replies to abandoned queries are
+        discarded by the next recv as they arrive, along with what is left of
+        an interrupted frame, so there is nothing to wait for. Otherwise, or
+        if a header could not be parsed, the output queue is cleared.
+        '''
+        if self.desynced or not self.sequencing:
+            self.clear()
 
     def send(self, msg):
         '''
-        Format and send the string `msg`.
+        Format and send the string `msg` with the next sequence number.
         '''
         if not msg.endswith('\n'):
             msg += '\n'
-        header = struct.pack(headerformat, 129, 1, 1, 0, len(msg))
+        self.seqnum = self.seqnum % 255 + 1
+        header = struct.pack(headerformat, 129, 1, self.seqnum, 0, len(msg))
         self.sock.sendall(header + msg)
 
-    def recv(self):
+    def discard(self):
         '''
-        Return a message from the scope.
+        Receives and drops the `skip` bytes left of an interrupted or stale
+        frame.
+        '''
+        view = memoryview(self.buffer)
+        while self.skip > 0:
+            nbytes = self.sock.recv_into(view, min(self.skip, len(view)))
+            if nbytes == 0:
+                raise socket.error('connection closed by scope')
+            self.skip -= nbytes
+
+    def recv_message(self):
         '''
-        reply = ''
+        Receives the next message from the scope into the reusable receive
+        buffer, whatever query it answers. Returns its sequence number and
+        length. A timeout leaves the connection where it was, so that the
+        next call carries on or skips the rest of the interrupted frame.
+        '''
+        header = memoryview(self.header)
+        length = 0
+        first = self.stats is not None
+        if first:
+            start = time.time()
+        if self.skip:
+            self.discard()
         while True:
-            header = ''
-            while len(header) < 8:
-                header += self.sock.recv(8 - len(header))
+            while self.header_pos < 8:
+                nbytes = self.sock.recv_into(header[self.header_pos:], 8 - self.header_pos)
+                if nbytes == 0:
+                    raise socket.error('connection closed by scope')
+                self.header_pos += nbytes
+            self.header_pos = 0
+            if first:
+                # time to the first byte: waiting for the trigger after an
+                # arm, otherwise the scope's reply latency
+                first = False
+                now = time.time()
+                self.stats.record('trigger' if self.armed else 'latency', now - start)
+                self.armed = False
+                start = now
             operation, headerver, seqnum, spare, totalbytes = \
-                struct.unpack(headerformat, header)
-            buffer = ''
-            while len(buffer) < totalbytes:
-                buffer += self.sock.recv(totalbytes - len(buffer))
-            reply += buffer
+                struct.unpack_from(headerformat, self.header)
+            if not operation & 0x80:
+                self.desynced = True
+                raise socket.error('invalid VICP header, out of sync with the scope')
+            if length + totalbytes > len(self.buffer):
+                # never resize in place: arrays handed out earlier may still
+                # reference the old buffer
+                grown = bytearray(max(2*len(self.buffer), length + totalbytes))
+                grown[:length] = self.buffer[:length]
+                self.buffer = grown
+            view = memoryview(self.buffer)
+            end = length + totalbytes
+            try:
+                while length < end:
+                    nbytes = self.sock.recv_into(view[length:end], end - length)
+                    if nbytes == 0:
+                        raise socket.error('connection closed by scope')
+                    length += nbytes
+            except socket.error:
+                self.skip = end - length
+                raise
             if operation % 2:
                 break
-        return reply
+        if self.stats is not None:
+            self.stats.record('transfer', time.time() - start, length)
+        return seqnum, length
+
+    def recv_into_buffer(self):
+        '''
+        Receive the reply to the last message sent directly into the reusable
+        receive buffer and return a memoryview of it. The view (and any array
+        built on top of it) is only valid until the next call to a recv
+        method. If the scope echoes sequence numbers, replies to earlier
+        queries that were abandoned are dropped.
+        '''
+        while True:
+            seqnum, length = self.recv_message()
+            if not self.sequencing or seqnum == self.seqnum:
+                return memoryview(self.buffer)[:length]
+            self.stale += 1
+
+    def recv(self):
+        '''
+        Return a message from the scope.
+        '''
+        return self.recv_into_buffer().tobytes()
 
     def check_last_command(self):
         """
@@ -225,25 +595,95 @@ class LeCroyScope(object):
             self.sock.close()
             raise Exception(errors[err])
         
+    def last_command_failed(self, reply):
+        '''
+        Returns True if `reply` to a `cmr?` query reports an error.
+        '''
+        try:
+            return int(reply.split(' ')[-1].rstrip('\n')) in errors
+        except ValueError:
+            return True
+
+    def query_batch(self, commands):
+        '''
+        Sends the queries for `commands` as a single message followed by one
+        `cmr?` check and returns the list of replies. Only if the batch
+        reports an error is each query repeated and checked on its own, which
+        raises an exception for the failing command.
+        '''
+        self.send(';'.join(command + '?' for command in commands) + ';cmr?')
+        replies = [reply.strip() for reply in self.recv().strip().split(';')]
+        if len(replies) == len(commands) + 1 and not self.last_command_failed(replies[-1]):
+            return replies[:-1]
+        replies = []
+        for command in commands:
+            self.send(command + '?')
+            replies.append(self.recv().strip())
+            self.check_last_command()
+        return replies
+
+    def send_batch(self, commands):
+        '''
+        Sends `commands` as a single message followed by one `cmr?` check.
+        Only if the batch reports an error is each command resent and checked
+        on its own, which raises an exception for the failing command.
+        '''
+        self.send(';'.join(commands) + ';cmr?')
+        if not self.last_command_failed(self.recv().strip()):
+            return
+        for command in commands:
+            self.send(command)
+            self.check_last_command()
+
     def get_settings(self):
         '''
         Captures the current settings of the scope as a dict of Command->Setting.
         '''
         settings = {}
-        for command in setting_commands:
-            self.send(command + '?')
-            settings[command] = self.recv().strip()
-            self.check_last_command()
+        for i in range(0, len(setting_commands), batch_size):
+            commands = setting_commands[i:i+batch_size]
+            settings.update(zip(commands, self.query_batch(commands)))
         return settings
 
     def set_settings(self, settings):
         '''
-        Sends a `settings` dict of Command->Setting to the scope.
+        Sends a `settings` dict of Command->Setting to the scope, checking
+        each batch of commands, in the order of ordered_settings.
         '''
-        for command, setting in settings.items():
-            print 'sending %s' % command
-            self.send(setting)
-            self.check_last_command()
+        settings = ordered_settings(settings)
+        for i in range(0, len(settings), batch_size):
+            self.send_batch(settings[i:i+batch_size])
+
+    def restore_settings(self, settings):
+        '''
+        Brings the scope to a `settings` dict of Command->Setting as returned
+        by `get_settings`. Only the settings that differ from the current
+        ones are sent, in batches without checks, followed by a single `cmr?`
+        check and a read back of the changed settings. COMM_HEADER is left
+        alone, as replies are parsed expecting `comm_header short`. Returns
+        a dict of Command->(wanted, actual) of the settings the scope did not
+        take as given, e.g. because it rounded them.
+        '''
+        current = self.get_settings()
+        changed = [command for command in setting_commands
+                   if command in settings and command != 'COMM_HEADER' and settings[command] != current[command]]
+        if not changed:
+            return {}
+        for i in range(0, len(changed), batch_size):
+            self.send(';'.join(settings[command] for command in changed[i:i+batch_size]))
+        self.send('cmr?')
+        if self.last_command_failed(self.recv().strip()):
+            # find and report the failing command
+            for command in changed:
+                self.send(settings[command])
+                self.check_last_command()
+        differ = {}
+        for i in range(0, len(changed), batch_size):
+            commands = changed[i:i+batch_size]
+            for command, setting in zip(commands, self.query_batch(commands)):
+                if setting != settings[command]:
+                    differ[command] = (settings[command], setting)
+        return differ
 
     def get_channels(self):
         '''
@@ -256,12 +696,32 @@ class LeCroyScope(object):
                 channels.append(i)
         return channels
 
+    def get_waveform_setup(self):
+        '''
+        Returns the waveform setup of the scope as a dict with the keys
+        'sparsing', 'number', 'first' and 'segment'.
+        '''
+        self.send('wfsu?')
+        fields = self.recv().strip().split(' ')[-1].split(',')
+        names = { 'SP' : 'sparsing', 'NP' : 'number', 'FP' : 'first', 'SN' : 'segment' }
+        return dict((names[key], int(value)) for key, value in zip(fields[::2], fields[1::2]) if key in names)
+
+    def set_waveform_setup(self, first=0, number=0, sparsing=1, segment=0):
+        '''
+        Restricts waveform transfers to `number` points (0 for all) of every
+        segment starting at point `first`, sending only every `sparsing`th
+        point. `segment` selects a single segment of a sequence (0 for all).
+        '''
+        self.send('wfsu sp,%i,np,%i,fp,%i,sn,%i' % (sparsing, number, first, segment))
+        self.check_last_command()
+
     def trigger(self):
         '''
         Arms the oscilliscope and instructs it to wait before processing
         further commands, i.e. nonblocking.
         '''
         self.send('arm;wait')
+        self.armed = True
         
     def set_sequence_mode(self, nsequence):
         '''
@@ -272,6 +732,13 @@ class LeCroyScope(object):
         else:
             self.send('seq on,%i'%nsequence)
 
+    def decode_wavedesc(self, channel, raw, offset=0):
+        '''
+        Decodes the wavedesc at `offset` in `raw` for `channel`, see
+        decode_wavedesc.
+        '''
+        return decode_wavedesc(self.wavedesc_cache, channel, raw, offset)
+
     def get_wavedesc(self, channel):
         '''
         Requests the wave descriptor for `channel` from the scope. Returns it in
@@ -286,53 +753,31 @@ class LeCroyScope(object):
         if not int(msg[1]) == channel:
             raise RuntimeError('waveforms out of sync or comm_header is off.')
 
-        data = StringIO.StringIO(msg)
-        startpos = re.search('WAVEDESC', data.read()).start()
-
-        wavedesc = {}
-        
-        # check endian
-        data.seek(startpos + 34)
-        if struct.unpack('<'+Enum.packfmt, data.read(Enum.length)) == 0:
-            endian = '>'
-            wavedesc['little_endian'] = True
-            np.little_endian = True
-        else:
-            endian = '<'
-            wavedesc['little_endian'] = False
-            np.little_endian = False
-        data.seek(startpos)
-
-        # build dictionary of wave description
-        for name, pos, datatype in wavedesc_template:
-            raw = data.read(datatype.length)
-            if datatype in (String, UnitDefinition):
-                wavedesc[name] = raw.rstrip('\x00')
-            elif datatype in (TimeStamp,):
-                wavedesc[name] = struct.unpack(endian+datatype.packfmt, raw)
-            else:
-                wavedesc[name] = struct.unpack(endian+datatype.packfmt, raw)[0]
+        return self.decode_wavedesc(channel, msg, msg.index('WAVEDESC'))
 
-        # determine data type
-        if wavedesc['comm_type'] == 0:
-            wavedesc['dtype'] = np.int8()
-        elif wavedesc['comm_type'] == 1:
-            wavedesc['dtype'] = np.int16()
-        else:
-            raise Exception('unknown comm_type.')
-        return wavedesc
-
-    def get_waveform(self, channel):
+    def get_waveform(self, channel, copy=False, trigtime=False):
         '''
-        Capture the raw data for `channel` from the scope and return a tuple
-        containing the wave descriptor and a numpy array of the digitized 
-        scope readout.
+        Capture the raw data for `channel` from the scope and return a
+        Waveform of the wave descriptor and a numpy array of the digitized 
+        scope readout. The descriptor and the data are fetched in a single
+        `wf? all` transfer. Unless `copy` is set, the array shares memory with
+        the receive buffer and is only valid until the next message is
+        received. With `trigtime` set, the trigger time array of the same
+        transfer is decoded into the descriptor, see decode_waveform.
         ''' 
         if channel not in range(1, 5):
             raise Exception('channel must be in %s.' % str(range(1, 5)))
-        self.send('c%s:wf? dat1' % str(channel))
-        msg = self.recv()
-        if not int(msg[1]) == channel:
-            raise RuntimeError('waveforms out of sync or comm_header is off.')
-        wavedesc = self.get_wavedesc(channel)
-        return (wavedesc, np.fromstring(msg[22:], wavedesc['dtype'], wavedesc['wave_array_count']))
+        self.send('c%s:wf? all' % str(channel))
+        msg = self.recv_into_buffer()
+        if self.stats is not None:
+            start = time.time()
+        wavedesc, wave_array = decode_waveform(self.wavedesc_cache, channel, self.buffer, len(msg), trigtime)
+        if self.stats is not None:
+            now = time.time()
+            self.stats.record('wavedesc', now - start)
+            start = now
+        if copy:
+            wave_array = wave_array.copy()
+            if self.stats is not None:
+                self.stats.record('copy', time.time() - start, wave_array.nbytes)
+        return Waveform(wavedesc, wave_array)
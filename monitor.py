@@ -0,0 +1,202 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import threading
+import SocketServer
+import numpy
+from lecroy import sample_timing
+from cruncher import Cruncher, Charge, Peak
+
+class Histogram(object):
+    '''
+    A histogram of `bins` equal bins from `lo` to `hi` with underflow and
+    overflow counts, filled with whole arrays at a time. If no range is
+    given it is set from the first values filled, with half the spread of
+    those values as margin on either side. Non-finite values are ignored.
+    '''
+    def __init__(self, bins=200, lo=None, hi=None):
+        self.bins = bins
+        self.lo = lo
+        self.hi = hi
+        self.counts = numpy.zeros(bins + 2, dtype=numpy.int64)
+        self.total = 0.0
+        self.total2 = 0.0
+
+    def fill(self, values):
+        values = values[numpy.isfinite(values)]
+        if len(values) == 0:
+            return
+        if self.lo is None or self.hi is None:
+            lo, hi = numpy.percentile(values, [0.1, 99.9])
+            span = hi - lo
+            if span <= 0:
+                span = abs(lo) or 1.0
+            self.lo, self.hi = lo - span/2, hi + span/2
+        index = numpy.floor((values - self.lo)*(self.bins/(self.hi - self.lo)))
+        index = numpy.clip(index, -1, self.bins).astype(numpy.intp) + 1
+        self.counts += numpy.bincount(index, minlength=self.bins + 2)
+        self.total += values.sum()
+        self.total2 += numpy.dot(values, values)
+
+    def summary(self):
+        count = int(self.counts.sum())
+        mean = self.total/count if count else 0.0
+        return { 'lo' : self.lo,
+                 'hi' : self.hi,
+                 'counts' : self.counts[1:-1].tolist(),
+                 'underflow' : int(self.counts[0]),
+                 'overflow' : int(self.counts[-1]),
+                 'entries' : count,
+                 'mean' : mean,
+                 'rms' : float(numpy.sqrt(max(self.total2/count - mean*mean, 0.0))) if count else 0.0 }
+
+class Monitor(object):
+    '''
+    Live view of an acquisition in constant memory. For every channel,
+    histograms of the baseline subtracted charge and amplitude in the signal
+    window and of the pedestal RMS are filled from whole sequence blocks,
+    using the pedestal and window definitions of fetch_and_crunch.py, and
+    the average waveform in volts is kept as an exponential moving average
+    over roughly the last `average_events` segments. `ranges` may fix the
+    (lo, hi) range of the 'charge', 'amplitude' and 'pedestal_rms'
+    histograms. Pass `process` to AcquisitionPipeline.add_stage; a snapshot
+    is published every `interval` seconds to `filename`, replaced
+    atomically, and to the clients of a MonitorServer.
+    '''
+    quantities = ('charge', 'amplitude', 'pedestal_rms')
+
+    def __init__(self, ped_start, ped_end, win_start, win_end, load, polarity=-1, bins=200, ranges=None, average_events=1000, interval=5.0, filename=None):
+        self.cruncher = Cruncher(ped_start, ped_end, win_start, win_end, load)
+        self.cruncher.register(Charge(win_start, win_end))
+        self.cruncher.register(Peak(win_start, win_end, polarity))
+        self.polarity = polarity
+        self.bins = bins
+        self.ranges = ranges or {}
+        self.average_events = average_events
+        self.interval = interval
+        self.filename = filename
+        self.histograms = {}
+        self.averages = {}
+        self.timing = {}
+        self.events = 0
+        self.start = time.time()
+        self.last = self.start
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def fill(self, channel, wave_desc, traces):
+        '''
+        Adds the segments of `traces` of `channel` to its histograms and
+        average waveform.
+        '''
+        if channel not in self.histograms:
+            self.histograms[channel] = dict((name, Histogram(self.bins, *self.ranges.get(name, (None, None))))
+                                            for name in self.quantities)
+        values = self.cruncher.crunch(traces, wave_desc)
+        histograms = self.histograms[channel]
+        histograms['pedestal_rms'].fill(values[:,4])
+        histograms['charge'].fill(values[:,10])
+        histograms['amplitude'].fill(self.polarity*values[:,11])
+        # the average of the raw samples is converted to volts once per block
+        mean = traces.mean(axis=0)*wave_desc['vertical_gain'] - wave_desc['vertical_offset']
+        average = self.averages.get(channel)
+        if average is None or average.shape != mean.shape:
+            self.averages[channel] = mean
+        else:
+            weight = min(1.0, float(len(traces))/self.average_events)
+            average *= 1.0 - weight
+            average += weight*mean
+        self.timing[channel] = sample_timing(wave_desc)
+
+    def process(self, i, block):
+        for channel, (wave_desc, traces) in block.items():
+            self.fill(channel, wave_desc, traces)
+        self.events += min(len(traces) for wave_desc, traces in block.values())
+        if time.time() - self.last >= self.interval:
+            self.publish()
+
+    def summary(self):
+        '''
+        Returns the current state as a JSON serializable dict.
+        '''
+        channels = {}
+        for channel in sorted(self.histograms):
+            first, interval = self.timing[channel]
+            channels[str(channel)] = { 'histograms' : dict((name, histogram.summary()) for name, histogram in self.histograms[channel].items()),
+                                       'average' : { 'first' : first, 'interval' : interval, 'volts' : self.averages[channel].tolist() } }
+        now = time.time()
+        return { 'time' : now, 'elapsed' : now - self.start, 'events' : self.events, 'channels' : channels }
+
+    def publish(self):
+        '''
+        Serializes a snapshot for MonitorServer clients and writes it to
+        `filename` if given.
+        '''
+        self.last = time.time()
+        snapshot = json.dumps(self.summary())
+        with self.lock:
+            self.snapshot = snapshot
+        if self.filename is not None:
+            with open(self.filename + '.tmp', 'w') as f:
+                f.write(snapshot)
+            os.rename(self.filename + '.tmp', self.filename)
+
+    def latest(self):
+        with self.lock:
+            return self.snapshot
+
+class SnapshotHandler(SocketServer.BaseRequestHandler):
+    '''
+    Sends the latest snapshot to a client and closes the connection.
+    '''
+    def handle(self):
+        snapshot = self.server.monitor.latest()
+        self.request.sendall((snapshot if snapshot is not None else '{}') + '\n')
+
+class MonitorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''
+    A TCP server at `port` giving the latest snapshot of `monitor` to every
+    client that connects, e.g. `nc localhost 1862`. Port 0 picks a free
+    port, available as `port` afterwards.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, monitor, host='127.0.0.1', port=1862):
+        SocketServer.TCPServer.__init__(self, (host, port), SnapshotHandler)
+        self.monitor = monitor
+        self.port = self.server_address[1]
+
+    def start(self):
+        '''
+        Serves from a background thread.
+        '''
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,217 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import Queue
+import numpy
+from lecroy import timestamp
+from pipeline import AcquisitionPipeline
+
+class ScopeWorker(threading.Thread):
+    '''
+    A thread owning one LeCroyScope that runs the functions it is given on
+    it, so that several scopes wait on their sockets at the same time.
+    '''
+    def __init__(self, index, scope):
+        threading.Thread.__init__(self, name='scope%i' % index)
+        self.daemon = True
+        self.index = index
+        self.scope = scope
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+
+    def run(self):
+        while True:
+            func = self.requests.get()
+            if func is None:
+                break
+            try:
+                self.results.put((func(self.index, self.scope), None))
+            except Exception as e:
+                self.results.put((None, e))
+
+class ScopeGroup(object):
+    '''
+    Drives a list of LeCroyScopes at once with one thread each. Looks like a
+    single scope to AcquisitionPipeline: `trigger` arms all scopes and
+    `resync` resynchronizes all of them.
+    '''
+    def __init__(self, scopes):
+        self.scopes = scopes
+        self.workers = [ScopeWorker(index, scope) for index, scope in enumerate(scopes)]
+        for worker in self.workers:
+            worker.start()
+
+    @property
+    def stats(self):
+        return self.scopes[0].stats
+
+    @stats.setter
+    def stats(self, stats):
+        for scope in self.scopes:
+            scope.stats = stats
+
+    def map(self, func):
+        '''
+        Calls `func(index, scope)` for all scopes concurrently and returns the
+        list of results. If any call fails, the first error is raised once
+        all calls are done.
+        '''
+        for worker in self.workers:
+            worker.requests.put(func)
+        results = []
+        error = None
+        for worker in self.workers:
+            result, e = worker.results.get()
+            if e is not None and error is None:
+                error = e
+            results.append(result)
+        if error is not None:
+            raise error
+        return results
+
+    def trigger(self):
+        self.map(lambda index, scope: scope.trigger())
+
+    def clear(self):
+        self.map(lambda index, scope: scope.clear())
+
+    def resync(self):
+        self.map(lambda index, scope: scope.resync())
+
+    def close(self):
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def match_segments(reference, times, tolerance):
+    '''
+    Returns the index arrays (i, j) of the elements of the sorted arrays
+    `reference` and `times` that are closest to each other and no more than
+    `tolerance` apart.
+    '''
+    if len(reference) == 0 or len(times) == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    j = numpy.searchsorted(times, reference)
+    after = numpy.minimum(j, len(times) - 1)
+    before = numpy.maximum(j - 1, 0)
+    nearest = numpy.where(numpy.abs(times[before] - reference) < numpy.abs(times[after] - reference), before, after)
+    i = numpy.nonzero(numpy.abs(times[nearest] - reference) <= tolerance)[0]
+    j = nearest[i]
+    # a segment may be nearest to two reference segments; keep the first
+    j, first = numpy.unique(j, return_index=True)
+    return i[first], j
+
+class MultiScopePipeline(AcquisitionPipeline):
+    '''
+    An AcquisitionPipeline reading from all scopes of a ScopeGroup, which
+    are armed together and share a trigger. The segments of every scope are
+    matched to those of the first scope by their trigger times, and only the
+    segments seen by all scopes are passed on, in blocks of
+    (scope, channel)->(wave_desc, traces) holding the same events in the
+    same rows.
+
+    The trigger time arrays give the segment times relative to the first
+    segment to well below a microsecond, while the descriptor `trigger_time`
+    only tells the first segments apart by the scope clocks. For each
+    acquisition, the shift between the relative times of a scope and the
+    first scope is found among the differences of their first few segments
+    as the one that matches the most segments within `tolerance` seconds,
+    and among equally good shifts the one closest to what the scope clocks
+    predict. Every scope needs an active channel for its trigger times.
+    '''
+    def __init__(self, group, channels, sequence_count, depth=4, stats=None, tolerance=1e-6, candidates=4):
+        for index, scope_channels in enumerate(channels):
+            if not scope_channels:
+                raise Exception('scope %i has no active channels.' % index)
+        AcquisitionPipeline.__init__(self, group, channels, sequence_count, depth, stats)
+        self.tolerance = tolerance
+        self.candidates = candidates
+        # offset of each scope's clock from the first scope's
+        self.clock_offsets = [None]*len(group.scopes)
+        self.segments = 0
+        self.dropped = 0
+
+    def read_scope(self, index, scope):
+        block = {}
+        for channel in self.channels[index]:
+            wave_desc, wave_array = scope.get_waveform(channel, copy=True, trigtime=True)
+            traces = wave_array.reshape(self.sequence_count, wave_array.size//self.sequence_count)
+            block[channel] = (wave_desc, traces)
+        return block
+
+    def align(self, k, reference, times, reference_start, start):
+        '''
+        Returns the matching segments (i, j) of the relative trigger `times`
+        of scope `k` to the `reference` times of the first scope.
+        '''
+        n = self.candidates
+        shifts = numpy.concatenate([times[:n] - reference[0], times[0] - reference[:n]])
+        predicted = 0.0 if self.clock_offsets[k] is None else reference_start - start + self.clock_offsets[k]
+        best = None
+        for shift in shifts:
+            i, j = match_segments(reference, times - shift, self.tolerance)
+            rank = (len(i), -abs(shift - predicted))
+            if best is None or rank > best[0]:
+                best = (rank, shift, i, j)
+        rank, shift, i, j = best
+        if len(i):
+            self.clock_offsets[k] = shift - (reference_start - start)
+        return i, j
+
+    def read(self):
+        '''
+        Transfers the current acquisition of all scopes and returns the event
+        built block.
+        '''
+        blocks = self.scope.map(self.read_scope)
+        times = []
+        starts = []
+        for block in blocks:
+            wave_desc, traces = block[min(block.keys())]
+            times.append(wave_desc['trigger_times'])
+            starts.append(timestamp(wave_desc))
+        # segments of the first scope seen by every scope, and their rows
+        rows = [numpy.arange(len(times[0]))]
+        for k in range(1, len(blocks)):
+            i, j = self.align(k, times[0], times[k], starts[0], starts[k])
+            found = numpy.empty(len(times[0]), dtype=int)
+            found.fill(-1)
+            found[i] = j
+            rows.append(found)
+        rows = numpy.array(rows)
+        keep = numpy.all(rows >= 0, axis=0)
+        self.segments += len(keep)
+        self.dropped += len(keep) - keep.sum()
+        built = {}
+        for k, block in enumerate(blocks):
+            index = rows[k][keep]
+            for channel, (wave_desc, traces) in block.items():
+                wave_desc = dict(wave_desc)
+                wave_desc['trigger_times'] = wave_desc['trigger_times'][index]
+                wave_desc['horiz_offsets'] = wave_desc['horiz_offsets'][index]
+                built[(k, channel)] = (wave_desc, traces[index])
+        return built
+
+    def summary(self):
+        lines = ['event building: %i of %i segments of the first scope seen by all scopes' % (self.segments - self.dropped, self.segments)]
+        return '\n'.join(lines + [AcquisitionPipeline.summary(self)])
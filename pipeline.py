@@ -0,0 +1,207 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import struct
+import socket
+import threading
+import Queue
+
+class Stage(threading.Thread):
+    '''
+    A worker thread that calls `process(i, block)` for every acquisition
+    taken from its bounded queue, in the order they were put. If `process`
+    returns something other than None it is passed on to each of the
+    `outputs` stages.
+    '''
+    def __init__(self, name, process, depth=4, outputs=(), stats=None):
+        threading.Thread.__init__(self, name=name)
+        self.stats = stats
+        self.daemon = True
+        self.process = process
+        self.depth = depth
+        self.outputs = list(outputs)
+        self.queue = Queue.Queue(depth)
+        self.error = None
+        self.processed = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.stalls = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        '''
+        Queues `item` for this stage, blocking while the queue is full. The
+        time spent blocked is accounted as backpressure.
+        '''
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        start = time.time()
+        if self.queue.full():
+            self.stalls += 1
+        while True:
+            if self.error is not None:
+                raise RuntimeError('%s stage failed: %s' % (self.name, self.error))
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        blocked = time.time() - start
+        self.blocked += blocked
+        if self.stats is not None:
+            self.stats.record('backpressure', blocked)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue # keep draining so upstream never blocks forever
+            start = time.time()
+            try:
+                result = self.process(*item)
+                if result is not None:
+                    for stage in self.outputs:
+                        stage.put(result)
+                self.processed += 1
+            except Exception as e:
+                self.error = e
+            busy = time.time() - start
+            self.busy += busy
+            if self.stats is not None:
+                self.stats.record(self.name, busy)
+
+    def stop(self):
+        '''
+        Waits for the queued items to be processed, then stops this stage and
+        all of its outputs.
+        '''
+        self.queue.put(None)
+        self.join()
+        for stage in self.outputs:
+            stage.stop()
+
+    def summary(self):
+        return '%s: %i blocks, %.3f s busy, %.3f s backpressure (%i stalls), max queue depth %i/%i' % \
+            (self.name, self.processed, self.busy, self.blocked, self.stalls, self.max_depth, self.depth)
+
+class AcquisitionPipeline(object):
+    '''
+    Reads sequence blocks from a LeCroyScope on the calling thread and hands
+    them to worker stages through bounded queues, so that writing and
+    crunching overlap with the next acquisition instead of adding to the dead
+    time. Each block is a dict of channel->(wave_desc, traces), where traces
+    has shape (sequence_count, num_samples), and is shared by all stages.
+    With a stats.Stats as `stats`, the scope and every stage are timed and a
+    rolling summary is reported every `stats.interval` seconds.
+    '''
+    def __init__(self, scope, channels, sequence_count, depth=4, stats=None):
+        self.scope = scope
+        self.stats = stats
+        scope.stats = stats
+        self.channels = channels
+        self.sequence_count = sequence_count
+        self.depth = depth
+        self.inputs = []
+        self.stages = []
+        self.count = 0
+        self.errors = 0
+
+    def add_stage(self, name, process, outputs=()):
+        '''
+        Adds a worker stage calling `process(i, block)`. Stages given as
+        `outputs` of another stage are fed by that stage instead of by the
+        reader.
+        '''
+        stage = Stage(name, process, self.depth, outputs, self.stats)
+        for output in outputs:
+            self.inputs.remove(output)
+        self.inputs.append(stage)
+        self.stages.append(stage)
+        return stage
+
+    def read(self):
+        '''
+        Transfers the current acquisition of all channels from the scope,
+        with the trigger time of every segment in the wave descriptors.
+        '''
+        block = {}
+        for channel in self.channels:
+            wave_desc, wave_array = self.scope.get_waveform(channel, copy=True, trigtime=True)
+            traces = wave_array.reshape(self.sequence_count, wave_array.size//self.sequence_count)
+            block[channel] = (wave_desc, traces)
+        return block
+
+    def run(self, nevents):
+        '''
+        Acquires until `nevents` events have been queued, then waits for all
+        stages to finish. The scope is re-armed as soon as a block has been
+        transferred, before the block is queued.
+        '''
+        for stage in self.stages:
+            stage.start()
+        try:
+            armed = False
+            while self.count < nevents:
+                print '\rfetching event: %i' % self.count,
+                sys.stdout.flush()
+                try:
+                    if not armed:
+                        self.scope.trigger()
+                    block = self.read()
+                    armed = self.count + self.sequence_count < nevents
+                    if armed:
+                        self.scope.trigger()
+                except (socket.error, struct.error) as e:
+                    print '\n' + str(e)
+                    self.errors += 1
+                    armed = False
+                    self.scope.resync()
+                    continue
+                size = min(len(traces) for wave_desc, traces in block.values())
+                for stage in self.inputs:
+                    stage.put((self.count, block))
+                self.count += size
+                if self.stats is not None:
+                    self.stats.add_events(size)
+                    if self.stats.due():
+                        print
+                        self.stats.report(sys.stdout)
+        finally:
+            for stage in self.inputs:
+                stage.stop()
+        for stage in self.stages:
+            if stage.error is not None:
+                raise RuntimeError('%s stage failed: %s' % (stage.name, stage.error))
+        return self.count
+
+    def summary(self):
+        '''
+        Returns the counters of all stages as a printable string, followed by
+        the stats of the whole run if there are any.
+        '''
+        lines = [stage.summary() for stage in self.stages]
+        if self.stats is not None:
+            self.stats.report()
+            lines.append(self.stats.format_summary(self.stats.summary()))
+        return '\n'.join(lines)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import json
+import h5py
+import config
+from lecroy import LeCroyScope, setting_commands
+
+def save_profile(filename, settings):
+    '''
+    Saves a `settings` dict of Command->Setting to a JSON profile.
+    '''
+    with open(filename, 'w') as f:
+        json.dump({ 'time' : time.asctime(), 'settings' : settings }, f, indent=1, sort_keys=True)
+
+def load_profile(filename, scope=0):
+    '''
+    Returns the settings dict of a JSON profile or of the attributes of an
+    HDF5 file written by fetch. For runs of several scopes, where the
+    settings of scope K are prefixed by `SK:`, those of `scope` are returned.
+    '''
+    if h5py.is_hdf5(filename):
+        with h5py.File(filename, 'r') as f:
+            attrs = dict((key, str(value)) for key, value in f.attrs.items())
+        prefix = 'S%i:' % scope
+        if any(key.startswith(prefix) for key in attrs):
+            attrs = dict((key[len(prefix):], value) for key, value in attrs.items() if key.startswith(prefix))
+        settings = dict((command, attrs[command]) for command in setting_commands if command in attrs)
+    else:
+        with open(filename) as f:
+            settings = dict((str(command), str(setting)) for command, setting in json.load(f)['settings'].items())
+    if not settings:
+        raise Exception('no scope settings found in %s.' % filename)
+    return settings
+
+def diff_settings(old, new):
+    '''
+    Returns the commands whose setting differs between the settings dicts
+    `old` and `new`, in the order of `setting_commands`.
+    '''
+    return [command for command in setting_commands if old.get(command) != new.get(command)]
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog save|restore|diff <profile> [--scope]"
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("--scope", type="int", dest="scope",
+                      help="index of the scope whose settings to use from a run of several scopes", default=0)
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2 or args[0] not in ('save', 'restore', 'diff'):
+        sys.exit(parser.format_help())
+    action, filename = args
+
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
+    try:
+        if action == 'save':
+            save_profile(filename, scope.get_settings())
+            print 'Saved settings to %s' % filename
+        elif action == 'diff':
+            profile = load_profile(filename, options.scope)
+            current = scope.get_settings()
+            for command in diff_settings(current, profile):
+                if command in profile:
+                    print '%-20s %-30s -> %s' % (command, current.get(command), profile[command])
+        else:
+            start = time.time()
+            profile = load_profile(filename, options.scope)
+            differ = scope.restore_settings(profile)
+            for command, (wanted, actual) in sorted(differ.items()):
+                print 'scope set %s as %s instead of %s' % (command, actual, wanted)
+            print 'Restored settings from %s in %.3f seconds' % (filename, time.time() - start)
+    finally:
+        scope.sock.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import sys
+import time
+import multiprocessing
+import h5py
+import numpy
+from cruncher import Cruncher, parse_extractor
+from traces import open_traces, hdf5_waveforms
+
+# per process state of the worker pool
+cruncher = None
+opened = {}
+
+def init_worker(ped_start, ped_end, win_start, win_end, load, features):
+    global cruncher
+    cruncher = Cruncher(ped_start, ped_end, win_start, win_end, load)
+    for spec in features:
+        cruncher.register(parse_extractor(spec))
+
+def open_source(filename):
+    '''
+    Returns the open HDF5 file or trace reader for `filename`, kept open for
+    the life of the worker process.
+    '''
+    if filename not in opened:
+        if h5py.is_hdf5(filename):
+            opened[filename] = h5py.File(filename, 'r')
+        else:
+            opened[filename] = open_traces(filename)
+    return opened[filename]
+
+def crunch_chunk(task):
+    '''
+    Crunches events `start` to `stop` of `channel` in `filename`. Returns
+    (output, crunched values, bytes read).
+    '''
+    output, filename, channel, start, stop = task
+    source = open_source(filename)
+    if isinstance(source, h5py.File):
+        waveform = hdf5_waveforms(source, channel, start, stop)
+    else:
+        waveform = source.waveforms(start, stop)
+    return output, cruncher.crunch(waveform.samples, waveform.wave_desc), waveform.samples.nbytes
+
+def plan(filename, outdir, chunk):
+    '''
+    Returns the tasks that crunch `filename` in chunks of `chunk` events.
+    '''
+    tasks = []
+    directory = outdir if outdir is not None else os.path.dirname(filename)
+    if h5py.is_hdf5(filename):
+        prefix = os.path.join(directory, os.path.splitext(os.path.basename(filename))[0])
+        f = h5py.File(filename, 'r')
+        try:
+            for name in sorted(f.keys()):
+                match = re.match(r'c(\d+)_samples$', name)
+                if match:
+                    channel = int(match.group(1))
+                    nevents = len(f[name])
+                    for start in xrange(0, nevents, chunk):
+                        tasks.append(('%s.ch%i.crunch'%(prefix,channel), filename, channel, start, min(start+chunk,nevents)))
+        finally:
+            f.close()
+    else:
+        match = re.match(r'(.*)\.ch(\d+)\.traces$', os.path.basename(filename))
+        if not match:
+            raise Exception('%s is not an HDF5 or .chN.traces file.' % filename)
+        prefix = os.path.join(directory, match.group(1))
+        channel = int(match.group(2))
+        nevents = len(open_traces(filename))
+        for start in xrange(0, nevents, chunk):
+            tasks.append(('%s.ch%i.crunch'%(prefix,channel), filename, channel, start, min(start+chunk,nevents)))
+    return tasks
+
+def recrunch(filenames, ped_start, ped_end, win_start, win_end, load, features=(), processes=None, chunk=1000, outdir=None):
+    '''
+    Crunches stored waveforms from fetch.py HDF5 files and fetch_fast.py
+    .traces files on a pool of worker processes, writing the same .crunch
+    records as fetch_and_crunch.py in event order. Returns the number of
+    events crunched.
+    '''
+    tasks = []
+    for filename in filenames:
+        tasks.extend(plan(filename, outdir, chunk))
+    total = sum(stop - start for output, filename, channel, start, stop in tasks)
+    pool = multiprocessing.Pool(processes, init_worker, (ped_start, ped_end, win_start, win_end, load, list(features)))
+    out = {}
+    count = 0
+    nbytes = 0
+    start = time.time()
+    last = start
+    try:
+        for output, values, size in pool.imap(crunch_chunk, tasks):
+            if output not in out:
+                out[output] = open(output, 'wb')
+            values.tofile(out[output])
+            count += len(values)
+            nbytes += size
+            now = time.time()
+            if now - last > 1.0 or count == total:
+                last = now
+                elapsed = max(now - start, 1e-9)
+                print '\rcrunched %i/%i events, %.0f events/s, %.1f MB/s' % (count, total, count/elapsed, nbytes/elapsed/1e6),
+                sys.stdout.flush()
+        pool.close()
+    except KeyboardInterrupt:
+        print '\rUser interrupted crunch early'
+        pool.terminate()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for f in out.values():
+            f.close()
+        print
+    return count
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog <file.h5 | prefix.chN.traces> ... --ps --pe --ws --we --load"
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("--ps", type="int", dest="ps",
+                      help="pedestal start index", default=0)
+    parser.add_option("--pe", type="int", dest="pe",
+                      help="pedestal end index", default=2500)
+    parser.add_option("--ws", type="int", dest="ws",
+                      help="window start index", default=2500)
+    parser.add_option("--we", type="int", dest="we",
+                      help="window end index", default=10000)
+    parser.add_option("--load", type="float", dest="load",
+                      help="load", default=50)
+    parser.add_option("--feature", action="append", dest="features",
+                      help="extra feature to crunch as name,start,end[,args], e.g. charge,2500,3000 peak,2500,10000 cfd,2500,10000,0.2", default=[])
+    parser.add_option("-j", type="int", dest="processes",
+                      help="number of worker processes (default: one per cpu)", default=None)
+    parser.add_option("--chunk", type="int", dest="chunk",
+                      help="number of events crunched per task", default=1000)
+    parser.add_option("-o", type="string", dest="outdir",
+                      help="directory for the .crunch files (default: next to the inputs)", default=None)
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        sys.exit(parser.format_help())
+
+    if options.chunk < 1:
+        sys.exit("Argument to --chunk must be positive")
+
+    try:
+        for spec in options.features:
+            parse_extractor(spec)
+    except Exception as e:
+        sys.exit(str(e))
+
+    start = time.time()
+    count = recrunch(args, options.ps, options.pe, options.ws, options.we, options.load, options.features, options.processes, options.chunk, options.outdir)
+    elapsed = time.time() - start
+    if count > 0:
+        print 'Crunched %i events in %.3f seconds.' % (count, elapsed)
@@ -28,8 +28,7 @@ import config
 from lecroy import LeCroyScope
 
 if __name__ == '__main__':
-    scope = LeCroyScope(config.ip, timeout=config.timeout)
-    scope.clear()
+    scope = LeCroyScope(config.ip, config.port, timeout=config.timeout)
     settings = scope.get_settings()
     print settings
     while True:
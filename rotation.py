@@ -0,0 +1,188 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import json
+import hashlib
+import threading
+import Queue
+from writers import segment_times
+
+def settings_hash(settings):
+    '''
+    Returns a hex digest identifying a settings dict of Command->Setting.
+    '''
+    return hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+def rotated_name(base, index, ext=''):
+    '''
+    Returns the name of file `index` of a run saved to `base` + `ext`, e.g.
+    run_0003.h5.
+    '''
+    return '%s_%04i%s' % (base, index, ext)
+
+def read_catalog(filename):
+    '''
+    Returns the list of entries of a run catalog, one per finished file.
+    '''
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class RotatingWriter(object):
+    '''
+    Writes a run as a series of files, taking whole blocks like HDF5Writer.
+    A new file is started at the first block boundary after `max_events`
+    events, `max_bytes` bytes of samples or `max_seconds` seconds (0 for no
+    limit), by calling `open_file(index, first)`, with `first` the first
+    event of the file in the run, for a writer with `write(i, block)`,
+    `close()`, a list of `filenames` and the `count` of events written;
+    the events of each file
+    are numbered from 0. Finished files are closed on a background thread,
+    so the acquisition never waits for a file to be finalized, and then
+    appended to the JSON lines run catalog `catalog` with their event range
+    in the run, the times of their first and last trigger, their size and
+    the hash of the scope `settings`. The run information of `update_info`
+    is stored in every file and catalog entry, with the zero suppression
+    counters of the blocks written to that file, see
+    suppress.ZeroSuppressor.
+    '''
+    def __init__(self, open_file, catalog, settings, max_events=0, max_bytes=0, max_seconds=0):
+        self.open_file = open_file
+        self.catalog = catalog
+        self.settings_hash = settings_hash(settings)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        open(catalog, 'w').close()
+        self.writer = None
+        self.index = 0
+        self.info = {}
+        self.counts = {}
+        self.error = None
+        self.queue = Queue.Queue()
+        self.finalizer = threading.Thread(target=self.finalize_files, name='finalizer')
+        self.finalizer.daemon = True
+        self.finalizer.start()
+
+    def due(self):
+        '''
+        True if the current file has reached one of the limits.
+        '''
+        return (self.max_events and self.events >= self.max_events) or \
+               (self.max_bytes and self.nbytes >= self.max_bytes) or \
+               (self.max_seconds and time.time() - self.opened >= self.max_seconds)
+
+    def write(self, i, block):
+        '''
+        Writes the `block` whose first event in the run is `i`, starting a
+        new file first if the current one is full.
+        '''
+        if self.error is not None:
+            raise RuntimeError('finalizing failed: %s' % self.error)
+        rows = min(len(traces) for wave_desc, traces in block.values())
+        if rows == 0:
+            self.count_segments(block)
+            return
+        if self.writer is not None and self.due():
+            self.rotate()
+        acq_time, trigger_times, horiz_offsets = segment_times(block.values()[0][0], rows)
+        if self.writer is None:
+            self.writer = self.open_file(self.index, i)
+            self.first = i
+            self.first_time = acq_time + trigger_times[0]
+            self.opened = time.time()
+            self.events = 0
+            self.nbytes = 0
+        self.writer.write(i - self.first, block)
+        self.events = i + rows - self.first
+        self.nbytes += sum(traces[:rows].nbytes for wave_desc, traces in block.values())
+        self.last_time = acq_time + trigger_times[-1]
+        self.count_segments(block)
+
+    def count_segments(self, block):
+        '''
+        Adds the zero suppression counters of `block` to those of the
+        current file.
+        '''
+        wave_desc = block.values()[0][0]
+        if 'zs_counts' in wave_desc:
+            kept, dropped = wave_desc['zs_counts']
+            self.counts['zs_kept'] = self.counts.get('zs_kept', 0) + kept
+            self.counts['zs_dropped'] = self.counts.get('zs_dropped', 0) + dropped
+
+    def update_info(self, values):
+        '''
+        Adds a dict of run information to the current and later files, and
+        to their catalog entries. Zero suppression counters are replaced by
+        those of each file.
+        '''
+        self.info.update(values)
+
+    def rotate(self):
+        '''
+        Hands the current file to the finalizer.
+        '''
+        entry = { 'index' : self.index,
+                  'files' : self.writer.filenames,
+                  'first_event' : self.first,
+                  'events' : self.events,
+                  'first_time' : self.first_time,
+                  'last_time' : self.last_time,
+                  'opened' : self.opened,
+                  'settings_hash' : self.settings_hash }
+        info = dict(self.info, **self.counts)
+        if info:
+            entry['info'] = info
+            if hasattr(self.writer, 'update_info'):
+                self.writer.update_info(info)
+        self.queue.put((self.writer, entry))
+        self.writer = None
+        self.counts = {}
+        self.index += 1
+
+    def finalize_files(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            writer, entry = item
+            try:
+                writer.close()
+                # the writer knows if it dropped events past the end of the run
+                entry['events'] = min(entry['events'], writer.count)
+                entry['closed'] = time.time()
+                entry['bytes'] = sum(os.path.getsize(filename) for filename in entry['files'])
+                with open(self.catalog, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        '''
+        Finalizes the current file and waits for all files to be finalized.
+        '''
+        if self.writer is not None:
+            self.rotate()
+        self.queue.put(None)
+        self.finalizer.join()
+        if self.error is not None:
+            raise RuntimeError('finalizing failed: %s' % self.error)
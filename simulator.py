@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import time
+import struct
+import socket
+import threading
+import SocketServer
+import numpy
+from lecroy import headerformat, wavedesc_template, wavedesclength, packfmt, String, UnitDefinition, TimeStamp
+
+# short forms of the long command headers understood by the simulator
+short_headers = { 'TIME_DIV'        : 'TDIV',
+                  'COMM_FORMAT'     : 'CFMT',
+                  'COMM_HEADER'     : 'CHDR',
+                  'COMM_ORDER'      : 'CORD',
+                  'TRIG_DELAY'      : 'TRDL',
+                  'TRIG_SELECT'     : 'TRSE',
+                  'TRIG_MODE'       : 'TRMD',
+                  'TRIG_PATTERN'    : 'TRPA',
+                  'SEQUENCE'        : 'SEQ',
+                  'COUPLING'        : 'CPL',
+                  'VOLT_DIV'        : 'VDIV',
+                  'OFFSET'          : 'OFST',
+                  'TRIG_COUPLING'   : 'TRCP',
+                  'TRIG_LEVEL'      : 'TRLV',
+                  'TRIG_SLOPE'      : 'TRSL',
+                  'TRACE'           : 'TRA',
+                  'WAVEFORM'        : 'WF',
+                  'ARM_ACQUISITION' : 'ARM',
+                  'WAVEFORM_SETUP'  : 'WFSU' }
+
+# settings of a freshly started simulator, by short header
+default_settings = { 'TDIV' : '50E-9 S',
+                     'CFMT' : 'DEF9,BYTE,BIN',
+                     'CHDR' : 'SHORT',
+                     'CORD' : 'LO',
+                     'TRDL' : '0 S',
+                     'TRSE' : 'EDGE,SR,C1,HT,OFF',
+                     'TRMD' : 'NORM',
+                     'TRPA' : 'C1,L,C2,X,C3,X,C4,X,STATE,OR',
+                     'SEQ'  : 'OFF',
+                     'WFSU' : 'SP,0,NP,0,FP,0,SN,0' }
+for i in range(1, 5):
+    default_settings.update({ 'C%i:CPL' % i  : 'D50',
+                              'C%i:VDIV' % i : '50E-3 V',
+                              'C%i:OFST' % i : '0 V',
+                              'C%i:TRCP' % i : 'DC',
+                              'C%i:TRLV' % i : '-10E-3 V',
+                              'C%i:TRSL' % i : 'NEG',
+                              'C%i:TRA' % i  : 'ON' if i == 1 else 'OFF' })
+
+def build_wavedesc(values):
+    '''
+    Packs a little endian wavedesc block from a dict of field values, with
+    zeros for any field not given.
+    '''
+    block = []
+    for name, pos, datatype in wavedesc_template:
+        if datatype in (String, UnitDefinition):
+            block.append(struct.pack('<' + packfmt(datatype), values.get(name, '')))
+        elif datatype is TimeStamp:
+            block.append(struct.pack('<' + packfmt(datatype), *values.get(name, (0.0, 0, 0, 0, 0, 0, 0))))
+        else:
+            block.append(struct.pack('<' + packfmt(datatype), values.get(name, 0)))
+    block = ''.join(block)
+    assert len(block) == wavedesclength
+    return block
+
+def parse_value(setting):
+    '''
+    Returns the leading number of a setting like '50E-3 V'.
+    '''
+    return float(setting.split(' ')[0].split(',')[0])
+
+class SimulatedScope(object):
+    '''
+    The state of a simulated oscilloscope: its settings and the waveforms of
+    the last acquisition. Each segment holds `record_length` samples of
+    noise with a negative pulse of random amplitude. An acquisition of N
+    segments takes `trigger_latency` plus N triggers at `trigger_rate`.
+    Waveform replies are sent at no more than `bandwidth` bytes per second
+    (0 for unlimited) and each one is dropped with probability `error_rate`.
+    Simulators given the same `trigger_seed` see the same trigger times, as
+    scopes sharing a trigger would. Replies carry the sequence number of the
+    message they answer unless `sequencing` is False, as for old firmware.
+    '''
+    def __init__(self, record_length=1000, channels=(1,), trigger_rate=1000.0, trigger_latency=0.001, bandwidth=0, error_rate=0.0, seed=None, trigger_seed=None, sequencing=True):
+        self.record_length = record_length
+        self.trigger_rate = trigger_rate
+        self.trigger_latency = trigger_latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.sequencing = sequencing
+        self.random = numpy.random.RandomState(seed)
+        self.trigger_random = self.random if trigger_seed is None else numpy.random.RandomState(trigger_seed)
+        self.settings = dict(default_settings)
+        for i in range(1, 5):
+            self.settings['C%i:TRA' % i] = 'ON' if i in channels else 'OFF'
+        self.lock = threading.RLock()
+        self.last_error = 0
+        self.ready = 0.0
+        self.acquisitions = 0
+        self.acquisition = None
+        self.start = time.time()
+        self.pool = self.make_pool(64)
+
+    def make_pool(self, count):
+        '''
+        Returns `count` distinct segments to draw acquisitions from.
+        '''
+        samples = self.random.normal(0.0, 2.0, size=(count, self.record_length))
+        t = numpy.maximum(numpy.arange(self.record_length) - self.record_length//2, 0)
+        shape = numpy.exp(-t/8.0) - numpy.exp(-t/2.0)
+        samples -= self.random.exponential(40.0, size=(count, 1))*shape
+        return numpy.clip(numpy.round(samples), -128, 127).astype(numpy.int8)
+
+    def sequence_count(self):
+        setting = self.settings['SEQ']
+        if setting.startswith('ON'):
+            return int(setting.split(',')[1])
+        return 1
+
+    def arm(self):
+        '''
+        Starts an acquisition of the configured number of segments.
+        '''
+        duration = self.trigger_latency + self.sequence_count()/self.trigger_rate
+        self.ready = max(self.ready, time.time()) + duration
+        self.acquisitions += 1
+        self.acquisition = None
+
+    def wait(self):
+        '''
+        Blocks until the current acquisition is complete.
+        '''
+        delay = self.ready - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def acquire(self):
+        '''
+        Returns the acquisition of the last arm as a dict of channel->(wave
+        desc values, trigger time array, samples), generating it on first use.
+        '''
+        if self.acquisition is not None:
+            return self.acquisition
+        sequence_count = self.sequence_count()
+        tinc = parse_value(self.settings['TDIV'])*10/self.record_length
+        times = numpy.cumsum(self.trigger_random.exponential(1.0/self.trigger_rate, size=sequence_count))
+        times -= times[0]
+        offsets = -5*tinc*self.record_length/10.0*numpy.ones(sequence_count) - self.random.uniform(0, tinc, size=sequence_count)
+        trigtime = numpy.empty((sequence_count, 2), dtype='<f8')
+        trigtime[:,0] = times
+        trigtime[:,1] = offsets
+        now = time.time()
+        stamp = time.gmtime(now)
+        self.acquisition = {}
+        for channel in range(1, 5):
+            samples = self.pool[self.random.randint(0, len(self.pool), size=sequence_count)]
+            vdiv = parse_value(self.settings['C%i:VDIV' % channel])
+            values = { 'descriptor_name'    : 'WAVEDESC',
+                       'template_name'      : 'LECROY_2_3',
+                       'comm_type'          : 0,
+                       'comm_order'         : 1,
+                       'wave_descriptor'    : wavedesclength,
+                       'trigtime_array'     : trigtime.nbytes if sequence_count > 1 else 0,
+                       'wave_array_1'       : samples.nbytes,
+                       'instrument_name'    : 'LECROYSIM',
+                       'trace_label'        : '',
+                       'wave_array_count'   : samples.size,
+                       'pnts_per_screen'    : self.record_length,
+                       'first_valid_pnt'    : 0,
+                       'last_valid_pnt'     : samples.size - 1,
+                       'first_point'        : 0,
+                       'sparsing_factor'    : 1,
+                       'segment_index'      : 0,
+                       'subarray_count'     : sequence_count,
+                       'sweeps_per_acq'     : 1,
+                       'vertical_gain'      : vdiv/25.0,
+                       'vertical_offset'    : parse_value(self.settings['C%i:OFST' % channel]),
+                       'max_value'          : 127.0,
+                       'min_value'          : -128.0,
+                       'nominal_bits'       : 8,
+                       'nom_subarray_count' : sequence_count,
+                       'horiz_interval'     : tinc,
+                       'horiz_offset'       : offsets[0],
+                       'vertunit'           : 'V',
+                       'horunit'            : 'S',
+                       'trigger_time'       : (stamp.tm_sec + now % 1, stamp.tm_min, stamp.tm_hour, stamp.tm_mday, stamp.tm_mon, stamp.tm_year, 0),
+                       'acq_duration'       : sequence_count/self.trigger_rate,
+                       'probe_att'          : 1.0,
+                       'vertical_vernier'   : 1.0,
+                       'wave_source'        : channel - 1 }
+            self.acquisition[channel] = (values, trigtime, samples)
+        return self.acquisition
+
+    def waveform_setup(self):
+        '''
+        Returns the (first point, number of points, sparsing) of the waveform
+        setup, applied to every segment.
+        '''
+        fields = self.settings['WFSU'].split(',')
+        setup = dict((key, int(value)) for key, value in zip(fields[::2], fields[1::2]))
+        return setup.get('FP', 0), setup.get('NP', 0), max(setup.get('SP', 0), 1)
+
+    def set_waveform_setup(self, arg):
+        '''
+        Updates the waveform setup from a 'SP,n,NP,n,FP,n,SN,n' argument, any
+        of whose pairs may be left out.
+        '''
+        fields = self.settings['WFSU'].split(',')
+        setup = zip(fields[::2], fields[1::2])
+        fields = arg.split(',')
+        changes = dict(zip(fields[::2], fields[1::2]))
+        if not set(changes) <= set(('SP', 'NP', 'FP', 'SN')):
+            self.last_error = 5
+            return
+        self.settings['WFSU'] = ','.join('%s,%i' % (key, int(changes.get(key, value))) for key, value in setup)
+
+    def waveform(self, channel, mode):
+        '''
+        Returns the reply to `cN:wf? mode` for `mode` DESC, DAT1 or ALL.
+        '''
+        values, trigtime, samples = self.acquire()[channel]
+        first, number, sparsing = self.waveform_setup()
+        if first or number or sparsing > 1:
+            samples = samples[:,first::sparsing]
+            if number:
+                samples = samples[:,:number]
+            samples = numpy.ascontiguousarray(samples)
+            values = dict(values, first_point=first, sparsing_factor=sparsing, wave_array_1=samples.nbytes, wave_array_count=samples.size, last_valid_pnt=samples.size - 1)
+        desc = build_wavedesc(values)
+        if mode == 'DESC':
+            block = desc
+        elif mode == 'DAT1':
+            block = samples.tostring()
+        elif mode == 'ALL':
+            block = desc + (trigtime.tostring() if values['trigtime_array'] else '') + samples.tostring()
+        else:
+            return None
+        return 'C%i:WF %s,#9%09i' % (channel, mode, len(block)) + block
+
+    def execute(self, message):
+        '''
+        Executes the ';' separated commands and queries in `message` and
+        returns the reply, or None if no query produced one.
+        '''
+        replies = []
+        for part in message.strip().split(';'):
+            part = part.strip()
+            if not part:
+                continue
+            head, _, arg = part.partition(' ')
+            head = head.upper()
+            arg = arg.strip()
+            query = head.endswith('?')
+            head = head.rstrip('?')
+            prefix = ''
+            if ':' in head:
+                prefix, _, head = head.partition(':')
+                prefix += ':'
+            head = short_headers.get(head, head)
+            key = prefix + head
+            if key == 'CMR' and query:
+                replies.append('CMR %i' % self.last_error)
+                self.last_error = 0
+            elif key == '*IDN' and query:
+                replies.append('*IDN LECROY,SIMULATOR,0,0.1')
+            elif key == 'ARM':
+                self.arm()
+            elif key == 'WAIT':
+                self.wait()
+            elif head == 'WF' and query and prefix:
+                reply = self.waveform(int(prefix[1]), arg.upper())
+                if reply is None:
+                    self.last_error = 5
+                elif self.random.uniform() < self.error_rate:
+                    pass # injected error: the reply is lost
+                else:
+                    replies.append(reply)
+            elif key == 'WFSU' and not query:
+                self.set_waveform_setup(arg.upper().replace(' ', ''))
+            elif key in self.settings:
+                if query:
+                    replies.append('%s %s' % (key, self.settings[key]))
+                else:
+                    self.settings[key] = arg.upper()
+                    if key == 'SEQ':
+                        self.acquisition = None
+            else:
+                self.last_error = 1
+        if replies:
+            return ';'.join(replies)
+        return None
+
+class VICPHandler(SocketServer.BaseRequestHandler):
+    '''
+    Speaks the VICP framing of LeCroyScope.send/recv for one connection.
+    '''
+    def recv_exactly(self, nbytes):
+        data = []
+        while nbytes > 0:
+            chunk = self.request.recv(nbytes)
+            if not chunk:
+                raise socket.error('connection closed by client')
+            data.append(chunk)
+            nbytes -= len(chunk)
+        return ''.join(data)
+
+    def recv_message(self):
+        '''
+        Returns the sequence number and the text of the next message.
+        '''
+        message = []
+        while True:
+            operation, headerver, seqnum, spare, totalbytes = \
+                struct.unpack(headerformat, self.recv_exactly(8))
+            message.append(self.recv_exactly(totalbytes))
+            if operation % 2:
+                break
+        return seqnum, ''.join(message)
+
+    def send_message(self, message, seqnum=1, bandwidth=0, frame_size=1 << 20):
+        message += '\n'
+        start = time.time()
+        for pos in xrange(0, len(message), frame_size):
+            frame = message[pos:pos+frame_size]
+            last = pos + frame_size >= len(message)
+            self.request.sendall(struct.pack(headerformat, 129 if last else 128, 1, seqnum, 0, len(frame)) + frame)
+            if bandwidth:
+                delay = start + (pos + len(frame))/float(bandwidth) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+    def handle(self):
+        scope = self.server.scope
+        try:
+            while True:
+                seqnum, message = self.recv_message()
+                with scope.lock:
+                    reply = scope.execute(message)
+                if reply is not None:
+                    self.send_message(reply, seqnum if scope.sequencing else 1, scope.bandwidth if len(reply) > 1024 else 0)
+        except socket.error:
+            pass
+
+class SimulatorServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''
+    A TCP server answering like a LeCroy oscilloscope at `port`, backed by
+    `scope`. Port 0 picks a free port, available as `port` afterwards.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, scope, host='127.0.0.1', port=1861):
+        SocketServer.TCPServer.__init__(self, (host, port), VICPHandler)
+        self.scope = scope
+        self.port = self.server_address[1]
+        self.thread = None
+
+    def start(self):
+        '''
+        Serves from a background thread.
+        '''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    import optparse
+
+    usage = "usage: %prog [--host] [--port] [-l] [-c] [--rate] [--latency] [--bandwidth] [--errors] [--seed] [--trigger-seed] [--no-sequencing]"
+    parser = optparse.OptionParser(usage, version="%prog 0.1.0")
+    parser.add_option("--host", type="string", dest="host",
+                      help="address to listen on", default='127.0.0.1')
+    parser.add_option("--port", type="int", dest="port",
+                      help="port to listen on", default=1861)
+    parser.add_option("-l", type="int", dest="record_length",
+                      help="samples per segment", default=1000)
+    parser.add_option("-c", type="string", dest="channels",
+                      help="comma separated list of active channels", default='1')
+    parser.add_option("--rate", type="float", dest="trigger_rate",
+                      help="trigger rate in Hz", default=1000.0)
+    parser.add_option("--latency", type="float", dest="trigger_latency",
+                      help="seconds from arm to the first trigger", default=0.001)
+    parser.add_option("--bandwidth", type="float", dest="bandwidth",
+                      help="link bandwidth in bytes per second (0 for unlimited)", default=0)
+    parser.add_option("--errors", type="float", dest="error_rate",
+                      help="probability that a waveform reply is lost", default=0.0)
+    parser.add_option("--seed", type="int", dest="seed",
+                      help="random seed", default=None)
+    parser.add_option("--trigger-seed", type="int", dest="trigger_seed",
+                      help="random seed of the trigger times, shared by simulators of scopes sharing a trigger", default=None)
+    parser.add_option("--no-sequencing", action="store_false", dest="sequencing",
+                      help="reply with sequence number 1 like old firmware", default=True)
+    (options, args) = parser.parse_args()
+
+    channels = [int(channel) for channel in options.channels.split(',')]
+    scope = SimulatedScope(options.record_length, channels, options.trigger_rate, options.trigger_latency, options.bandwidth, options.error_rate, options.seed, options.trigger_seed, options.sequencing)
+    server = SimulatorServer(scope, options.host, options.port)
+    print 'Simulating a LeCroy oscilloscope on %s:%i' % (options.host, server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
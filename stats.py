@@ -0,0 +1,204 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import math
+import time
+import json
+import threading
+import numpy
+
+# latency histogram bins: 8 per decade from 1 us to 100 s, plus under/overflow
+bins_per_decade = 8
+min_decade = -6
+max_decade = 2
+bin_edges = 10.0**(min_decade + numpy.arange((max_decade - min_decade)*bins_per_decade + 1)/float(bins_per_decade))
+
+class Timer(object):
+    '''
+    Context manager recording the time spent in a `stage` of `stats`.
+    '''
+    def __init__(self, stats, stage, nbytes=0):
+        self.stats = stats
+        self.stage = stage
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.record(self.stage, time.time() - self.start, self.nbytes)
+
+class Stats(object):
+    '''
+    Per stage latency histograms and byte counts of an acquisition, plus the
+    number of events acquired. `report` prints a summary of the interval
+    since the previous report and, if `filename` is given, writes it as JSON
+    lines ('jsonl') or replaces the file with a Prometheus text exposition
+    ('prom') of the running totals. Safe to use from several threads.
+    '''
+    def __init__(self, interval=10.0, filename=None, format='jsonl'):
+        if format not in ('jsonl', 'prom'):
+            raise Exception('unknown stats format %s.' % format)
+        self.interval = interval
+        self.filename = filename
+        self.format = format
+        self.lock = threading.Lock()
+        self.stages = []
+        self.histograms = {}
+        self.seconds = {}
+        self.nbytes = {}
+        self.events = 0
+        self.start = time.time()
+        self.last = (self.start, 0, {}, {}, {}, [])
+
+    def record(self, stage, seconds, nbytes=0):
+        '''
+        Records one occurrence of `stage` taking `seconds` and moving `nbytes`.
+        '''
+        if seconds > 0:
+            index = int(math.floor((math.log10(seconds) - min_decade)*bins_per_decade)) + 1
+            index = min(max(index, 0), len(bin_edges))
+        else:
+            index = 0
+        with self.lock:
+            if stage not in self.histograms:
+                self.stages.append(stage)
+                self.histograms[stage] = numpy.zeros(len(bin_edges) + 1, dtype=numpy.int64)
+                self.seconds[stage] = 0.0
+                self.nbytes[stage] = 0
+            self.histograms[stage][index] += 1
+            self.seconds[stage] += seconds
+            self.nbytes[stage] += nbytes
+
+    def time(self, stage, nbytes=0):
+        '''
+        Returns a context manager that records the time spent in `stage`.
+        '''
+        return Timer(self, stage, nbytes)
+
+    def add_events(self, count):
+        with self.lock:
+            self.events += count
+
+    def due(self):
+        '''
+        True once `interval` seconds have passed since the last report.
+        '''
+        return time.time() - self.last[0] >= self.interval
+
+    def quantile(self, histogram, q):
+        '''
+        Returns the upper bin edge below which a fraction `q` of `histogram`
+        lies.
+        '''
+        total = histogram.sum()
+        if total == 0:
+            return 0.0
+        index = int(numpy.searchsorted(numpy.cumsum(histogram), q*total))
+        return bin_edges[min(index, len(bin_edges) - 1)]
+
+    def snapshot(self):
+        '''
+        Returns a consistent copy of (time, events, histograms, seconds,
+        bytes, stages) taken under the lock, as stages may appear at any time.
+        '''
+        with self.lock:
+            histograms = dict((stage, histogram.copy()) for stage, histogram in self.histograms.items())
+            return time.time(), self.events, histograms, dict(self.seconds), dict(self.nbytes), list(self.stages)
+
+    def summary(self, since=None):
+        '''
+        Returns a dict summarising the interval since the snapshot `since`,
+        or since the start if None.
+        '''
+        now, events, histograms, seconds, nbytes, stages = self.snapshot()
+        then, events0, histograms0, seconds0, nbytes0, stages0 = since if since is not None else (self.start, 0, {}, {}, {}, [])
+        elapsed = max(now - then, 1e-9)
+        summary = { 'time' : now, 'elapsed' : elapsed, 'events' : events - events0, 'events_per_s' : (events - events0)/elapsed, 'stages' : {} }
+        for stage in stages:
+            histogram = histograms[stage] - histograms0.get(stage, 0)
+            count = int(histogram.sum())
+            busy = seconds[stage] - seconds0.get(stage, 0.0)
+            moved = nbytes[stage] - nbytes0.get(stage, 0)
+            summary['stages'][stage] = { 'count' : count,
+                                         'seconds' : busy,
+                                         'mean' : busy/count if count else 0.0,
+                                         'p50' : self.quantile(histogram, 0.5),
+                                         'p99' : self.quantile(histogram, 0.99),
+                                         'bytes' : moved,
+                                         'mb_per_s' : moved/busy/1e6 if busy > 0 else 0.0 }
+        return summary
+
+    def format_summary(self, summary):
+        lines = ['%.1f events/s over %.1f s' % (summary['events_per_s'], summary['elapsed'])]
+        with self.lock:
+            stages = list(self.stages)
+        for stage in stages:
+            values = summary['stages'].get(stage)
+            if values is None or values['count'] == 0:
+                continue
+            line = '  %-12s %7i x  mean %9.3f ms  p50 %9.3f ms  p99 %9.3f ms  total %8.3f s' % \
+                (stage, values['count'], values['mean']*1e3, values['p50']*1e3, values['p99']*1e3, values['seconds'])
+            if values['bytes']:
+                line += '  %8.1f MB/s' % values['mb_per_s']
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        '''
+        Returns the running totals in the Prometheus text exposition format.
+        '''
+        now, events, histograms, seconds, nbytes, stages = self.snapshot()
+        lines = ['# TYPE lecrunch_events_total counter',
+                 'lecrunch_events_total %i' % events,
+                 '# TYPE lecrunch_stage_seconds histogram']
+        for stage in stages:
+            cumulative = numpy.cumsum(histograms[stage])
+            for edge, count in zip(bin_edges, cumulative):
+                lines.append('lecrunch_stage_seconds_bucket{stage="%s",le="%g"} %i' % (stage, edge, count))
+            lines.append('lecrunch_stage_seconds_bucket{stage="%s",le="+Inf"} %i' % (stage, cumulative[-1]))
+            lines.append('lecrunch_stage_seconds_sum{stage="%s"} %f' % (stage, seconds[stage]))
+            lines.append('lecrunch_stage_seconds_count{stage="%s"} %i' % (stage, cumulative[-1]))
+        lines.append('# TYPE lecrunch_stage_bytes_total counter')
+        for stage in stages:
+            lines.append('lecrunch_stage_bytes_total{stage="%s"} %i' % (stage, nbytes[stage]))
+        return '\n'.join(lines) + '\n'
+
+    def report(self, out=None):
+        '''
+        Prints the summary of the interval since the last report to `out` (if
+        given) and writes the stats file. Returns the summary.
+        '''
+        summary = self.summary(self.last)
+        self.last = self.snapshot()
+        if out is not None:
+            print >>out, self.format_summary(summary)
+        if self.filename is not None:
+            if self.format == 'jsonl':
+                with open(self.filename, 'a') as f:
+                    f.write(json.dumps(summary) + '\n')
+            else:
+                with open(self.filename + '.tmp', 'w') as f:
+                    f.write(self.prometheus())
+                os.rename(self.filename + '.tmp', self.filename)
+        return summary
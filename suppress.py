@@ -0,0 +1,115 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy
+from cruncher import sample_range
+
+class ZeroSuppressor(object):
+    '''
+    Zero suppression of whole sequence blocks before writing. A segment is
+    kept if, on any channel, the largest excursion with the given
+    `polarity` from the mean of the pedestal points `ped_start` to `ped_end`
+    within the window points `win_start` to `win_end` exceeds `threshold`
+    volts. The test is done on the raw samples with one reduction per
+    window. With mode 'drop' the other segments are removed from the block
+    and the remaining events are renumbered from 0; with mode 'shrink' they
+    are kept with their samples zeroed and flagged in the wave descriptor
+    as 'suppressed', which HDF5Writer stores as a num_samples of 0 and
+    RawWriter leaves out of the file. Every block passed on carries the
+    (kept, dropped) segments of the block it came from as 'zs_counts' in
+    its wave descriptors, so that writers can count them per file. Use
+    `process` as a pipeline stage feeding the writer.
+    '''
+    modes = ('drop', 'shrink')
+
+    def __init__(self, ped_start, ped_end, win_start, win_end, threshold, polarity=-1, mode='drop'):
+        if mode not in self.modes:
+            raise Exception('unknown zero suppression mode %s.' % mode)
+        self.ped_start = ped_start
+        self.ped_end = ped_end
+        self.win_start = win_start
+        self.win_end = win_end
+        self.threshold = threshold
+        self.polarity = polarity
+        self.mode = mode
+        self.kept = 0
+        self.dropped = 0
+
+    def select(self, wave_desc, traces):
+        '''
+        Returns a boolean array of the segments of `traces` over threshold.
+        '''
+        start, end = sample_range(self.ped_start, self.ped_end, wave_desc)
+        pedestal = traces[:,start:end].mean(axis=1)
+        start, end = sample_range(self.win_start, self.win_end, wave_desc)
+        window = traces[:,start:end]
+        if self.polarity < 0:
+            excursion = pedestal - window.min(axis=1)
+        else:
+            excursion = window.max(axis=1) - pedestal
+        gain = numpy.abs(numpy.ravel(wave_desc['vertical_gain']))
+        return excursion*gain > self.threshold
+
+    def process(self, i, block):
+        '''
+        Returns the suppressed block with the number of its first event in
+        the output. In drop mode a block may be left with no segments.
+        '''
+        rows = min(len(traces) for wave_desc, traces in block.values())
+        keep = numpy.zeros(rows, dtype=bool)
+        for wave_desc, traces in block.values():
+            keep |= self.select(wave_desc, traces[:rows])
+        count = int(keep.sum())
+        first = self.kept if self.mode == 'drop' else self.kept + self.dropped
+        self.kept += count
+        self.dropped += rows - count
+        suppressed = {}
+        for channel, (wave_desc, traces) in block.items():
+            wave_desc = dict(wave_desc)
+            wave_desc['zs_counts'] = (count, rows - count)
+            if self.mode == 'drop':
+                index = numpy.nonzero(keep)[0]
+                for key in ('trigger_times', 'horiz_offsets'):
+                    if key in wave_desc:
+                        wave_desc[key] = wave_desc[key][index]
+                traces = traces[index]
+            else:
+                traces = traces[:rows].copy()
+                traces[~keep] = 0
+                wave_desc['suppressed'] = ~keep
+            suppressed[channel] = (wave_desc, traces)
+        return (first, suppressed)
+
+    def info(self):
+        '''
+        Returns the settings and counters as a dict for the file metadata.
+        '''
+        return { 'zs_mode' : self.mode,
+                 'zs_threshold' : self.threshold,
+                 'zs_polarity' : self.polarity,
+                 'zs_pedestal' : (self.ped_start, self.ped_end),
+                 'zs_window' : (self.win_start, self.win_end),
+                 'zs_kept' : self.kept,
+                 'zs_dropped' : self.dropped }
+
+    def summary(self):
+        total = self.kept + self.dropped
+        return 'zero suppression: kept %i of %i segments (%.1f%%)' % (self.kept, total, 100.0*self.kept/total if total else 0.0)
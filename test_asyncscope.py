@@ -0,0 +1,88 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+from asyncscope import EventLoop, Return, Timeout, sleep, with_timeout
+
+def sleeper(seconds, value=None):
+    yield sleep(seconds)
+    raise Return(value)
+
+class WithTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def test_outer_deadline_earlier_than_inner(self):
+        def inner():
+            yield with_timeout(sleeper(3.0), 2.5)
+        def outer():
+            try:
+                yield with_timeout(inner(), 0.2)
+            except Timeout:
+                raise Return('outer')
+        start = time.time()
+        cpu = time.clock()
+        self.assertEqual(self.loop.run_until_complete(outer()), 'outer')
+        self.assertLess(time.time() - start, 1.0)
+        self.assertLess(time.clock() - cpu, 0.5)
+
+    def test_inner_deadline_earlier_than_outer(self):
+        def inner():
+            try:
+                yield with_timeout(sleeper(3.0), 0.1)
+            except Timeout:
+                raise Return('inner')
+        def outer():
+            value = yield with_timeout(inner(), 2.0)
+            raise Return(value)
+        self.assertEqual(self.loop.run_until_complete(outer()), 'inner')
+
+    def test_nested_with_timeout(self):
+        def run():
+            value = yield with_timeout(with_timeout(sleeper(0.01, 'done'), 1.0), None)
+            raise Return(value)
+        self.assertEqual(self.loop.run_until_complete(run()), 'done')
+        def expire():
+            yield with_timeout(with_timeout(sleeper(3.0), 2.0), 0.1)
+        start = time.time()
+        self.assertRaises(Timeout, self.loop.run_until_complete, expire())
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_with_timeout_of_task(self):
+        task = self.loop.spawn(sleeper(0.01, 'task'))
+        def run():
+            value = yield with_timeout(task, 1.0)
+            raise Return(value)
+        self.assertEqual(self.loop.run_until_complete(run()), 'task')
+        slow = self.loop.spawn(sleeper(0.5))
+        def expire():
+            yield with_timeout(slow, 0.1)
+        self.assertRaises(Timeout, self.loop.run_until_complete, expire())
+        slow.cancel()
+
+    def test_with_timeout_of_other(self):
+        def run():
+            yield with_timeout(42, 1.0)
+        self.assertRaises(TypeError, self.loop.run_until_complete, run())
+
+if __name__ == '__main__':
+    unittest.main()
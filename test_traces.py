@@ -0,0 +1,69 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from writers import RawWriter, BlockCompressor
+from traces import BlockTraceFile
+
+class IterBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'run.ch1.traces')
+        wave_desc = dict(vertical_offset=0.0, vertical_gain=0.001, horiz_interval=1e-9, horiz_offset=0.0,
+                         trigger_time=(1.5,2,3,4,5,2024,0), trigger_times=numpy.zeros(10), horiz_offsets=numpy.zeros(10))
+        compressor = BlockCompressor('zlib', None, 2)
+        writer = RawWriter(self.filename, {}, wave_desc, compressor)
+        self.traces = numpy.random.RandomState(1).randint(-100, 100, (200, 10, 100)).astype('i1')
+        for i, traces in enumerate(self.traces):
+            writer.write(i*10, wave_desc, traces)
+        writer.close()
+        compressor.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_ahead_at_most_threads_blocks(self):
+        reader = BlockTraceFile(self.filename)
+        decoded = []
+        decode = reader.decode
+        def counting_decode(k):
+            decoded.append(k)
+            return decode(k)
+        reader.decode = counting_decode
+        blocks = reader.iterblocks(threads=4)
+        times, horiz_offsets, traces = next(blocks)
+        self.assertTrue((traces == self.traces[0]).all())
+        self.assertLessEqual(len(decoded), 4)
+        blocks.close()
+
+    def test_reads_every_block_in_order(self):
+        reader = BlockTraceFile(self.filename)
+        for expected, (times, horiz_offsets, traces) in zip(self.traces, reader.iterblocks(threads=4)):
+            self.assertTrue((traces == expected).all())
+        self.assertEqual(len(list(reader.iterblocks(threads=4))), len(self.traces))
+
+if __name__ == '__main__':
+    unittest.main()
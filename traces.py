@@ -0,0 +1,454 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import bz2
+import json
+import collections
+import zlib
+import struct
+from multiprocessing.pool import ThreadPool
+import numpy
+from lecroy import Waveform
+from writers import raw_magic, raw_version, raw_header_format, raw_block_formats, raw_codecs
+
+# record header written by fetch_fast.py, matching its '=IBdddd' pattern
+header_dtype = numpy.dtype([('num_samples', '=u4'),
+                            ('sample_bytes', 'u1'),
+                            ('vert_offset', '=f8'),
+                            ('vert_scale', '=f8'),
+                            ('horiz_offset', '=f8'),
+                            ('horiz_scale', '=f8')])
+
+# per event trigger times of a BlockTraceFile: the acquisition time in seconds
+# since the epoch and the seconds from it to the trigger of the event
+time_dtype = numpy.dtype([('acq_time', 'f8'),
+                          ('trigger_time', 'f8')])
+
+sample_dtypes = { 1 : numpy.dtype('i1'),
+                  2 : numpy.dtype('=i2') }
+
+decompressors = { raw_codecs['zlib'] : zlib.decompress,
+                  raw_codecs['bz2']  : bz2.decompress }
+
+def decode_payload(payload, codec, sequence_count, num_samples, dtype, stored=None):
+    '''
+    Returns (trigger times, horizontal offsets, traces, kept) of a raw block
+    `payload` of which `stored` segments have samples, decompressing and
+    undoing the delta encoding of the samples for codecs other than none.
+    Segments that were not stored are zero in `traces` and False in the
+    boolean array `kept`, which is None if all segments were stored.
+    '''
+    if codec != raw_codecs['none']:
+        payload = numpy.frombuffer(decompressors[codec](payload), dtype=numpy.uint8)
+    times = payload[:8*sequence_count].view('<f8')
+    horiz_offsets = payload[8*sequence_count:16*sequence_count].view('<f8')
+    start = 16*sequence_count
+    kept = None
+    if stored is None or stored == sequence_count:
+        stored = sequence_count
+    else:
+        kept = payload[start:start+sequence_count].view(numpy.bool_)
+        start += sequence_count
+    traces = payload[start:start+stored*num_samples*dtype.itemsize].view(dtype).reshape(stored, num_samples)
+    if codec != raw_codecs['none']:
+        traces = numpy.cumsum(traces, axis=1, dtype=dtype)
+    if kept is not None:
+        full = numpy.zeros((sequence_count, num_samples), dtype=dtype)
+        full[kept] = traces
+        traces = full
+    return times, horiz_offsets, traces, kept
+
+def meta_wave_desc(meta, first_point=0, sparsing_factor=1):
+    '''
+    Returns a wave descriptor with one value per event of the record headers
+    or writers.meta_dtype fields in `meta`, for the Waveform of those events
+    and for Cruncher.crunch.
+    '''
+    return { 'vertical_gain'   : numpy.asarray(meta['vert_scale'])[:,numpy.newaxis],
+             'vertical_offset' : numpy.asarray(meta['vert_offset'])[:,numpy.newaxis],
+             'horiz_interval'  : numpy.asarray(meta['horiz_scale']),
+             'horiz_offset'    : -numpy.asarray(meta['horiz_offset']),
+             'first_point'     : first_point,
+             'sparsing_factor' : sparsing_factor }
+
+def read_hdf5(f, channel, start, stop):
+    '''
+    Returns (traces, meta) of events `start` to `stop` of `channel` from a
+    fetch.py HDF5 file, where meta has the fields of writers.meta_dtype.
+    '''
+    traces = f['c%i_samples'%channel][start:stop]
+    if 'c%i_meta'%channel in f:
+        return traces, f['c%i_meta'%channel][start:stop]
+    # files written before the compound metadata dataset
+    meta = {}
+    for name in ('vert_offset', 'vert_scale', 'horiz_offset', 'horiz_scale'):
+        meta[name] = f['c%i_%s'%(channel,name)][start:stop]
+    return traces, meta
+
+def hdf5_waveforms(f, channel, start=0, stop=None):
+    '''
+    Returns the Waveform of events `start` to `stop` of `channel` from an
+    open fetch.py HDF5 file.
+    '''
+    traces, meta = read_hdf5(f, channel, start, stop)
+    attrs = f['c%i_samples'%channel].attrs
+    return Waveform(meta_wave_desc(meta, int(attrs.get('first_point', 0)), int(attrs.get('sparsing_factor', 1))), traces)
+
+class TraceFile(object):
+    '''
+    Random access reader for the <prefix>.chN.traces files of fetch_fast.py,
+    backed by numpy.memmap. When every record has the same length the file
+    is viewed as one structured array and nothing is parsed per record.
+    Otherwise an index of record offsets is built once and saved next to the
+    file as <filename>.index, to be reused and extended on the next open.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='r') if os.path.getsize(filename) else numpy.zeros(0, numpy.uint8)
+        self.records = None
+        self.offsets = numpy.zeros(0, numpy.int64)
+        if len(self.data) < header_dtype.itemsize:
+            return
+        if self.data[:len(raw_magic)].tostring() == raw_magic:
+            raise Exception('%s is a block oriented raw file, use BlockTraceFile.' % filename)
+        first = self.data[:header_dtype.itemsize].view(header_dtype)[0]
+        record_dtype = numpy.dtype(header_dtype.descr + [('samples', sample_dtypes[int(first['sample_bytes'])], (int(first['num_samples']),))])
+        nrecords = len(self.data)//record_dtype.itemsize
+        records = self.data[:nrecords*record_dtype.itemsize].view(record_dtype)
+        if (records['num_samples'] == first['num_samples']).all() and (records['sample_bytes'] == first['sample_bytes']).all():
+            self.records = records
+        else:
+            self.offsets = self.build_index()
+
+    def build_index(self):
+        '''
+        Returns the byte offset of every complete record, reusing and
+        extending the sidecar index file.
+        '''
+        index = self.filename + '.index'
+        offsets = [0]
+        if os.path.exists(index):
+            saved = numpy.fromfile(index, dtype=numpy.int64)
+            if len(saved) and saved[-1] <= len(self.data):
+                offsets = list(saved)
+        size = len(self.data)
+        end = offsets[-1]
+        while end + header_dtype.itemsize <= size:
+            header = self.data[end:end+header_dtype.itemsize].view(header_dtype)[0]
+            next_end = end + header_dtype.itemsize + int(header['num_samples'])*int(header['sample_bytes'])
+            if next_end > size:
+                break
+            end = next_end
+            offsets.append(end)
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        try:
+            offsets.tofile(index)
+        except IOError:
+            pass
+        return offsets[:-1]
+
+    def __len__(self):
+        if self.records is not None:
+            return len(self.records)
+        return len(self.offsets)
+
+    def header(self, i):
+        '''
+        Returns the record header of event `i`.
+        '''
+        if self.records is not None:
+            if i < 0:
+                i += len(self)
+            return self.headers(i, i+1)[0]
+        offset = self.offsets[i]
+        return self.data[offset:offset+header_dtype.itemsize].view(header_dtype)[0]
+
+    def headers(self, start=0, stop=None):
+        '''
+        Returns the record headers of events `start` to `stop` as an array of
+        `header_dtype`.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        headers = numpy.empty(max(0, stop-start), dtype=header_dtype)
+        if self.records is not None:
+            for name in header_dtype.names:
+                headers[name] = self.records[name][start:stop]
+        else:
+            for n, offset in enumerate(self.offsets[start:stop]):
+                headers[n] = self.data[offset:offset+header_dtype.itemsize].view(header_dtype)[0]
+        return headers
+
+    def samples(self, i):
+        '''
+        Returns the samples of event `i` as a read only view of the file.
+        '''
+        if self.records is not None:
+            return self.records['samples'][i]
+        header = self.header(i)
+        start = self.offsets[i] + header_dtype.itemsize
+        dtype = sample_dtypes[int(header['sample_bytes'])]
+        return self.data[start:start+int(header['num_samples'])*dtype.itemsize].view(dtype)
+
+    def __getitem__(self, key):
+        '''
+        Returns the samples of one event for an integer `key`, or a 2D array
+        of events by samples for a slice. Records shorter than the longest
+        one in a slice are padded with zeros.
+        '''
+        if isinstance(key, slice):
+            if self.records is not None:
+                return self.records['samples'][key]
+            traces = [self.samples(i) for i in xrange(*key.indices(len(self)))]
+            if not traces:
+                return numpy.zeros((0,0), dtype=numpy.int8)
+            out = numpy.zeros((len(traces), max(len(trace) for trace in traces)), dtype=traces[0].dtype)
+            for n, trace in enumerate(traces):
+                out[n,:len(trace)] = trace
+            return out
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('event %i out of range.' % key)
+        return self.samples(key)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.samples(i)
+
+    def waveforms(self, start=0, stop=None):
+        '''
+        Returns the Waveform of events `start` to `stop`.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        return Waveform(meta_wave_desc(self.headers(start, stop)), self[start:stop])
+
+    def batches(self, size):
+        '''
+        Iterates over the file in batches of `size` events, yielding tuples
+        of (first event, headers, 2D samples).
+        '''
+        for start in xrange(0, len(self), size):
+            yield start, self.headers(start, start+size), self[start:start+size]
+
+class BlockTraceFile(object):
+    '''
+    Random access reader for the versioned, block oriented raw files written
+    by fetch_fast.py, backed by numpy.memmap. Only the block headers, one per
+    acquisition, are parsed when the file is opened. `info` holds the scope
+    settings and wave descriptor stored in the file header. Uncompressed
+    blocks are returned as views of the file; compressed blocks are
+    decompressed on access, keeping the last one, or in parallel by
+    `iterblocks`.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        start = len(raw_magic) + struct.calcsize(raw_header_format)
+        if self.data[:len(raw_magic)].tostring() != raw_magic:
+            raise Exception('%s is not a block oriented raw file.' % filename)
+        self.version, length = struct.unpack(raw_header_format, self.data[len(raw_magic):start].tostring())
+        if self.version > raw_version:
+            raise Exception('%s has unsupported version %i.' % (filename, self.version))
+        self.info = json.loads(self.data[start:start+length].tostring(), encoding='latin-1')
+        self.blocks = []
+        self.cached = (None, None)
+        offset = start + length
+        block_format = raw_block_formats[self.version]
+        self.blocksize = struct.calcsize(block_format)
+        size = len(self.data)
+        while offset + self.blocksize <= size:
+            fields = struct.unpack(block_format, self.data[offset:offset+self.blocksize].tostring())
+            first, sequence_count, num_samples, sample_bytes, vert_offset, vert_scale, horiz_scale = fields[:7]
+            acq_time = fields[7] if len(fields) > 7 else 0.0
+            if len(fields) > 8:
+                codec, payload_bytes = fields[8:10]
+            else:
+                codec, payload_bytes = raw_codecs['none'], sequence_count*(16 + num_samples*sample_bytes)
+            stored = fields[10] if len(fields) > 10 else sequence_count
+            end = offset + self.blocksize + payload_bytes
+            if end > size:
+                break
+            self.blocks.append((offset, sequence_count, num_samples, sample_bytes, vert_offset, vert_scale, horiz_scale, acq_time, codec, payload_bytes, stored))
+            offset = end
+        # index of the first event of each block, plus the total
+        self.starts = numpy.cumsum([0] + [block[1] for block in self.blocks])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def decode(self, k):
+        offset, sequence_count, num_samples, sample_bytes, vert_offset, vert_scale, horiz_scale, acq_time, codec, payload_bytes, stored = self.blocks[k]
+        offset += self.blocksize
+        return decode_payload(self.data[offset:offset+payload_bytes], codec, sequence_count, num_samples, sample_dtypes[sample_bytes].newbyteorder('<'), stored)
+
+    def block(self, k):
+        '''
+        Returns a tuple of (trigger times, horizontal offsets, traces, kept)
+        of acquisition block `k`, see decode_payload, as read only views of
+        the file unless the block is compressed or has suppressed segments.
+        '''
+        if self.blocks[k][8] == raw_codecs['none'] and self.blocks[k][10] == self.blocks[k][1]:
+            return self.decode(k)
+        if self.cached[0] != k:
+            self.cached = (k, self.decode(k))
+        return self.cached[1]
+
+    def iterblocks(self, threads=4):
+        '''
+        Yields (trigger times, horizontal offsets, traces) of every block in
+        order, decompressing up to `threads` blocks ahead in parallel.
+        '''
+        if threads < 2 or all(block[8] == raw_codecs['none'] for block in self.blocks):
+            for k in xrange(len(self.blocks)):
+                yield self.decode(k)[:3]
+            return
+        pool = ThreadPool(threads)
+        pending = collections.deque()
+        try:
+            for k in xrange(len(self.blocks)):
+                if len(pending) == threads:
+                    yield pending.popleft().get()[:3]
+                pending.append(pool.apply_async(self.decode, (k,)))
+            while pending:
+                yield pending.popleft().get()[:3]
+        finally:
+            pool.terminate()
+
+    def locate(self, i):
+        '''
+        Returns the block and the position in that block of event `i`.
+        '''
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('event %i out of range.' % i)
+        k = int(numpy.searchsorted(self.starts, i, side='right')) - 1
+        return k, i - int(self.starts[k])
+
+    def headers(self, start=0, stop=None):
+        '''
+        Returns the per event headers of events `start` to `stop` as an array
+        of `header_dtype`, like TraceFile.headers. Suppressed segments have a
+        num_samples of 0, as in HDF5 files.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        headers = numpy.empty(max(0, stop-start), dtype=header_dtype)
+        for k, lo, hi, pos in self.spans(start, stop):
+            offset, sequence_count, num_samples, sample_bytes, vert_offset, vert_scale, horiz_scale, acq_time, codec, payload_bytes, stored = self.blocks[k]
+            rows = headers[pos:pos+hi-lo]
+            kept = self.block(k)[3]
+            rows['num_samples'] = num_samples if kept is None else numpy.where(kept[lo:hi], num_samples, 0)
+            rows['sample_bytes'] = sample_bytes
+            rows['vert_offset'] = vert_offset
+            rows['vert_scale'] = vert_scale
+            rows['horiz_offset'] = self.block(k)[1][lo:hi]
+            rows['horiz_scale'] = horiz_scale
+        return headers
+
+    def trigger_times(self, start=0, stop=None):
+        '''
+        Returns the trigger times of events `start` to `stop` as an array of
+        `time_dtype`. Files of version 1 have no acquisition times.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        times = numpy.empty(max(0, stop-start), dtype=time_dtype)
+        for k, lo, hi, pos in self.spans(start, stop):
+            times['acq_time'][pos:pos+hi-lo] = self.blocks[k][7]
+            times['trigger_time'][pos:pos+hi-lo] = self.block(k)[0][lo:hi]
+        return times
+
+    def spans(self, start, stop):
+        '''
+        Yields (block, first row, end row, output position) for each block
+        holding events `start` to `stop`.
+        '''
+        if start >= stop:
+            return
+        k = int(numpy.searchsorted(self.starts, start, side='right')) - 1
+        pos = 0
+        while k < len(self.blocks) and self.starts[k] < stop:
+            lo = max(start, self.starts[k]) - self.starts[k]
+            hi = min(stop, self.starts[k+1]) - self.starts[k]
+            yield k, int(lo), int(hi), pos
+            pos += hi - lo
+            k += 1
+
+    def samples(self, i):
+        '''
+        Returns the samples of event `i` as a read only view of the file.
+        '''
+        k, n = self.locate(i)
+        return self.block(k)[2][n]
+
+    def __getitem__(self, key):
+        '''
+        Returns the samples of one event for an integer `key`, or a 2D array
+        of events by samples for a contiguous slice. Within a single block the
+        slice is a view of the file.
+        '''
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise IndexError('only contiguous slices are supported.')
+            spans = list(self.spans(start, stop))
+            if not spans:
+                return numpy.zeros((0,0), dtype=numpy.int8)
+            if len(spans) == 1:
+                k, lo, hi, pos = spans[0]
+                return self.block(k)[2][lo:hi]
+            pieces = [self.block(k)[2][lo:hi] for k, lo, hi, pos in spans]
+            out = numpy.zeros((stop-start, max(piece.shape[1] for piece in pieces)), dtype=pieces[0].dtype)
+            for (k, lo, hi, pos), piece in zip(spans, pieces):
+                out[pos:pos+hi-lo,:piece.shape[1]] = piece
+            return out
+        return self.samples(key)
+
+    def __iter__(self):
+        for times, horiz_offsets, traces in self.iterblocks():
+            for trace in traces:
+                yield trace
+
+    def waveforms(self, start=0, stop=None):
+        '''
+        Returns the Waveform of events `start` to `stop`.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        wave_desc = self.info.get('wave_desc', {})
+        return Waveform(meta_wave_desc(self.headers(start, stop), wave_desc.get('first_point', 0), wave_desc.get('sparsing_factor', 1)), self[start:stop])
+
+    def batches(self, size):
+        '''
+        Iterates over the file in batches of `size` events, yielding tuples
+        of (first event, headers, 2D samples).
+        '''
+        for start in xrange(0, len(self), size):
+            yield start, self.headers(start, start+size), self[start:start+size]
+
+def open_traces(filename):
+    '''
+    Opens a .traces file with the reader matching its format.
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(len(raw_magic))
+    if magic == raw_magic:
+        return BlockTraceFile(filename)
+    return TraceFile(filename)
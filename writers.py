@@ -0,0 +1,407 @@
+# LeCrunch2
+# Copyright (C) 2014 Benjamin Land
+#
+# based on
+#
+# LeCrunch
+# Copyright (C) 2010 Anthony LaTorre
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+import json
+import time
+import zlib
+import struct
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+import h5py
+import numpy
+from lecroy import timestamp
+
+# per event metadata stored alongside the samples of each channel
+meta_dtype = numpy.dtype([('num_samples', 'i4'),
+                          ('vert_offset', 'f8'),
+                          ('vert_scale', 'f8'),
+                          ('horiz_offset', 'f8'),
+                          ('horiz_scale', 'f8'),
+                          ('acq_time', 'f8'),
+                          ('trigger_time', 'f8')])
+
+def segment_times(wave_desc, rows):
+    '''
+    Returns (acquisition time, trigger times, horizontal offsets) of the
+    first `rows` segments of an acquisition: the descriptor trigger_time in
+    seconds since the epoch, and per segment the seconds since that trigger
+    and the horiz_offset, from the trigger time array if it was fetched.
+    '''
+    acq_time = timestamp(wave_desc) if 'trigger_time' in wave_desc else 0.0
+    if 'trigger_times' in wave_desc:
+        return acq_time, wave_desc['trigger_times'][:rows], wave_desc['horiz_offsets'][:rows]
+    horiz_offsets = numpy.empty(rows)
+    horiz_offsets.fill(wave_desc['horiz_offset'])
+    return acq_time, numpy.zeros(rows), horiz_offsets
+
+def hdf5_filter(compression, level=None):
+    '''
+    Returns the h5py (compression, compression_opts) for a `compression` of
+    'gzip', 'lzf' or 'none'.
+    '''
+    if compression == 'none':
+        return None, None
+    if compression == 'lzf':
+        return 'lzf', None
+    if compression == 'gzip':
+        return 'gzip', level
+    raise Exception('unknown compression %s.' % compression)
+
+class HDF5Writer(object):
+    '''
+    Writes acquisitions to an HDF5 file. `block_events` events are collected
+    per channel in memory and flushed as a single hyperslab write for each
+    dataset, with the dataset chunks aligned to that block. The per event
+    metadata of channel N is one compound dataset `cN_meta` of `meta_dtype`.
+    The dataset names are formatted from `names` and the channel keys, so
+    other keys than channel numbers can be used with a matching format.
+    Segments flagged in the wave descriptor array 'suppressed' are stored
+    with a num_samples of 0.
+    '''
+    def __init__(self, filename, nevents, sequence_count, settings, wave_descs, block_events=1024, compression='gzip', level=None, shuffle=False, names='c%i'):
+        self.nevents = nevents
+        self.sequence_count = sequence_count
+        self.channels = sorted(wave_descs.keys())
+        # a block holds whole acquisitions, but no more than the whole run
+        block_events = min(block_events, nevents + sequence_count - 1)
+        self.block_events = max(1, block_events//sequence_count)*sequence_count
+        compression, compression_opts = hdf5_filter(compression, level)
+        self.filenames = [filename]
+        self.f = h5py.File(filename, 'w')
+        for command, setting in settings.items():
+            self.f.attrs[command] = setting
+        self.current_dim = {}
+        self.samples = {}
+        self.meta = {}
+        self.buffer = {}
+        self.meta_buffer = {}
+        for channel in self.channels:
+            wave_desc = wave_descs[channel]
+            self.current_dim[channel] = wave_desc['wave_array_count']//sequence_count
+            self.samples[channel] = self.f.create_dataset((names + "_samples")%channel, (nevents,self.current_dim[channel]), dtype=wave_desc['dtype'], chunks=(self.block_events,self.current_dim[channel]), maxshape=(None,None), compression=compression, compression_opts=compression_opts, shuffle=shuffle)
+            for key, value in wave_desc.items():
+                try:
+                    self.samples[channel].attrs[key] = value
+                except ValueError:
+                    pass
+            self.meta[channel] = self.f.create_dataset((names + "_meta")%channel, (nevents,), dtype=meta_dtype, chunks=(self.block_events,), maxshape=(None,))
+            self.buffer[channel] = numpy.zeros((self.block_events,self.current_dim[channel]), dtype=wave_desc['dtype'])
+            self.meta_buffer[channel] = numpy.zeros((self.block_events,), dtype=meta_dtype)
+        self.start = 0
+        self.fill = 0
+        self.count = 0
+
+    def resize(self, channel, num_samples):
+        '''
+        Widens the samples of `channel` to `num_samples` per event.
+        '''
+        self.current_dim[channel] = num_samples
+        self.samples[channel].resize(num_samples, 1)
+        self.buffer[channel] = numpy.zeros((self.block_events,num_samples), dtype=self.buffer[channel].dtype)
+
+    def write(self, i, block):
+        '''
+        Buffers the acquisition `block` of channel->(wave_desc, traces) whose
+        first event is `i`, flushing when the buffers are full.
+        '''
+        rows = min(min(len(traces) for wave_desc, traces in block.values()), self.nevents - i)
+        if rows <= 0:
+            return
+        grown = [channel for channel, (wave_desc, traces) in block.items() if traces.shape[1] > self.current_dim[channel]]
+        if grown:
+            self.flush()
+            for channel in grown:
+                self.resize(channel, block[channel][1].shape[1])
+        if self.fill == 0:
+            self.start = i
+        end = self.fill + rows
+        for channel, (wave_desc, traces) in block.items():
+            num_samples = traces.shape[1]
+            buf = self.buffer[channel]
+            buf[self.fill:end,:num_samples] = traces[:rows]
+            buf[self.fill:end,num_samples:] = 0
+            acq_time, trigger_times, horiz_offsets = segment_times(wave_desc, rows)
+            meta = self.meta_buffer[channel][self.fill:end]
+            if 'suppressed' in wave_desc:
+                meta['num_samples'] = numpy.where(wave_desc['suppressed'][:rows], 0, num_samples)
+            else:
+                meta['num_samples'] = num_samples
+            meta['vert_offset'] = wave_desc['vertical_offset']
+            meta['vert_scale'] = wave_desc['vertical_gain']
+            meta['horiz_offset'] = -horiz_offsets
+            meta['horiz_scale'] = wave_desc['horiz_interval']
+            meta['acq_time'] = acq_time
+            meta['trigger_time'] = trigger_times
+        self.fill = end
+        if self.fill + self.sequence_count > self.block_events:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered events of every channel to the file.
+        '''
+        if self.fill == 0:
+            return
+        end = self.start + self.fill
+        for channel in self.channels:
+            self.samples[channel][self.start:end] = self.buffer[channel][:self.fill]
+            self.meta[channel][self.start:end] = self.meta_buffer[channel][:self.fill]
+        self.count = end
+        self.fill = 0
+
+    def update_info(self, values):
+        '''
+        Stores a dict of run information as attributes of the file.
+        '''
+        for key, value in values.items():
+            self.f.attrs[key] = value
+
+    def close(self):
+        '''
+        Flushes the buffers and truncates the datasets to the events written.
+        '''
+        self.flush()
+        for channel in self.channels:
+            self.samples[channel].resize(self.count, 0)
+            self.meta[channel].resize(self.count, 0)
+        self.f.close()
+
+# Block oriented raw format written by fetch_fast.py, all little endian:
+#   file header:  raw_magic, raw_header_format (version, info length), then
+#                 the info as JSON: the scope settings and the wave descriptor
+#   per acquisition: raw_block_format (first event, sequence count,
+#                 num_samples, sample bytes, v_off, v_scale, h_scale and,
+#                 since version 2, the acquisition time, since version 3,
+#                 the codec and payload length and, since version 4, the
+#                 number of segments stored), then the payload: trigger
+#                 times f8[sequence count], h_off f8[sequence count], if
+#                 fewer segments are stored than acquired a u1[sequence
+#                 count] mask of the stored ones, and samples[segments
+#                 stored, num_samples]. Segments suppressed by a
+#                 ZeroSuppressor in shrink mode are not stored. With a codec other
+#                 than none, the samples of each segment are delta encoded
+#                 and the whole payload compressed on its own, so blocks can
+#                 be decompressed independently.
+raw_magic = 'LECRUNCH'
+raw_version = 4
+raw_header_format = '<HI'
+raw_block_formats = { 1 : '<QIIBddd',
+                      2 : '<QIIBdddd',
+                      3 : '<QIIBddddBQ',
+                      4 : '<QIIBddddBQI' }
+raw_block_format = raw_block_formats[raw_version]
+
+# spaces appended to the info JSON by RawWriter, making room for run
+# information that is only known once the run is over
+raw_info_reserve = 1024
+
+# codec numbers of the raw block format, and the default level of each
+raw_codecs = { 'none' : 0,
+               'zlib' : 1,
+               'bz2'  : 2 }
+raw_levels = { 'zlib' : 6,
+               'bz2'  : 9 }
+compressors = { 'zlib' : zlib.compress,
+                'bz2'  : bz2.compress }
+
+def json_wavedesc(wave_desc):
+    '''
+    Returns a copy of `wave_desc` containing only JSON serializable values.
+    '''
+    return dict((key, value) for key, value in wave_desc.items() if isinstance(value, (str, int, long, float, bool, tuple)))
+
+def delta_encode(traces):
+    '''
+    Returns the differences between neighbouring samples of each segment of
+    `traces`, starting with the first sample, in the integer type of the
+    samples. Overflows wrap around, which the cumulative sum in the same
+    type undoes.
+    '''
+    deltas = numpy.empty_like(traces)
+    deltas[:,:1] = traces[:,:1]
+    numpy.subtract(traces[:,1:], traces[:,:-1], out=deltas[:,1:])
+    return deltas
+
+class BlockCompressor(object):
+    '''
+    Delta encodes and compresses the payloads of raw blocks with `codec`
+    ('zlib' or 'bz2') at `level` on a pool of `workers` threads; both
+    codecs release the GIL while they run. One compressor can be shared by
+    the RawWriters of all channels. The bytes in and out and the time spent
+    compressing are counted, and recorded as the 'compress' stage of
+    `stats` if given.
+    '''
+    def __init__(self, codec='zlib', level=None, workers=2, stats=None):
+        if codec not in compressors:
+            raise Exception('unknown compression %s.' % codec)
+        self.codec = codec
+        self.level = raw_levels[codec] if level is None else level
+        self.workers = workers
+        self.stats = stats
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.seconds = 0.0
+        self.start = time.time()
+
+    def compress(self, times, offsets, samples, mask=''):
+        '''
+        Returns the codec number and the compressed payload of a block.
+        '''
+        start = time.time()
+        data = times.tostring() + offsets.tostring() + mask + delta_encode(samples).tostring()
+        payload = compressors[self.codec](data, self.level)
+        seconds = time.time() - start
+        with self.lock:
+            self.raw_bytes += len(data)
+            self.stored_bytes += len(payload)
+            self.seconds += seconds
+        if self.stats is not None:
+            self.stats.record('compress', seconds, len(data))
+        return raw_codecs[self.codec], payload
+
+    def submit(self, times, offsets, samples, mask=''):
+        '''
+        Queues a block for compression and returns its AsyncResult.
+        '''
+        return self.pool.apply_async(self.compress, (times, offsets, samples, mask))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def summary(self):
+        with self.lock:
+            raw_bytes, stored_bytes, seconds = self.raw_bytes, self.stored_bytes, self.seconds
+        return 'compression: %s level %i, %.1f MB to %.1f MB (ratio %.2f), %.1f MB/s per worker, %.1f MB/s with %i workers' % \
+            (self.codec, self.level, raw_bytes/1e6, stored_bytes/1e6, raw_bytes/float(stored_bytes) if stored_bytes else 0.0,
+             raw_bytes/seconds/1e6 if seconds > 0 else 0.0, raw_bytes/(time.time() - self.start)/1e6, self.workers)
+
+class RawWriter(object):
+    '''
+    Writes acquisitions of one channel to a versioned, block oriented raw
+    file. Every segment of an acquisition shares a single block header and
+    the whole sequence of samples is written in one call. Segments flagged
+    as 'suppressed' in the wave descriptor are left out, see
+    suppress.ZeroSuppressor. With a
+    BlockCompressor as `compressor`, the blocks are compressed in the
+    background and written in order as they are done, with no more than
+    two blocks per worker pending.
+    '''
+    def __init__(self, filename, settings, wave_desc, compressor=None):
+        self.f = open(filename, 'wb')
+        self.info = {'settings' : settings, 'wave_desc' : json_wavedesc(wave_desc)}
+        info = json.dumps(self.info, encoding='latin-1')
+        self.info_length = len(info) + raw_info_reserve
+        self.f.write(raw_magic + struct.pack(raw_header_format, raw_version, self.info_length) + info.ljust(self.info_length))
+        self.compressor = compressor
+        self.pending = collections.deque()
+        self.count = 0
+
+    def write(self, i, wave_desc, traces, trigger_times=None, horiz_offsets=None):
+        '''
+        Writes the `traces` of the acquisition whose first event is `i`. The
+        per segment times default to those of `wave_desc`, see segment_times.
+        With a compressor, `traces` must not change until it is written.
+        '''
+        sequence_count, num_samples = traces.shape
+        if sequence_count == 0:
+            return
+        acq_time, times, offsets = segment_times(wave_desc, sequence_count)
+        if trigger_times is None:
+            trigger_times = times
+        if horiz_offsets is None:
+            horiz_offsets = -offsets
+        fields = (i, sequence_count, num_samples, traces.dtype.itemsize, wave_desc['vertical_offset'], wave_desc['vertical_gain'], wave_desc['horiz_interval'], acq_time)
+        trigger_times = numpy.asarray(trigger_times, dtype='<f8')
+        horiz_offsets = numpy.asarray(horiz_offsets, dtype='<f8')
+        mask = ''
+        if 'suppressed' in wave_desc and wave_desc['suppressed'][:sequence_count].any():
+            kept = ~wave_desc['suppressed'][:sequence_count]
+            mask = kept.astype(numpy.uint8).tostring()
+            traces = traces[kept]
+        samples = numpy.ascontiguousarray(traces, dtype=traces.dtype.newbyteorder('<'))
+        self.count = i + sequence_count
+        if self.compressor is None:
+            header = struct.pack(raw_block_format, *(fields + (raw_codecs['none'], 16*sequence_count + len(mask) + samples.nbytes, len(samples))))
+            self.f.write(header + trigger_times.tostring() + horiz_offsets.tostring() + mask)
+            samples.tofile(self.f)
+            return
+        self.pending.append((fields, len(samples), self.compressor.submit(trigger_times, horiz_offsets, samples, mask)))
+        while self.pending and (self.pending[0][2].ready() or len(self.pending) > 2*self.compressor.workers):
+            self.write_pending()
+
+    def write_pending(self):
+        '''
+        Waits for the oldest pending block to be compressed and writes it.
+        '''
+        fields, stored, result = self.pending.popleft()
+        codec, payload = result.get()
+        self.f.write(struct.pack(raw_block_format, *(fields + (codec, len(payload), stored))) + payload)
+
+    def update_info(self, values):
+        '''
+        Adds a dict of run information to the info of the file header, in
+        the space reserved for it.
+        '''
+        info = json.dumps(dict(self.info, **values), encoding='latin-1')
+        if len(info) > self.info_length:
+            raise Exception('run information does not fit in the file header.')
+        self.info = dict(self.info, **values)
+        position = self.f.tell()
+        self.f.seek(len(raw_magic) + struct.calcsize(raw_header_format))
+        self.f.write(info.ljust(self.info_length))
+        self.f.seek(position)
+
+    def close(self):
+        while self.pending:
+            self.write_pending()
+        self.f.close()
+
+class RawFileSet(object):
+    '''
+    The RawWriters of all channels of a run, writing `<prefix>.chN.traces`.
+    Takes whole blocks of channel->(wave_desc, traces) like HDF5Writer.
+    '''
+    def __init__(self, prefix, settings, wave_descs, compressor=None):
+        self.writers = dict((channel, RawWriter('%s.ch%s.traces' % (prefix, channel), settings, wave_desc, compressor))
+                            for channel, wave_desc in wave_descs.items())
+        self.filenames = ['%s.ch%s.traces' % (prefix, channel) for channel in sorted(wave_descs)]
+
+    def write(self, i, block):
+        for channel, writer in self.writers.items():
+            wave_desc, traces = block[channel]
+            writer.write(i, wave_desc, traces)
+
+    @property
+    def count(self):
+        return max(writer.count for writer in self.writers.values())
+
+    def update_info(self, values):
+        for writer in self.writers.values():
+            writer.update_info(values)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()